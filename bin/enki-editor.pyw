@@ -5,6 +5,7 @@ Windows entry point. See also enki.py
 
 import sys
 import os.path
+import multiprocessing
 
 """
 When script is executed from the source tree, it shall import enki package, which is one level higher.
@@ -15,4 +16,5 @@ sys.path.insert(0, os.path.join(sys.path[0], '..'))
 import enki.main
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # search worker processes in the frozen Windows build
     sys.exit(enki.main.main())
@@ -131,6 +131,41 @@ class Config():
             self._data['FileBrowser'] = {'LastPath': ''}
             self._data['_version'] = 15
 
+        if self._data['_version'] == 15:
+            self._data['Search'] = {'WorkerCount': 0}
+            self._data['_version'] = 16
+
+        if self._data['_version'] == 16:
+            self._data['Search']['TrigramIndex'] = False
+            self._data['_version'] = 17
+
+        if self._data['_version'] == 17:
+            self._data['Search']['ResultsEmitInterval'] = 250
+            self._data['Search']['MaxResultsBatchSize'] = 1000
+            self._data['Search']['MaxPendingResultsBatches'] = 4
+            self._data['_version'] = 18
+
+        if self._data['_version'] == 18:
+            self._data['Search']['ResultCacheSize'] = 64
+            self._data['_version'] = 19
+
+        if self._data['_version'] == 19:
+            self._data['Search']['MaxResultsInMemory'] = 200000
+            self._data['_version'] = 20
+
+        if self._data['_version'] == 20:
+            self._data['Preview']['RenderCacheSize'] = 32
+            self._data['_version'] = 21
+
+        if self._data['_version'] == 21:
+            self._data['Preview']['IncrementalUpdate'] = True
+            self._data['_version'] = 22
+
+        if self._data['_version'] == 22:
+            self._data['Preview']['ConverterProcesses'] = 1
+            self._data['Preview']['ConverterTimeout'] = 30
+            self._data['_version'] = 23
+
     def _setPlatformDefaults(self):
         """Set default values, which depend on platform
         """
@@ -65,6 +65,7 @@ class Core(QObject):
         self._config = None
         self._uiSettingsManager = None
         self._fileFilter = None
+        self._projectFiles = None
         self._loadedPlugins = []
         self._cmdLine = {}
 
@@ -121,6 +122,10 @@ class Core(QObject):
         self._fileFilter = enki.core.filefilter.FileFilter()
         profiler.stepDone('Create FileFilter')
 
+        import enki.core.projectfiles
+        self._projectFiles = enki.core.projectfiles.ProjectFiles()
+        profiler.stepDone('Create ProjectFiles')
+
         import enki.core.locator
         self._locator = enki.core.locator.Locator(self._mainWindow)
         profiler.stepDone('Create Locator')
@@ -148,6 +153,9 @@ class Core(QObject):
         if self._locator is not None:
             self._locator.del_()
             self._locator = None
+        if self._projectFiles is not None:
+            self._projectFiles.del_()
+            self._projectFiles = None
         if self._fileFilter is not None:
             self._fileFilter = None
         if self._uiSettingsManager is not None:
@@ -272,6 +280,13 @@ class Core(QObject):
         """
         return self._fileFilter
 
+    def projectFiles(self):
+        """Lists of files of the project directories
+
+        See ::mod:`enki.core.projectfiles`
+        """
+        return self._projectFiles
+
     def locator(self):
         """::class:`enki.core.locator.Locator` instance
 
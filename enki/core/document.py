@@ -12,6 +12,7 @@ from PyQt4.QtGui import QColor, QFileDialog, \
                         QInputDialog, \
                         QMessageBox, \
                         QPlainTextEdit, \
+                        QTextCursor, \
                         QTextOption, \
                         QWidget, \
                         QVBoxLayout
@@ -141,6 +142,26 @@ class _FileWatcher(QObject):
             return None
 
 
+def _minimalEdit(text, start, end, newText):
+    """Get the smallest edit (start, end, newText), which replaces text[start:end] with newText.
+    None, if the text is not changed
+    """
+    oldText = text[start:end]
+    if oldText == newText:
+        return None
+
+    prefixLength = len(os.path.commonprefix([oldText, newText]))
+    maxSuffixLength = min(len(oldText), len(newText)) - prefixLength
+    suffixLength = 0
+    while suffixLength < maxSuffixLength and \
+          oldText[-1 - suffixLength] == newText[-1 - suffixLength]:
+        suffixLength += 1
+
+    return (start + prefixLength,
+            end - suffixLength,
+            newText[prefixLength:len(newText) - suffixLength])
+
+
 class Document(QWidget):
     """
     Document is a opened file representation.
@@ -412,6 +433,36 @@ class Document(QWidget):
         self._externallyRemoved = False
         self.qutepart.cursorPosition = pos
 
+    def applyReplacements(self, replacements):
+        """Replace parts of the text as one undoable action.
+
+        replacements is list of tuples (start, end, newText). start and end are absolute positions in the current text.
+        Replaced parts must not overlap.
+
+        Only minimal edits are applied: replacements, which don't change the text, are skipped, common beginning
+        and end of the old and the new text are not touched. Therefore cursors and marks out of changed parts are kept.
+        The document notifies the highlighters about the changes once, when all edits have been applied.
+
+        Returns count of applied edits
+        """
+        text = self.qutepart.text
+        edits = []
+        for start, end, newText in replacements:
+            edit = _minimalEdit(text, start, end, newText)
+            if edit is not None:
+                edits.append(edit)
+
+        if edits:
+            edits.sort(key=lambda edit: edit[0], reverse=True)  # from the end, edits don't move next positions
+            cursor = QTextCursor(self.qutepart.document())
+            with self.qutepart:
+                for start, end, newText in edits:
+                    cursor.setPosition(start)
+                    cursor.setPosition(end, QTextCursor.KeepAnchor)
+                    cursor.insertText(newText)
+
+        return len(edits)
+
     def modelToolTip(self):
         """Tool tip for the opened files model
         """
@@ -0,0 +1,456 @@
+"""
+projectfiles --- In-memory lists of files of the project directories
+====================================================================
+
+Search in directory, Locator and other functionality need list of files in a directory tree.
+Walking a big tree takes a lot of time, therefore, when a tree has been walked once,
+the list of files is kept in memory and updated with QFileSystemWatcher when files are
+created, removed or renamed.
+
+The lists are filter-aware. Hidden files and directories, and files and directories, ignored by
+:mod:`enki.core.filefilter` (i.e. ``__pycache__``), are not included.
+The lists are dropped, when the filter changes.
+
+Lists are created by the code, which walks the tree (i.e. search thread) with
+:func:`enki.core.projectfiles.walkDirectory` and passed to
+:meth:`enki.core.projectfiles.ProjectFiles.addListing`.
+
+Inside a git work tree the list is read from the git index with :func:`enki.core.projectfiles.gitListing`,
+which is much faster than walking. Such lists don't contain files, ignored by ``.gitignore``,
+and are updated with git too.
+
+Methods, which read the lists, are thread safe and return ``None``, if the path is not covered
+by any of the lists. In this case caller shall use the file system.
+
+Instance is accessible as ``core.projectFiles()``
+"""
+
+import fnmatch
+import os
+import os.path
+import threading
+
+from PyQt4.QtCore import pyqtSignal, QFileSystemWatcher, QObject
+
+from enki.core.core import core
+from enki.lib.get_console_output import get_console_output
+import enki.lib.treewalker
+
+
+def _isHidden(name):
+    """Check if file or directory name is hidden
+    """
+    return name.startswith('.')
+
+
+def _isSkipped(name, filterRegExp):
+    """Check if file or directory name is hidden or matches filterRegExp
+    """
+    return _isHidden(name) or filterRegExp.match(name) is not None
+
+
+def iterDirectory(path, filterRegExp):
+    """Walk the directory tree. Generator yields tuples
+    (directory path, list of subdirectory names, list of file names).
+    Hidden directories and files and directories and files matching filterRegExp are skipped.
+    Skipped directories are not walked.
+
+    Raises UnicodeDecodeError, if failed to decode a file name
+    """
+    skip = lambda name: _isSkipped(name, filterRegExp)
+    return enki.lib.treewalker.walk(path, skipDirectory=skip, skipFile=skip)
+
+
+def walkDirectory(path, filterRegExp, mustStop=None):
+    """Walk the directory tree.
+
+    Returns dictionary {directory path: (set of subdirectory names, set of file names)}.
+    Hidden directories and files and directories and files matching filterRegExp are skipped.
+
+    mustStop is callable, which is checked for every directory. Walking is interrupted,
+    and None is returned, if it returns True.
+
+    Raises UnicodeDecodeError, if failed to decode a file name
+    """
+    listing = {}
+    for directory, dirs, files in iterDirectory(path, filterRegExp):
+        listing[directory] = (set(dirs), set(files))
+
+        if mustStop is not None and mustStop():
+            return None
+
+    return listing
+
+
+def _gitFiles(path, options):
+    """Run ``git ls-files`` in the directory. Returns list of paths relative to the directory or None
+    """
+    try:
+        stdout, stderr = get_console_output(['git', 'ls-files', '-z'] + options, cwd=path)
+    except OSError:  # git is not installed or the directory is not accessible
+        return None
+
+    if not stdout and stderr:  # not a git work tree
+        return None
+
+    return stdout.decode('utf8').split('\0')
+
+
+def _gitDirectory(listing, directories, relDir, filterRegExp):
+    """Get absolute path of the directory, which contains files, listed by git.
+    Adds the directory and its parents to the listing. Returns None for hidden and filtered out directories
+    """
+    if relDir in directories:
+        return directories[relDir]
+
+    parentRelDir, separator, name = relDir.rpartition('/')
+    parent = _gitDirectory(listing, directories, parentRelDir, filterRegExp)
+    if parent is None or _isSkipped(name, filterRegExp):
+        directory = None
+    else:
+        directory = os.path.join(parent, name)
+        listing[parent][0].add(name)
+        listing[directory] = (set(), set())
+
+    directories[relDir] = directory
+    return directory
+
+
+def gitListing(path, filterRegExp):
+    """List the directory tree with ``git ls-files``. Files of the submodules are listed too.
+
+    Returns dictionary {directory path: (set of subdirectory names, set of file names)}, like walkDirectory().
+    Hidden directories and files, directories and files matching filterRegExp and files, ignored by git,
+    are skipped. Only existing regular files are listed, git also lists deleted files, nested repositories
+    and symlinks to directories.
+    Directories without not ignored files are not listed.
+
+    Returns None, if the path is not inside a git work tree, or git is not available or too old to list
+    the submodules, or git lists no files in the directory, i.e. the directory is ignored
+    """
+    try:
+        # --recurse-submodules can't be combined with -o
+        cached = _gitFiles(path, ['-c', '--recurse-submodules'])
+        untracked = _gitFiles(path, ['-o', '--exclude-standard'])
+    except UnicodeDecodeError:
+        return None
+
+    if cached is None or untracked is None:
+        return None
+    relPaths = cached + untracked
+
+    listing = {path: (set(), set())}
+    directories = {'': path}  # relative path: absolute path or None, if hidden
+    for relPath in relPaths:
+        if not relPath or relPath.endswith('/'):  # untracked nested repository
+            continue
+
+        relDir, separator, name = relPath.rpartition('/')
+        if _isSkipped(name, filterRegExp) or \
+           not os.path.isfile(os.path.join(path, relPath)):
+            continue
+
+        directory = _gitDirectory(listing, directories, relDir, filterRegExp)
+        if directory is not None:
+            listing[directory][1].add(name)
+
+    if len(listing) == 1 and not listing[path][1]:
+        return None
+    return listing
+
+
+def _isUnder(path, root):
+    """Check if path is root or is inside root
+    """
+    return path == root or path.startswith(root + os.path.sep)
+
+
+class ProjectFiles(QObject):
+    """Lists of files of the directory trees. See module docs.
+    """
+
+    MAX_ROOTS_COUNT = 8
+
+    filesChanged = pyqtSignal(unicode)
+    """
+    filesChanged(rootPath)
+
+    **Signal** emitted, when list of files for the root has been added, updated or dropped
+    """  # pylint: disable=W0105
+
+    _listingAvailable = pyqtSignal(unicode, object, bool)  # internal. Moves listings to the GUI thread
+
+    def __init__(self):
+        QObject.__init__(self)
+        self._lock = threading.Lock()
+        self._roots = []  # list of root paths, last used is the last
+        self._listings = {}  # directory path -> (set of subdirectory names, set of file names)
+        self._sortedFiles = {}  # root path -> sorted list of file paths. Built on request
+        self._gitRoots = set()  # roots, listed with gitListing()
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._onDirectoryChanged)
+        self._listingAvailable.connect(self._onListingAvailable)
+        core.fileFilter().regExpChanged.connect(self.clear)
+
+    def del_(self):
+        """Explicitly called destructor
+        """
+        core.fileFilter().regExpChanged.disconnect(self.clear)
+        self.clear()
+
+    def clear(self):
+        """Drop all lists
+        """
+        with self._lock:
+            roots = self._roots
+            self._roots = []
+            self._listings = {}
+            self._sortedFiles = {}
+            self._gitRoots = set()
+
+        directories = self._watcher.directories()
+        if directories:
+            self._watcher.removePaths(directories)
+
+        for root in roots:
+            self.filesChanged.emit(root)
+
+    def addListing(self, rootPath, listing, fromGit=False):
+        """Add a listing, created with walkDirectory() or, if fromGit is True, with gitListing().
+        May be called from any thread. The listing is used after the GUI thread processed it
+        """
+        self._listingAvailable.emit(os.path.abspath(rootPath), listing, fromGit)
+
+    def _onListingAvailable(self, rootPath, listing, fromGit):
+        """Listing from addListing() has been received by the GUI thread.
+        Start watching its directories
+        """
+        with self._lock:
+            if self._findRoot(rootPath) is not None:  # already watched
+                return
+
+            # Remove roots, which are inside the new one
+            for root in [root for root in self._roots if _isUnder(root, rootPath)]:
+                self._dropRoot(root)
+
+            if len(self._roots) >= self.MAX_ROOTS_COUNT:
+                self._dropRoot(self._roots[0])
+
+            self._roots.append(rootPath)
+            self._listings.update(listing)
+            if fromGit:
+                self._gitRoots.add(rootPath)
+
+        directories = listing.keys()
+        self._watcher.addPaths(directories)
+
+        # Don't trust not watched lists. i.e. inotify limit might have been reached
+        watched = set(self._watcher.directories())
+        if not all([directory in watched for directory in directories]):
+            with self._lock:
+                self._dropRoot(rootPath)
+
+        self.filesChanged.emit(rootPath)
+
+    def _findRoot(self, path):
+        """Find root, which contains the path, or None. Must be called with the lock held
+        """
+        for root in self._roots:
+            if _isUnder(path, root):
+                return root
+        return None
+
+    def _dropRoot(self, rootPath):
+        """Forget the root and stop watching it. Must be called with the lock held
+        """
+        self._roots.remove(rootPath)
+        self._sortedFiles.pop(rootPath, None)
+        self._gitRoots.discard(rootPath)
+        self._removeDirectories([directory for directory in self._listings \
+                                    if _isUnder(directory, rootPath)])
+
+    def _removeDirectories(self, directories):
+        """Forget and stop watching directories. Must be called with the lock held
+        """
+        for directory in directories:
+            del self._listings[directory]
+        if directories:
+            self._watcher.removePaths(directories)
+
+    def _onDirectoryChanged(self, path):
+        """QFileSystemWatcher notification. File or directory has been created, removed or renamed.
+        Update listing for the directory
+        """
+        with self._lock:
+            root = self._findRoot(path)
+            if root is None or not path in self._listings:
+                return
+
+            oldDirs = self._listings[path][0]
+            subtree = [directory for directory in self._listings \
+                            if _isUnder(directory, path)]
+
+        if not os.path.isdir(path):  # removed
+            with self._lock:
+                if path == root:
+                    self._dropRoot(root)
+                else:
+                    self._removeDirectories(subtree)
+                    self._sortedFiles.pop(root, None)
+            self.filesChanged.emit(root)
+            return
+
+        if root in self._gitRoots:
+            self._updateFromGit(root, path, subtree)
+            return
+
+        try:
+            names = os.listdir(path)
+        except (OSError, UnicodeDecodeError):
+            with self._lock:
+                self._dropRoot(root)
+            self.filesChanged.emit(root)
+            return
+
+        filterRegExp = core.fileFilter().regExp()
+        dirs = set()
+        files = set()
+        for name in names:
+            if _isSkipped(name, filterRegExp):
+                continue
+            fullPath = os.path.join(path, name)
+            if os.path.isdir(fullPath):
+                dirs.add(name)
+            elif os.path.isfile(fullPath):
+                files.add(name)
+
+        newListing = {}
+        for name in dirs - oldDirs:
+            try:
+                newListing.update(walkDirectory(os.path.join(path, name), filterRegExp))
+            except UnicodeDecodeError:
+                pass
+
+        with self._lock:
+            removedDirs = [os.path.join(path, name) for name in oldDirs - dirs]
+            self._removeDirectories([directory for directory in subtree \
+                                        if any([_isUnder(directory, removed) for removed in removedDirs])])
+            self._listings[path] = (dirs, files)
+            self._listings.update(newListing)
+            self._sortedFiles.pop(root, None)
+
+        if newListing:
+            self._watcher.addPaths(newListing.keys())
+
+        self.filesChanged.emit(root)
+
+    def _updateFromGit(self, root, path, subtree):
+        """Update listing of the changed directory and its subtree with git.
+        Files, created in the directory, but ignored by git, are not added
+        """
+        newListing = gitListing(path, core.fileFilter().regExp())
+
+        with self._lock:
+            if newListing is None:
+                self._dropRoot(root)
+            else:
+                self._removeDirectories(subtree)
+                self._listings.update(newListing)
+                self._sortedFiles.pop(root, None)
+
+        if newListing is not None:
+            self._watcher.addPaths(newListing.keys())
+
+        self.filesChanged.emit(root)
+
+    def files(self, path):
+        """Get list of files in the directory tree.
+        Files are sorted in the order of :func:`enki.lib.treewalker.walk`.
+        Returns None, if the tree is not listed
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            root = self._findRoot(path)
+            if root is None:
+                return None
+
+            # the root has been used, move it to the end of the list
+            self._roots.remove(root)
+            self._roots.append(root)
+
+            if not root in self._sortedFiles:
+                files = [os.path.join(directory, fileName) \
+                            for directory, (dirs, files) in self._listings.iteritems() \
+                                if _isUnder(directory, root) \
+                                    for fileName in files]
+                files.sort(key=enki.lib.treewalker.walkOrderKey)
+                self._sortedFiles[root] = files
+            sortedFiles = self._sortedFiles[root]
+
+        if path == root:
+            return sortedFiles
+        else:
+            prefix = path + os.path.sep
+            return [filePath for filePath in sortedFiles if filePath.startswith(prefix)]
+
+    def directoryContents(self, path):
+        """Get tuple (sorted list of subdirectory names, sorted list of file names) for the directory.
+        Returns None, if the directory is not listed
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        with self._lock:
+            if not path in self._listings:
+                return None
+            dirs, files = self._listings[path]
+            return sorted(dirs), sorted(files)
+
+    def isFile(self, path):
+        """Check if path is an existing file.
+        Returns None, if not known. i.e. directory is not listed or the file is hidden or filtered out,
+        or the directory is listed with git, which doesn't list ignored files
+        """
+        path = os.path.abspath(path)
+        directory, fileName = os.path.split(path)
+        if _isHidden(fileName) or core.fileFilter().regExp().match(fileName):
+            return None
+
+        with self._lock:
+            if not directory in self._listings or \
+               self._findRoot(directory) in self._gitRoots:
+                return None
+            return fileName in self._listings[directory][1]
+
+    def glob(self, pattern):
+        """Get tuple (sorted list of directories, sorted list of files), which match the glob pattern.
+        Returns None, if the pattern is not covered by the lists
+        """
+        pattern = os.path.abspath(pattern)
+        parts = pattern.split(os.path.sep)
+        literalParts = []
+        for part in parts:
+            if '*' in part or '?' in part or '[' in part:
+                break
+            literalParts.append(part)
+        baseDirectory = os.path.sep.join(literalParts) or os.path.sep
+
+        def matches(path):
+            """fnmatch() '*' matches path separator, glob doesn't. Check depth separately
+            """
+            return len(path.split(os.path.sep)) == len(parts) and \
+                   fnmatch.fnmatch(path, pattern)
+
+        with self._lock:
+            if self._findRoot(baseDirectory) is None:
+                return None
+
+            matchingDirs = []
+            matchingFiles = []
+            for directory, (dirs, files) in self._listings.iteritems():
+                if not _isUnder(directory, baseDirectory):
+                    continue
+                matchingDirs.extend([os.path.join(directory, name) for name in dirs \
+                                        if matches(os.path.join(directory, name))])
+                matchingFiles.extend([os.path.join(directory, name) for name in files \
+                                        if matches(os.path.join(directory, name))])
+
+        return sorted(matchingDirs), sorted(matchingFiles)
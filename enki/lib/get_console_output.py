@@ -5,6 +5,7 @@ Popen wrapper, which does some platform specific hacks
 
 import subprocess
 import os, os.path
+import signal
 import sys
 
 # Determine if we're frozen with Pyinstaller or not.
@@ -14,7 +15,10 @@ else:
     isFrozen = False
 
 
-def open_console_output(command, cwd):
+def open_console_output(command, cwd, new_process_group=False):
+    """Start the command. If new_process_group is True, the command is started
+    in a new process group, which can be killed with kill_process_group()
+    """
     if hasattr(subprocess, 'STARTUPINFO'):  # windows only
         # On Windows, subprocess will pop up a command window by default when run from
         # Pyinstaller with the --noconsole option. Avoid this distraction.
@@ -35,15 +39,36 @@ def open_console_output(command, cwd):
     # with the --noconsole option requires redirecting everything
     # (stdin, stdout, stderr) to avoid a OSError exception
     # "[Error 6] the handle is invalid."
+    kwargs = {}
+    if new_process_group:
+        if hasattr(subprocess, 'CREATE_NEW_PROCESS_GROUP'):  # windows only
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['preexec_fn'] = os.setsid
+
     popen = subprocess.Popen(
             command,
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            startupinfo=si, env=env, cwd=cwd)
+            startupinfo=si, env=env, cwd=cwd, **kwargs)
 
     return popen
 
+def kill_process_group(popen):
+    """Kill the process, started with new_process_group=True, and its children
+    """
+    try:
+        if hasattr(subprocess, 'STARTUPINFO'):  # windows only
+            si = subprocess.STARTUPINFO()
+            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(popen.pid)], startupinfo=si)
+        else:
+            os.killpg(popen.pid, signal.SIGTERM)
+    except OSError:  # already finished
+        pass
+    popen.wait()
+
 def get_console_output(command, cwd=None):
     popen = open_console_output(command, cwd)
     return popen.communicate()
@@ -0,0 +1,82 @@
+"""
+lrucache --- Size bounded LRU cache
+===================================
+
+:class:`LruCache` keeps values, while their estimated total size doesn't exceed the limit.
+The least recently used values are evicted first.
+Used by the search result cache and the preview render cache.
+
+The module doesn't depend on Qt
+"""
+
+import collections
+import threading
+
+
+class LruCache:
+    """LRU cache, bounded by the estimated size of the values. Thread safe.
+
+    estimateSize is callable, which gets a value and returns its estimated size in bytes
+    """
+    def __init__(self, maxSize, estimateSize):
+        self._maxSize = maxSize
+        self._estimateSize = estimateSize
+        self._size = 0
+        # key: (value, size). The most recently used are at the end
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def setMaxSize(self, maxSize):
+        """Set the size limit in bytes. Evicts entries, if necessary
+        """
+        with self._lock:
+            self._maxSize = maxSize
+            self._evict()
+
+    def size(self):
+        """Estimated size of the cached values
+        """
+        return self._size
+
+    def get(self, key, isValid=None):
+        """Get cached value or None, if not cached.
+
+        isValid is optional callable, which gets the cached value. The value is removed, if it returns False
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            elif isValid is not None and not isValid(entry[0]):
+                self._size -= entry[1]
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        """Cache value. Values, which are bigger than the limit, are not cached
+        """
+        size = self._estimateSize(value)
+        with self._lock:
+            oldEntry = self._entries.pop(key, None)
+            if oldEntry is not None:
+                self._size -= oldEntry[1]
+
+            if size <= self._maxSize:
+                self._entries[key] = (value, size)
+                self._size += size
+                self._evict()
+
+    def clear(self):
+        """Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        """Remove the least recently used entries, while the size exceeds the limit
+        """
+        while self._size > self._maxSize and self._entries:
+            key, (value, size) = self._entries.popitem(last=False)
+            self._size -= size
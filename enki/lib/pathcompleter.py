@@ -185,6 +185,21 @@ class PathCompleter(AbstractPathCompleter):
         if self._path != '/':
             self._path += '/'
 
+        contents = core.projectFiles().directoryContents(self._path)
+        if contents is not None:  # directory is listed, don't touch the file system
+            dirNames, fileNames = contents
+            self._dirs = [os.path.join(self._path, name) \
+                            for name in dirNames if name.startswith(enterredFile)]
+            self._files = [os.path.join(self._path, name) \
+                            for name in fileNames if name.startswith(enterredFile)]
+
+        # Not listed directory, or hidden and ignored files are requested
+        if not self._dirs and not self._files:
+            self._listDirectory(enterredFile)
+
+    def _listDirectory(self, enterredFile):
+        """Fill list of directories and files, which start with enterredFile, from the file system
+        """
         if not os.path.isdir(self._path):
             self._status = 'No directory %s' % self._path
             return
@@ -280,15 +295,26 @@ class GlobCompleter(AbstractPathCompleter):
     """
     def __init__(self, text):
         AbstractPathCompleter.__init__(self, text)
-        variants = glob.iglob(os.path.expanduser(text) + '*')
-        variants = self._filterHidden(variants)
-        variants.sort()
+        pattern = os.path.expanduser(text) + '*'
 
-        for path in sorted(variants):
-            if os.path.isdir(path):
-                self._dirs.append(path)
-            else:
-                self._files.append(path)
+        # Glob in the lists of project files, if possible
+        if os.path.isabs(pattern):
+            globbed = core.projectFiles().glob(pattern)
+        else:
+            globbed = None
+
+        if globbed is not None:
+            self._dirs, self._files = globbed
+        else:
+            variants = glob.iglob(pattern)
+            variants = self._filterHidden(variants)
+            variants.sort()
+
+            for path in sorted(variants):
+                if os.path.isdir(path):
+                    self._dirs.append(path)
+                else:
+                    self._files.append(path)
 
         if not self._dirs and not self._files:
             self._status = 'No matching files'
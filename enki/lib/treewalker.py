@@ -0,0 +1,127 @@
+"""
+treewalker --- Fast directory tree walker
+=========================================
+
+Replacement for ``os.walk()``, optimized for building lists of files for search:
+
+* Directories are pruned before descending into them, i.e. ``.git`` is never listed
+* Directory entries types are taken from ``scandir()`` (``d_type`` on Unix), files are not stat'ed.
+  ``os.scandir()`` is used on Python 3, the `scandir <https://pypi.python.org/pypi/scandir>`_
+  module on Python 2, if installed. Otherwise every entry is stat'ed once
+* Symlink loops are detected, when symlinks are followed. Every directory is walked only once
+* Walker is a generator. Caller may process results before the walking is finished
+
+Order of results is deterministic. Entries of a directory are sorted by name,
+files of a directory go before its subdirectories. :func:`walkOrderKey` sorts lists of paths in this order.
+"""
+
+import os
+import os.path
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def walkOrderKey(path):
+    """Sort key, which sorts list of file paths in the same order, as :func:`walk` returns them
+    """
+    directory, name = os.path.split(path)
+    return directory.split(os.path.sep), name
+
+
+def _listWithScandir(path, followLinks):
+    """List directory with scandir(). Returns tuple (list of directory names, list of file names)
+    """
+    dirs = []
+    files = []
+    for entry in scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=followLinks):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+        except OSError:  # i.e. broken symlink
+            pass
+    return dirs, files
+
+
+def _listWithStat(path, followLinks):
+    """List directory with os.listdir() and os.stat(). Returns tuple (list of directory names, list of file names)
+    """
+    statFunc = os.stat if followLinks else os.lstat
+    dirs = []
+    files = []
+    for name in os.listdir(path):
+        try:
+            mode = statFunc(os.path.join(path, name)).st_mode
+        except OSError:  # i.e. broken symlink
+            continue
+        if stat.S_ISDIR(mode):
+            dirs.append(name)
+        elif stat.S_ISREG(mode):
+            files.append(name)
+        elif not followLinks and stat.S_ISLNK(mode) and os.path.isfile(os.path.join(path, name)):
+            files.append(name)
+    return dirs, files
+
+
+def walk(path, skipDirectory=None, skipFile=None, followLinks=True):
+    """Walk the directory tree.
+
+    Generator yields tuples (directory path, list of subdirectory names, list of file names) top-down.
+
+    skipDirectory and skipFile are callables, which get a name and return True, if the directory
+    or file shall be skipped. Skipped directories are not walked.
+
+    Directories, which can't be listed, are silently skipped.
+    Raises UnicodeDecodeError, if failed to decode a file name
+    """
+    listFunc = _listWithScandir if scandir is not None else _listWithStat
+
+    visited = set()  # (device, inode) of walked directories. Used for symlink loops detection
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+
+        if followLinks:
+            try:
+                dirStat = os.stat(directory)
+            except OSError:
+                continue
+            key = (dirStat.st_dev, dirStat.st_ino)
+            if dirStat.st_ino:  # 0 on Windows with Python 2, loops are not detected
+                if key in visited:
+                    continue
+                visited.add(key)
+
+        try:
+            dirs, files = listFunc(directory, followLinks)
+        except OSError:
+            continue
+
+        if skipDirectory is not None:
+            dirs = [name for name in dirs if not skipDirectory(name)]
+        if skipFile is not None:
+            files = [name for name in files if not skipFile(name)]
+        dirs.sort()
+        files.sort()
+
+        yield directory, dirs, files
+
+        stack.extend([os.path.join(directory, name) for name in reversed(dirs)])
+
+
+def iterFiles(path, skipDirectory=None, skipFile=None, followLinks=True):
+    """Walk the directory tree. Generator yields full paths of files.
+
+    See :func:`walk` for parameters
+    """
+    for directory, dirs, files in walk(path, skipDirectory, skipFile, followLinks):
+        for name in files:
+            yield os.path.join(directory, name)
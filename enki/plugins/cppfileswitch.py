@@ -61,6 +61,15 @@ class Plugin(QObject):
         return any([filePath.endswith(suffix)
                             for suffix in _IMPLEMENTATION_SUFFIXES])
 
+    def _isFile(self, path):
+        """Check if file exists. Use list of project files, if the directory is listed
+        """
+        isFile = core.projectFiles().isFile(path)
+        if isFile is None:
+            return os.path.isfile(path)
+        else:
+            return isFile
+
     def _tryFindFileOnFileSystem(self):
         """Try to find file on File system with the same path, but different suffix
         """
@@ -78,7 +87,7 @@ class Plugin(QObject):
 
         existing = [path
                         for path in variants \
-                            if os.path.isfile(path)]
+                            if self._isFile(path)]
         if existing:
             return existing[0]
         else:
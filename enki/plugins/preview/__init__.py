@@ -225,6 +225,9 @@ class Plugin(QObject):
             core.config()['Sphinx']['Cmdline'] = u'sphinx-build -d ' + os.path.join('_build','doctrees')  \
                                                  + ' . ' + os.path.join('_build','html')
             core.config().flush()
+        if not 'BuildDaemon' in core.config()['Sphinx']:
+            core.config()['Sphinx']['BuildDaemon'] = False
+            core.config().flush()
 
     def del_(self):
         """Uninstall the plugin
@@ -336,6 +339,9 @@ class Plugin(QObject):
         dialog.appendOption(ChoiseOption(dialog, core.config(), "Sphinx/BuildOnSave",
                                          {widget.rbBuildOnlyOnSave: True,
                                           widget.rbBuildOnFileChange: False}))
+        dialog.appendOption(CheckableOption(dialog, core.config(),
+                                            "Sphinx/BuildDaemon",
+                                            widget.cbSphinxBuildDaemon))
         dialog.appendOption(TextOption(dialog, core.config(),
                                        "Sphinx/ProjectPath",
                                        widget.leSphinxProjectPath))
@@ -0,0 +1,303 @@
+# .. -*- coding: utf-8 -*-
+#
+# ***************************************************************
+# converter.py - Markdown, ReST and CodeChat conversion to HTML
+# ***************************************************************
+#
+# Conversion of a big document holds the GIL for a long time and stalls the
+# GUI thread, and a hung converter would block the preview forever.
+# Therefore, the documents are converted by a pool of long-lived worker
+# processes, see ``ConverterPool``. The workers import the converters once,
+# when started. A job, which takes too long, is aborted by killing its worker;
+# a new one is started instead, and ``ConversionFailed`` is raised, so the
+# error message isn't taken for a converted document.
+#
+# The conversion functions are also used directly by the converter thread,
+# if the worker processes are disabled.
+#
+# This module doesn't depend on Qt, therefore it is imported by the workers.
+#
+# Imports
+# =======
+# Library imports
+# ---------------
+import cgi
+import multiprocessing
+import os.path
+import StringIO
+import sys
+import time
+import traceback
+
+# Determine if we're frozen with Pyinstaller or not.
+if getattr(sys, 'frozen', False):
+    isFrozen = True
+else:
+    isFrozen = False
+
+# Conversion
+# ==========
+def convert(converter, text, settings):
+    """Convert the text to HTML. converter is 'Markdown', 'Restructured Text'
+    or 'CodeChat'. settings is a dictionary of the converter options.
+
+    Returns tuple (html, errString).
+    """
+    if converter == 'Markdown':
+        return convertMarkdown(text), None
+    elif converter == 'Restructured Text':
+        return convertReST(text)
+    elif converter == 'CodeChat':
+        return convertCodeChat(text, settings['fileExtension'])
+    else:
+        return 'No preview for this type of file', None
+
+def convertMarkdown(text):
+    """Convert Markdown to HTML
+    """
+    try:
+        import markdown
+    except ImportError:
+        return 'Markdown preview requires <i>python-markdown</i> package<br/>' \
+               'Install it with your package manager or see ' \
+               '<a href="http://packages.python.org/Markdown/install.html">installation instructions</a>'
+
+    try:
+        import mdx_mathjax
+    except ImportError:
+        pass  #mathjax doesn't require import statement if installed as extension
+
+    extensions = ['fenced_code', 'nl2br']
+
+    # version 2.0 supports only extension names, not instances
+    if markdown.version_info[0] > 2 or \
+       (markdown.version_info[0] == 2 and markdown.version_info[1] > 0):
+
+        class _StrikeThroughExtension(markdown.Extension):
+            """http://achinghead.com/python-markdown-adding-insert-delete.html
+            Class is placed here, because depends on imported markdown, and markdown import is lazy
+            """
+            DEL_RE = r'(~~)(.*?)~~'
+            def extendMarkdown(self, md, md_globals):
+                # Create the del pattern
+                delTag = markdown.inlinepatterns.SimpleTagPattern(self.DEL_RE, 'del')
+                # Insert del pattern into markdown parser
+                md.inlinePatterns.add('del', delTag, '>not_strong')
+
+        extensions.append(_StrikeThroughExtension())
+
+    try:
+        return markdown.markdown(text, extensions + ['mathjax'])
+    except (ImportError, ValueError):  # markdown raises ValueError or ImportError, depends on version
+                                       # it is not clear, how to distinguish missing mathjax from other errors
+        return markdown.markdown(text, extensions) #keep going without mathjax
+
+def convertReST(text):
+    """Convert ReST
+    """
+    try:
+        import docutils.core
+        import docutils.writers.html4css1
+    except ImportError:
+        return 'Restructured Text preview requires the <i>python-docutils</i> package.<br/>' \
+               'Install it with your package manager or see ' \
+               '<a href="http://pypi.python.org/pypi/docutils"/>this page.</a>', None
+
+    errStream = StringIO.StringIO()
+    settingsDict = {
+      # Make sure to use Unicode everywhere.
+      'output_encoding': 'unicode',
+      'input_encoding' : 'unicode',
+      # Don't stop processing, no matter what.
+      'halt_level'     : 5,
+      # Capture errors to a string and return it.
+      'warning_stream' : errStream }
+    # Frozen-specific settings.
+    if isFrozen:
+        settingsDict['template'] = (
+          # The default docutils stylesheet and template uses a relative path,
+          # which doesn't work when frozen ???. Under Unix when not frozen,
+          # it produces:
+          # ``IOError: [Errno 2] No such file or directory:
+          # '/usr/lib/python2.7/dist-packages/docutils/writers/html4css1/template.txt'``.
+          os.path.join(os.path.dirname(docutils.writers.html4css1.__file__),
+                       docutils.writers.html4css1.Writer.default_template) )
+        settingsDict['stylesheet_dirs'] = ['.',
+          os.path.dirname(docutils.writers.html4css1.__file__)]
+    htmlString = docutils.core.publish_string(text, writer_name='html',
+                                              settings_overrides=settingsDict)
+    errString = errStream.getvalue()
+    if errString:
+        errString = "<font color='red'>" + cgi.escape(errString) + '</font>'
+    errStream.close()
+    return htmlString, errString
+
+def convertCodeChat(text, fileExtension):
+    """Convert source code with CodeChat
+    """
+    import CodeChat.CodeToRest as CodeToRest
+    import CodeChat.LanguageSpecificOptions as LSO
+
+    # Use StringIO to pass CodeChat compilation information back to
+    # the UI.
+    errStream = StringIO.StringIO()
+    lso = LSO.LanguageSpecificOptions()
+    # Check to seee if CodeToRest supportgs this file's extension.
+    if fileExtension not in lso.extension_to_options.keys():
+        return 'No preview for this type of file', None
+    # CodeToRest can render this file. Do so.
+    lso.set_language(fileExtension)
+    htmlString = CodeToRest.code_to_html_string(text, lso, errStream)
+    # Error string might contain characters such as ">" and "<",
+    # they need to be converted to "&gt;" and "&lt;" such that
+    # they can be displayed correctly in the log window as html strings.
+    # This step is handled by ``cgi.escape``.
+    errString = errStream.getvalue()
+    if errString:
+        errString = "<font color='red'>" + cgi.escape(errString) + '</font>'
+    errStream.close()
+    return htmlString, errString
+
+# Worker processes
+# ================
+class ConversionFailed(Exception):
+    """A job has failed, timed out or its worker process has died. The message is
+    an HTML error string, which can be shown instead of the preview.
+    """
+    pass
+
+def _preImport():
+    """Import the converters, so the first job doesn't wait for it.
+    """
+    for moduleName in ('markdown', 'docutils.core', 'docutils.writers.html4css1',
+                       'CodeChat.CodeToRest', 'CodeChat.LanguageSpecificOptions'):
+        try:
+            __import__(moduleName)
+        except Exception:  # not installed or broken converter is reported, when used
+            pass
+
+def _workerMain(connection):
+    """Main function of a worker process. Receives jobs (converter, text, settings)
+    and sends back (True, (html, errString)) or, if the converter has raised
+    an exception, (False, errString) until the connection is closed.
+    """
+    _preImport()
+    while True:
+        try:
+            job = connection.recv()
+        except (EOFError, IOError):
+            break
+        if job is None:
+            break
+
+        try:
+            result = (True, convert(*job))
+        except Exception:
+            result = (False, "<font color='red'><pre>" + cgi.escape(traceback.format_exc()) + '</pre></font>')
+        connection.send(result)
+
+
+class ConverterProcess:
+    """A worker process. Jobs are sent and results are received over a pipe.
+    """
+    def __init__(self):
+        self._connection, childConnection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_workerMain, args=(childConnection,))
+        self._process.daemon = True
+        self._process.start()
+        childConnection.close()
+
+    def send(self, job):
+        """Send a job (converter, text, settings)
+        """
+        self._connection.send(job)
+
+    def poll(self, timeout):
+        """Wait for the result up to timeout seconds. Returns True, if the result
+        is ready or the process has died.
+        """
+        return self._connection.poll(timeout) or not self._process.is_alive()
+
+    def receive(self):
+        """Receive the result. Raises EOFError, if the process has died.
+        """
+        return self._connection.recv()
+
+    def kill(self):
+        """Terminate the process immediately.
+        """
+        self._process.terminate()
+        self._process.join()
+        self._connection.close()
+
+    def stop(self):
+        """Ask the process to exit and wait for it.
+        """
+        try:
+            self._connection.send(None)
+        except (IOError, ValueError):  # the process has died
+            pass
+        self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._connection.close()
+
+
+class ConverterPool:
+    """Pool of warm worker processes. Not thread safe, used by the converter thread only.
+
+    A job is sent to an idle worker. If it doesn't finish within the timeout, or
+    the worker dies, the worker is replaced with a new one and ConversionFailed is raised.
+    """
+    POLL_INTERVAL = 0.1  # seconds
+
+    def __init__(self, size):
+        self._size = size
+        self._idleWorkers = [ConverterProcess() for i in range(size)]
+
+    def size(self):
+        """Count of worker processes.
+        """
+        return self._size
+
+    def convert(self, converter, text, settings, timeout):
+        """Convert the text in a worker process. See ``convert``.
+        timeout is the job time limit in seconds. Raises ConversionFailed, if the
+        converter has raised an exception, the job has timed out or the worker has died.
+        """
+        if self._idleWorkers:
+            worker = self._idleWorkers.pop(0)
+        else:
+            worker = ConverterProcess()
+
+        startTime = time.time()
+        try:
+            worker.send((converter, text, settings))
+            while not worker.poll(self.POLL_INTERVAL):
+                if time.time() - startTime > timeout:
+                    self._respawn(worker)
+                    raise ConversionFailed("<font color='red'>Conversion has been aborted, "
+                                           "because it took more than {} s</font>".format(timeout))
+            converted, result = worker.receive()
+        except (EOFError, IOError):
+            self._respawn(worker)
+            raise ConversionFailed("<font color='red'>Converter process has died</font>")
+
+        self._idleWorkers.append(worker)
+        if not converted:
+            raise ConversionFailed(result)
+        return result
+
+    def _respawn(self, worker):
+        """Kill the worker and start a new one instead.
+        """
+        worker.kill()
+        self._idleWorkers.append(ConverterProcess())
+
+    def close(self):
+        """Stop all workers.
+        """
+        for worker in self._idleWorkers:
+            worker.stop()
+        self._idleWorkers = []
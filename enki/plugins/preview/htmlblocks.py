@@ -0,0 +1,204 @@
+# .. -*- coding: utf-8 -*-
+#
+# ***************************************************************
+# htmlblocks.py - Split rendered HTML into independent top blocks
+# ***************************************************************
+#
+# Reloading the whole preview on every pause in typing re-runs JavaScript
+# (MathJax), loses the layout and the scroll position. Instead, the preview
+# dock compares the new HTML with the previous one block by block and replaces
+# only the changed top-level elements of the page. This module does the
+# comparison; the dock patches the page.
+#
+# A page is split into the head and the blocks. The blocks are the child
+# elements of the container: the ``<body>`` of a full document or the
+# fragment itself (Markdown output). If the container holds a single wrapper
+# element and nothing else, as docutils' ``<div class="document">``, the
+# wrapper becomes the container. Everything before the first block and after
+# the last one is the head. If the heads of two pages differ, the page must be
+# reloaded.
+#
+# The blocks are marked with the ``data-enki-block`` attribute, so the dock
+# can find them in the DOM, where scripts could have inserted other elements.
+#
+# This module doesn't depend on Qt.
+#
+# Imports
+# =======
+# Library imports
+# ---------------
+import collections
+import HTMLParser
+
+# The attribute which marks the blocks of the page in the DOM.
+BLOCK_ATTRIBUTE = 'data-enki-block'
+
+# Elements, which a browser moves to the ``<head>``, if they start a fragment.
+_HEAD_TAGS = frozenset(['base', 'link', 'meta', 'script', 'style', 'title'])
+
+# Elements without an end tag.
+_VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                        'input', 'keygen', 'link', 'meta', 'param', 'source',
+                        'track', 'wbr'])
+
+# A split page. head is a (prefix, suffix) tuple of the HTML around the blocks.
+# blocks is a list of (tag, markup) tuples; the markup of a block includes the
+# whitespace, which follows it.
+Page = collections.namedtuple('Page', ['head', 'blocks'])
+
+
+class _Element:
+    """An element of the parsed HTML. Offsets are offsets in the HTML text.
+    """
+    def __init__(self, tag, start, contentStart):
+        self.tag = tag
+        self.start = start
+        self.contentStart = contentStart
+        self.contentEnd = None
+        self.end = None
+        self.children = []
+        self.hasText = False  # has not whitespace text, which isn't in a child element
+
+
+class _TreeBuilder(HTMLParser.HTMLParser):
+    """Build a tree of _Element. Raises ValueError, if the HTML isn't well
+    formed.
+    """
+    def __init__(self, html):
+        HTMLParser.HTMLParser.__init__(self)
+        self._html = html
+        # Offsets of the line starts, HTMLParser reports (line, column) positions.
+        self._lineStarts = [0]
+        index = html.find('\n')
+        while index != -1:
+            self._lineStarts.append(index + 1)
+            index = html.find('\n', index + 1)
+
+        self.root = _Element(None, 0, 0)
+        self._stack = [self.root]
+
+    def _offset(self):
+        line, column = self.getpos()
+        return self._lineStarts[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        start = self._offset()
+        element = _Element(tag, start, start + len(self.get_starttag_text()))
+        self._stack[-1].children.append(element)
+        if tag in _VOID_TAGS:
+            element.contentEnd = element.end = element.contentStart
+        else:
+            self._stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        start = self._offset()
+        element = _Element(tag, start, start + len(self.get_starttag_text()))
+        element.contentEnd = element.end = element.contentStart
+        self._stack[-1].children.append(element)
+
+    def handle_endtag(self, tag):
+        if tag in _VOID_TAGS:
+            return
+        element = self._stack.pop()
+        if element.tag != tag:
+            raise ValueError('Not matching end tag ' + tag)
+        element.contentEnd = self._offset()
+        element.end = self._html.index('>', element.contentEnd) + 1
+
+    def handle_data(self, data):
+        if data.strip():
+            self._stack[-1].hasText = True
+
+    def handle_entityref(self, name):
+        self._stack[-1].hasText = True
+
+    def handle_charref(self, name):
+        self._stack[-1].hasText = True
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        if len(self._stack) != 1:
+            raise ValueError('Not closed element ' + self._stack[-1].tag)
+        self.root.contentEnd = self.root.end = len(self._html)
+
+
+def _findBody(root):
+    """Find the ``<body>`` element of a full document or None.
+    """
+    for element in root.children:
+        if element.tag == 'body':
+            return element
+        elif element.tag == 'html':
+            return _findBody(element)
+    return None
+
+
+def splitHtml(html):
+    """Split HTML into a Page. Returns None, if the HTML can't be split.
+    """
+    builder = _TreeBuilder(html)
+    try:
+        builder.feed(html)
+        builder.close()
+    except (HTMLParser.HTMLParseError, ValueError):
+        return None
+
+    container = _findBody(builder.root)
+    if container is not None:
+        children = container.children
+    else:
+        container = builder.root
+        children = container.children
+        while children and children[0].tag in _HEAD_TAGS:
+            children = children[1:]
+
+    while len(children) == 1 and not container.hasText and \
+          children[0].children and not children[0].hasText:
+        container = children[0]
+        children = container.children
+
+    if container.hasText or not children:
+        return None
+
+    blocks = []
+    for index, element in enumerate(children):
+        if index + 1 < len(children):
+            end = children[index + 1].start
+        else:
+            end = element.end
+        blocks.append((element.tag, html[element.start:end]))
+
+    head = (html[:children[0].start], html[children[-1].end:])
+    return Page(head, blocks)
+
+
+def markBlock(tag, markup):
+    """Add BLOCK_ATTRIBUTE to the start tag of the block markup.
+    """
+    nameEnd = 1 + len(tag)
+    return markup[:nameEnd] + ' ' + BLOCK_ATTRIBUTE + markup[nameEnd:]
+
+
+def markedHtml(page):
+    """HTML of the page with marked blocks.
+    """
+    prefix, suffix = page.head
+    return prefix + ''.join([markBlock(tag, markup) for tag, markup in page.blocks]) + suffix
+
+
+def changedRange(oldBlocks, newBlocks):
+    """Find the changed blocks. Returns (first, oldEnd, newEnd): oldBlocks[first:oldEnd]
+    shall be replaced with newBlocks[first:newEnd].
+    """
+    first = 0
+    maxFirst = min(len(oldBlocks), len(newBlocks))
+    while first < maxFirst and oldBlocks[first] == newBlocks[first]:
+        first += 1
+
+    oldEnd = len(oldBlocks)
+    newEnd = len(newBlocks)
+    while oldEnd > first and newEnd > first and oldBlocks[oldEnd - 1] == newBlocks[newEnd - 1]:
+        oldEnd -= 1
+        newEnd -= 1
+
+    return first, oldEnd, newEnd
@@ -11,7 +11,6 @@
 import os.path
 import collections
 import Queue
-import StringIO
 import traceback
 import re
 import shutil
@@ -19,6 +18,7 @@ import cgi
 import sys
 import shlex
 import codecs
+import threading
 
 # Third-party imports
 # -------------------
@@ -33,7 +33,11 @@ from enki.core.core import core
 from enki.widgets.dockwidget import DockWidget
 from enki.plugins.preview import isHtmlFile
 from preview_sync import PreviewSync
-from enki.lib.get_console_output import get_console_output
+from rendercache import renderCache, renderKey
+import converter
+import htmlblocks
+from sphinxdaemon import SphinxDaemon
+from enki.lib.get_console_output import open_console_output, kill_process_group
 
 # Likewise, attempt importing CodeChat; failing that, disable the CodeChat feature.
 try:
@@ -48,12 +52,6 @@ else:
     import CodeChat.CodeToRest as CodeToRest
     import CodeChat.LanguageSpecificOptions as LSO
 
-# Determine if we're frozen with Pyinstaller or not.
-if getattr(sys, 'frozen', False):
-    isFrozen = True
-else:
-    isFrozen = False
-
 def commonPrefix(*dirs):
     """This function provides a platform-independent path commonPrefix. It
     returns the common path between all directories in input list dirs, assuming
@@ -139,6 +137,27 @@ def copyTemplateFile(errors, source, templateFileName, dest, newName=None):
         except (IOError, OSError) as why:
             errors.append((sourcePath, dest, str(why)))
 
+def _renderCacheSize():
+    """Size limit of the render cache in bytes.
+    """
+    return core.config()['Preview']['RenderCacheSize'] * 1024 * 1024
+
+def _readLines(stream, isError, lines):
+    """Read lines of the builder output stream and put tuples (isError, line)
+    to the lines queue. (isError, None) is put, when the stream is closed.
+    Runs in a separate thread.
+    """
+    for line in iter(stream.readline, ''):
+        lines.put((isError, line))
+    lines.put((isError, None))
+
+def _outputText(text):
+    """Convert builder output to unicode.
+    """
+    if isinstance(text, unicode):
+        return text
+    return text.decode('utf8', 'replace')
+
 class ConverterThread(QThread):
     """Thread converts markdown to HTML.
     """
@@ -157,17 +176,43 @@ class ConverterThread(QThread):
       # parameter above contains the HTML instead.
       QUrl)
 
-    _Task = collections.namedtuple("Task", ["filePath", "language", "text"])
+    # This signal is emitted while the HTML builder is running, to show its
+    # output progressively.
+    htmlBuilderOutput = pyqtSignal(
+      # Output text of the builder.
+      unicode,
+      # True, if a new build has been started and the previous output shall
+      # be cleared.
+      bool)
+
+    # Interval of checking for new tasks while the builder is running, in seconds.
+    BUILDER_POLL_INTERVAL = 0.1
+
+    _Task = collections.namedtuple("Task", ["filePath", "language", "text", "cacheKey"])
+
+    # A task, which cancels the previous ones.
+    _CANCEL = 'cancel'
 
     def __init__(self):
         QThread.__init__(self)
         self._queue = Queue.Queue()
+        # Worker processes. Created by the thread, when used first time.
+        self._pool = None
+        self._poolFailed = False
+        # Resident Sphinx application. The process is started, when used first time.
+        self._sphinxDaemon = SphinxDaemon()
         self.start(QThread.LowPriority)
 
-    def process(self, filePath, language, text):
-        """Convert data and emit result.
+    def process(self, filePath, language, text, cacheKey=None):
+        """Convert data and emit result. If cacheKey is not None, the result
+        is put to the render cache with this key.
+        """
+        self._queue.put(self._Task(filePath, language, text, cacheKey))
+
+    def cancel(self):
+        """Don't emit the result of the current and queued tasks.
         """
-        self._queue.put(self._Task(filePath, language, text))
+        self._queue.put(self._CANCEL)
 
     def stop_async(self):
         self._queue.put(None)
@@ -177,14 +222,54 @@ class ConverterThread(QThread):
         # and Enki settings enable codechat (config()['CodeChat']['Enabled'] is true).
         return core.config()['CodeChat']['Enabled'] and LSO and CodeToRest
 
+    def cacheKey(self, filePath, language, template, text):
+        """Get the render cache key for the document or None, if the result
+        of the conversion can't be cached. The branches follow ``_getHtml``.
+        Sphinx output is not cached, because it is produced by a build of the
+        whole project.
+        """
+        if language == 'Markdown':
+            return renderKey(language, template, (), text)
+        elif language == 'Restructured Text' and not sphinxEnabledForFile(filePath):
+            return renderKey(language, None, (), text)
+        elif filePath and not sphinxEnabledForFile(filePath) and self._canUseCodeChat():
+            fileName, fileExtension = os.path.splitext(filePath)
+            return renderKey(language, None, ('CodeChat', fileExtension), text)
+        else:
+            return None
+
+    def _convert(self, converterName, text, settings):
+        """Convert the text with a worker process, or in this thread, if the
+        workers are disabled with Preview/ConverterProcesses set to 0.
+        See ``converter.convert``. Raises ``converter.ConversionFailed``.
+        """
+        processCount = core.config()['Preview']['ConverterProcesses']
+        if self._pool is not None and self._pool.size() != processCount:
+            self._pool.close()
+            self._pool = None
+
+        if processCount > 0 and self._pool is None and not self._poolFailed:
+            try:
+                self._pool = converter.ConverterPool(processCount)
+            except (OSError, IOError):
+                traceback.print_exc()
+                self._poolFailed = True  # convert in this thread
+
+        if self._pool is not None:
+            return self._pool.convert(converterName, text, settings,
+                                      core.config()['Preview']['ConverterTimeout'])
+        else:
+            return converter.convert(converterName, text, settings)
+
     def _getHtml(self, language, text, filePath):
         """Get HTML for document
         """
         if language == 'Markdown':
-            return self._convertMarkdown(text), None, QUrl()
+            html, errString = self._convert('Markdown', text, {})
+            return html, errString, QUrl()
         # For ReST, use docutils only if Sphinx isn't available.
         elif language == 'Restructured Text' and not sphinxEnabledForFile(filePath):
-            htmlUnicode, errString = self._convertReST(text)
+            htmlUnicode, errString = self._convert('Restructured Text', text, {})
             return htmlUnicode, errString, QUrl()
         elif filePath:
             # Use Sphinx to generate the HTML if possible.
@@ -226,110 +311,21 @@ class ConverterThread(QThread):
 
             # Otherwise, fall back to using CodeChat+docutils.
             elif self._canUseCodeChat():
-                # Use StringIO to pass CodeChat compilation information back to
-                # the UI.
-                errStream = StringIO.StringIO()
-                lso = LSO.LanguageSpecificOptions()
                 fileName, fileExtension = os.path.splitext(filePath)
-                # Check to seee if CodeToRest supportgs this file's extension.
-                if fileExtension not in lso.extension_to_options.keys():
-                    return 'No preview for this type of file', None, QUrl()
-                # CodeToRest can render this file. Do so.
-                lso.set_language(fileExtension)
-                htmlString = CodeToRest.code_to_html_string(text, lso, errStream)
-                # Error string might contain characters such as ">" and "<",
-                # they need to be converted to "&gt;" and "&lt;" such that
-                # they can be displayed correctly in the log window as html strings.
-                # This step is handled by ``cgi.escape``.
-                errString = errStream.getvalue()
-                if errString:
-                    errString = "<font color='red'>" + cgi.escape(errString) + '</font>'
-                errStream.close()
+                htmlString, errString = self._convert('CodeChat', text,
+                                                      {'fileExtension': fileExtension})
                 return htmlString, errString, QUrl()
 
         return 'No preview for this type of file', None, QUrl()
 
-    def _convertMarkdown(self, text):
-        """Convert Markdown to HTML
-        """
-        try:
-            import markdown
-        except ImportError:
-            return 'Markdown preview requires <i>python-markdown</i> package<br/>' \
-                   'Install it with your package manager or see ' \
-                   '<a href="http://packages.python.org/Markdown/install.html">installation instructions</a>'
-
-        try:
-            import mdx_mathjax
-        except ImportError:
-            pass  #mathjax doesn't require import statement if installed as extension
-
-        extensions = ['fenced_code', 'nl2br']
-
-        # version 2.0 supports only extension names, not instances
-        if markdown.version_info[0] > 2 or \
-           (markdown.version_info[0] == 2 and markdown.version_info[1] > 0):
-
-            class _StrikeThroughExtension(markdown.Extension):
-                """http://achinghead.com/python-markdown-adding-insert-delete.html
-                Class is placed here, because depends on imported markdown, and markdown import is lazy
-                """
-                DEL_RE = r'(~~)(.*?)~~'
-                def extendMarkdown(self, md, md_globals):
-                    # Create the del pattern
-                    delTag = markdown.inlinepatterns.SimpleTagPattern(self.DEL_RE, 'del')
-                    # Insert del pattern into markdown parser
-                    md.inlinePatterns.add('del', delTag, '>not_strong')
-
-            extensions.append(_StrikeThroughExtension())
-
-        try:
-            return markdown.markdown(text, extensions + ['mathjax'])
-        except (ImportError, ValueError):  # markdown raises ValueError or ImportError, depends on version
-                                           # it is not clear, how to distinguish missing mathjax from other errors
-            return markdown.markdown(text, extensions) #keep going without mathjax
-
-    def _convertReST(self, text):
-        """Convert ReST
-        """
-        try:
-            import docutils.core
-            import docutils.writers.html4css1
-        except ImportError:
-            return 'Restructured Text preview requires the <i>python-docutils</i> package.<br/>' \
-                   'Install it with your package manager or see ' \
-                   '<a href="http://pypi.python.org/pypi/docutils"/>this page.</a>', None
-
-        errStream = StringIO.StringIO()
-        settingsDict = {
-          # Make sure to use Unicode everywhere.
-          'output_encoding': 'unicode',
-          'input_encoding' : 'unicode',
-          # Don't stop processing, no matter what.
-          'halt_level'     : 5,
-          # Capture errors to a string and return it.
-          'warning_stream' : errStream }
-        # Frozen-specific settings.
-        if isFrozen:
-            settingsDict['template'] = (
-              # The default docutils stylesheet and template uses a relative path,
-              # which doesn't work when frozen ???. Under Unix when not frozen,
-              # it produces:
-              # ``IOError: [Errno 2] No such file or directory:
-              # '/usr/lib/python2.7/dist-packages/docutils/writers/html4css1/template.txt'``.
-              os.path.join(os.path.dirname(docutils.writers.html4css1.__file__),
-                           docutils.writers.html4css1.Writer.default_template) )
-            settingsDict['stylesheet_dirs'] = ['.',
-              os.path.dirname(docutils.writers.html4css1.__file__)]
-        htmlString = docutils.core.publish_string(text, writer_name='html',
-                                                  settings_overrides=settingsDict)
-        errString = errStream.getvalue()
-        if errString:
-            errString = "<font color='red'>" + cgi.escape(errString) + '</font>'
-        errStream.close()
-        return htmlString, errString
-
     def _runHtmlBuilder(self):
+        # Use the resident Sphinx application, if enabled. A custom command
+        # line of the advanced mode is always executed.
+        if core.config()['Sphinx']['BuildDaemon'] and not core.config()['Sphinx']['AdvancedMode']:
+            errString = self._runBuildDaemon()
+            if errString is not None:
+                return errString
+
         # Build the commond line for Sphinx.
         if core.config()['Sphinx']['AdvancedMode']:
             htmlBuilderCommandLine = core.config()['Sphinx']['Cmdline']
@@ -360,8 +356,8 @@ class ConverterThread(QThread):
             else:
                 htmlBuilderCommandLineStr = ' '.join(htmlBuilderCommandLine)
             s = '<pre>{} : {}\n\n'.format(cwd, htmlBuilderCommandLineStr)
-            stdout, stderr = get_console_output(htmlBuilderCommandLine,
-                                                cwd=cwd)
+            self.htmlBuilderOutput.emit(u'{} : {}\n'.format(cwd, htmlBuilderCommandLineStr), True)
+            stdout, stderr = self._runBuilderCommand(htmlBuilderCommandLine, cwd)
         except OSError as ex:
             return s + '<font color=red>Failed to execute HTML builder:\n' + \
                    '{}\n'.format(str(ex)) + \
@@ -369,6 +365,90 @@ class ConverterThread(QThread):
 
         return s + cgi.escape(stdout) + '<br><font color=red>' + cgi.escape(stderr) + '</font></pre>'
 
+    def _isSphinxTask(self, task):
+        """Check if the task builds the Sphinx project. The branches follow
+        ``_getHtml``.
+        """
+        return (isinstance(task, self._Task) and task.language != 'Markdown' and
+                sphinxEnabledForFile(task.filePath))
+
+    def _isCancelled(self):
+        """A newer build of the Sphinx project or the quit command has been
+        queued, the running build is obsolete. Other tasks, i.e. a Markdown
+        document or a cancel after a render cache hit, don't interrupt the
+        build, otherwise the project would be rebuilt from the beginning next
+        time.
+        """
+        with self._queue.mutex:
+            tasks = list(self._queue.queue)
+        return any(task is None or self._isSphinxTask(task) for task in tasks)
+
+    def _runBuilderCommand(self, command, cwd):
+        """Run the HTML builder in a new process group and return (stdout, stderr).
+        The output is emitted while the builder is running. If a newer build is
+        queued, the builder and its child processes are killed; the queued tasks
+        are coalesced by run(). See ``_isCancelled``.
+        """
+        popen = open_console_output(command, cwd, new_process_group=True)
+        popen.stdin.close()
+        # The pipes are read by threads, because they can't be polled on Windows.
+        lines = Queue.Queue()
+        for stream, isError in ((popen.stdout, False), (popen.stderr, True)):
+            reader = threading.Thread(target=_readLines, args=(stream, isError, lines))
+            reader.daemon = True
+            reader.start()
+
+        stdout = []
+        stderr = []
+        openStreamsCount = 2
+        while openStreamsCount:
+            if self._isCancelled():
+                kill_process_group(popen)
+                stderr.append('\nBuild has been cancelled\n')
+                break
+
+            try:
+                item = lines.get(timeout=self.BUILDER_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            # Emit all available lines at once
+            newText = []
+            while item is not None:
+                isError, line = item
+                if line is None:
+                    openStreamsCount -= 1
+                else:
+                    (stderr if isError else stdout).append(line)
+                    newText.append(line)
+                try:
+                    item = lines.get_nowait()
+                except Queue.Empty:
+                    item = None
+            if newText:
+                self.htmlBuilderOutput.emit(_outputText(''.join(newText)), False)
+        else:
+            popen.wait()
+
+        return ''.join(stdout), ''.join(stderr)
+
+    def _runBuildDaemon(self):
+        """Build the project with the Sphinx build daemon. Returns the build
+        output, or None, if Sphinx can't be run in the daemon.
+        """
+        projectPath = os.path.abspath(core.config()['Sphinx']['ProjectPath'])
+        outputPath = os.path.join(projectPath, core.config()['Sphinx']['OutputPath'])
+        self.htmlBuilderOutput.emit(u'{} : Sphinx build daemon\n'.format(projectPath), True)
+        result = self._sphinxDaemon.build(projectPath, outputPath,
+                                          lambda text, isWarning: self.htmlBuilderOutput.emit(_outputText(text), False),
+                                          self._isCancelled)
+        if result is None:
+            return None
+
+        stdout, stderr = result
+        s = '<pre>{} : Sphinx build daemon\n\n'.format(projectPath)
+        return s + cgi.escape(stdout) + '<br><font color=red>' + cgi.escape(stderr) + '</font></pre>'
+
     def run(self):
         """Thread function
         """
@@ -380,15 +460,26 @@ class ConverterThread(QThread):
                 task = self._queue.get()
 
             if task is None:  # None is a quit command
+                if self._pool is not None:
+                    self._pool.close()
+                self._sphinxDaemon.stop()
                 break
+            elif task is self._CANCEL:
+                continue
 
             # TODO: This is ugly. Should pass this exception back to the main
             # thread and re-raise it there, or use a QFuture like approach which
             # does this automaticlaly.
             try:
                 html, errString, url = self._getHtml(task.language, task.text, task.filePath)
+            except converter.ConversionFailed as ex:
+                # Not cached, the next conversion of the text can succeed
+                html, errString, url = u'', unicode(ex), QUrl()
             except Exception:
                 traceback.print_exc()
+            else:
+                if task.cacheKey is not None and url.isEmpty():
+                    renderCache(_renderCacheSize()).put(task.cacheKey, (html, errString))
 
             if not self._queue.qsize():  # Do not emit results, if having new task
                 self.htmlReady.emit(task.filePath, html, errString, url)
@@ -453,8 +544,11 @@ class PreviewDock(DockWidget):
 
         self._thread = ConverterThread()
         self._thread.htmlReady.connect(self._setHtml)
+        self._thread.htmlBuilderOutput.connect(self._onHtmlBuilderOutput)
 
         self._visiblePath = None
+        # htmlblocks.Page of the HTML set to the view, None if it can't be patched.
+        self._visiblePage = None
 
         # If we update Preview on every key press, freezes are noticable (the
         # GUI thread draws the preview too slowly).
@@ -494,6 +588,7 @@ class PreviewDock(DockWidget):
         """
         self._typingTimer.stop()
         self._thread.htmlReady.disconnect(self._setHtml)
+        self._thread.htmlBuilderOutput.disconnect(self._onHtmlBuilderOutput)
         try:
             self._widget.webView.page().mainFrame().loadFinished.disconnect(self._restoreScrollPos)
         except TypeError:  # already has been disconnected
@@ -726,9 +821,21 @@ class PreviewDock(DockWidget):
             if ( (not sphinxCanProcess) or
                 (sphinxCanProcess and not internallyModified) or
                 saveThenBuild ):
+                # Show the cached page, if the same text has already been
+                # rendered. For example, when switching back to a document or
+                # saving a not modified one.
+                cacheKey = self._thread.cacheKey(document.filePath(), language,
+                                                 self._getCurrentTemplatePath(), text)
+                if cacheKey is not None:
+                    cached = renderCache(_renderCacheSize()).get(cacheKey)
+                    if cached is not None:
+                        self._thread.cancel()
+                        html, errString = cached
+                        self._setHtml(document.filePath(), html, errString)
+                        return
                 self._setHtmlProgress(-1)
                 # for rest language is already correct
-                self._thread.process(document.filePath(), language, text)
+                self._thread.process(document.filePath(), language, text, cacheKey)
             # Warn.
             if (sphinxCanProcess and internallyModified and
                 externallyModified and not buildOnSave):
@@ -799,14 +906,24 @@ class PreviewDock(DockWidget):
         """Set HTML to the view and restore scroll bars position.
         Called by the thread
         """
-        self._saveScrollPos()
-        self._visiblePath = filePath
-        self._widget.webView.page().mainFrame().loadFinished.connect(self._restoreScrollPos)
+        page = None
+        if baseUrl.isEmpty() and core.config()['Preview']['IncrementalUpdate']:
+            page = htmlblocks.splitHtml(html)
 
-        if baseUrl.isEmpty():
-            self._widget.webView.setHtml(html, baseUrl=QUrl.fromLocalFile(filePath))
+        if self._patchHtml(filePath, page):
+            self.previewSync.syncTextToPreview()
         else:
-            self._widget.webView.setUrl(baseUrl)
+            self._saveScrollPos()
+            self._visiblePath = filePath
+            self._widget.webView.page().mainFrame().loadFinished.connect(self._restoreScrollPos)
+
+            if baseUrl.isEmpty():
+                if page is not None:
+                    html = htmlblocks.markedHtml(page)
+                self._widget.webView.setHtml(html, baseUrl=QUrl.fromLocalFile(filePath))
+            else:
+                self._widget.webView.setUrl(baseUrl)
+        self._visiblePage = page
 
         self._widget.teLog.clear()
 
@@ -902,6 +1019,52 @@ class PreviewDock(DockWidget):
             self._setHtmlProgress(100)
         self.setHtmlDone.emit()
 
+    def _onHtmlBuilderOutput(self, text, started):
+        """Show output of the running HTML builder in the log. The complete
+        log replaces it, when the build is finished.
+        """
+        if started:
+            self._widget.teLog.clear()
+        self._widget.teLog.appendPlainText(text.rstrip('\n'))
+
+    def _patchHtml(self, filePath, page):
+        """Replace only the changed blocks of the visible page with blocks of
+        the new htmlblocks.Page. The page is not reloaded, so JavaScript isn't
+        executed again and the scroll position is kept.
+        Returns False, if the page can't be patched and must be reloaded.
+        """
+        oldPage = self._visiblePage
+        if page is None or oldPage is None or \
+           filePath != self._visiblePath or page.head != oldPage.head:
+            return False
+
+        frame = self._widget.webView.page().mainFrame()
+        selector = '[{}]'.format(htmlblocks.BLOCK_ATTRIBUTE)
+        elements = frame.findAllElements(selector).toList()
+        if len(elements) != len(oldPage.blocks):
+            return False  # the page is being loaded or has been changed by a script
+
+        first, oldEnd, newEnd = htmlblocks.changedRange(oldPage.blocks, page.blocks)
+        markup = ''.join([htmlblocks.markBlock(tag, blockMarkup) \
+                            for tag, blockMarkup in page.blocks[first:newEnd]])
+        if markup:
+            if oldEnd < len(elements):
+                elements[oldEnd].prependOutside(markup)
+            else:
+                elements[-1].appendOutside(markup)
+        for element in elements[first:oldEnd]:
+            element.removeFromDocument()
+
+        elements = frame.findAllElements(selector).toList()
+        if len(elements) != len(page.blocks):
+            return False  # the browser has parsed the markup differently
+
+        # Typeset math of the new blocks only.
+        for element in elements[first:newEnd]:
+            element.evaluateJavaScript("if (window.MathJax && MathJax.Hub) "
+                                       "{ MathJax.Hub.Queue(['Typeset', MathJax.Hub, this]); }")
+        return True
+
     def _setHtmlProgress(self, progress=None, color=None):
         """Set progress bar and status label.
         if progress is -1: use an indefinite progress bar.
@@ -960,6 +1123,8 @@ class PreviewDock(DockWidget):
         path = QFileDialog.getSaveFileName(self, 'Save Preview as HTML', filter='HTML (*.html)')
         if path:
             text = self._widget.webView.page().mainFrame().toHtml()
+            # Remove the marks of the blocks, which are used for updating the page.
+            text = re.sub(' {}(="")?'.format(htmlblocks.BLOCK_ATTRIBUTE), '', text)
             data = text.encode('utf8')
             try:
                 # Andrei: Shouldn't this be wb, since utf8 can produce binary data
@@ -0,0 +1,78 @@
+# .. -*- coding: utf-8 -*-
+#
+# *****************************************************
+# rendercache.py - LRU cache of rendered preview pages
+# *****************************************************
+#
+# Converting a big Markdown or ReST document takes a while. The preview dock
+# renders the same text again when the user switches back to a tab or saves
+# a document without changes. This module remembers the rendered HTML, so
+# such a preview can be shown without a conversion.
+#
+# Pages are addressed by their content: the key includes the language, the
+# template, the converter settings and a hash of the text, see ``renderKey``.
+# The least recently used pages are evicted when the size of the cache
+# exceeds the limit.
+#
+# This module doesn't depend on Qt.
+#
+# Imports
+# =======
+# Library imports
+# ---------------
+import hashlib
+import threading
+
+# Local imports
+# -------------
+from enki.lib.lrucache import LruCache
+
+# Estimated memory used by a cache entry besides the text of its page.
+_ENTRY_OVERHEAD = 256
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def renderCache(maxSize):
+    """Get the RenderCache. maxSize is the size limit in bytes. The limit is
+    updated, if changed.
+    """
+    global _cache  # pylint: disable=W0603
+    with _cacheLock:
+        if _cache is None:
+            _cache = RenderCache(maxSize)
+        else:
+            _cache.setMaxSize(maxSize)
+        return _cache
+
+
+def textHash(text):
+    """Hash of the text of a document.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def renderKey(language, template, settings, text):
+    """Key of a rendered page. settings is a hashable tuple of the converter
+    settings, which affect the result.
+    """
+    return (language, template, settings, textHash(text))
+
+
+def estimateSize(value):
+    """Estimate memory used by a (html, errString) value.
+    """
+    html, errString = value
+    return _ENTRY_OVERHEAD + (len(html) + len(errString or '')) * 4
+
+
+class RenderCache(LruCache):
+    """LRU cache of rendered pages. Thread safe.
+
+    Value is tuple (html, errString), as returned by the converter.
+    """
+    def __init__(self, maxSize):
+        LruCache.__init__(self, maxSize, estimateSize)
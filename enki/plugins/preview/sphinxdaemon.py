@@ -0,0 +1,233 @@
+# .. -*- coding: utf-8 -*-
+#
+# *************************************************************
+# sphinxdaemon.py - Resident Sphinx application for the preview
+# *************************************************************
+#
+# Running ``sphinx-build`` on every save pays the interpreter startup, the
+# import of Sphinx and its extensions and the load of the pickled environment
+# each time. Instead, a daemon process keeps a Sphinx application with its
+# environment in memory. On a build request it runs an update build, which
+# reads and writes only the changed documents (and the documents, which depend
+# on them).
+#
+# The daemon is restarted, when the project, the output directory or
+# ``conf.py`` changes, because Sphinx can't reload the configuration and
+# the extensions of a running application.
+#
+# The output of a build is sent to the preview while the build is running.
+# A build, which has become obsolete, is not waited for, but the daemon is not
+# killed, because a new daemon would load the environment again. The daemon
+# finishes the build, and the next build request waits for it.
+#
+# The daemon uses the Sphinx, which is importable by Enki's Python, not the
+# configured ``sphinx-build`` executable; therefore it is optional, see the
+# ``Sphinx/BuildDaemon`` option.
+#
+# This module doesn't depend on Qt.
+#
+# Imports
+# =======
+# Library imports
+# ---------------
+import multiprocessing
+import os
+import os.path
+import StringIO
+import traceback
+
+def _doctreePath(projectPath, outputPath):
+    """Directory of the pickled environment and doctrees. It is placed next to
+    the output directory, i.e. ``_build/doctrees`` for ``_build/html``, as the
+    HTML builder command does, but never in the project directory.
+    """
+    outputParent = os.path.dirname(os.path.normpath(outputPath))
+    if os.path.normpath(outputParent) == os.path.normpath(projectPath):
+        return os.path.join(outputPath, '.doctrees')  # Sphinx default
+    return os.path.join(outputParent, 'doctrees')
+
+def _confMTime(projectPath):
+    """Modification time of conf.py of the project or None.
+    """
+    try:
+        return os.path.getmtime(os.path.join(projectPath, 'conf.py'))
+    except OSError:
+        return None
+
+class _PipeStream:
+    """Output stream of the Sphinx application. Keeps the written text and sends
+    it to the parent process as ('output', text, isWarning) messages.
+    """
+    def __init__(self, connection, isWarning):
+        self._connection = connection
+        self._isWarning = isWarning
+        self._buffer = StringIO.StringIO()
+
+    def write(self, text):
+        self._buffer.write(text)
+        self._connection.send(('output', text, self._isWarning))
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+    def clear(self):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+def _daemonMain(connection, projectPath, outputPath, doctreePath):
+    """Main function of the daemon process. Creates the Sphinx application, then
+    receives build requests until the connection is closed. The output of a build
+    is sent while building, then ('done', status, warnings) is sent.
+    Sends None, if Sphinx can't be used.
+    """
+    # Sphinx projects expect the current directory to be the project directory,
+    # as for ``sphinx-build``.
+    os.chdir(projectPath)
+    status = _PipeStream(connection, False)
+    warning = _PipeStream(connection, True)
+    try:
+        from sphinx.application import Sphinx
+        app = Sphinx(projectPath, projectPath, outputPath, doctreePath, 'html',
+                     status=status, warning=warning)
+    except Exception:
+        traceback.print_exc()
+        app = None
+
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, IOError):
+            break
+        if request is None:
+            break
+        if app is None:
+            connection.send(None)
+            continue
+
+        try:
+            app.build(False, [])
+        except Exception:
+            warning.write(traceback.format_exc())
+        connection.send(('done', status.getvalue(), warning.getvalue()))
+        status.clear()
+        warning.clear()
+
+
+class SphinxDaemon:
+    """A resident Sphinx application, running in a separate process.
+    Not thread safe, used by the converter thread only.
+    """
+    POLL_INTERVAL = 0.1  # seconds
+
+    # Returned by _wait(), if the build has been cancelled.
+    _CANCELLED = 'cancelled'
+
+    def __init__(self):
+        self._process = None
+        self._connection = None
+        self._key = None  # (projectPath, outputPath, conf.py mtime) of the running daemon
+        self._failedKey = None  # the key, for which Sphinx couldn't be run
+        self._building = False  # a build has been requested and is not done yet
+
+    def build(self, projectPath, outputPath, onOutput=None, isCancelled=None):
+        """Build the project. Paths are absolute.
+
+        onOutput(text, isWarning) is called for the output of the build, while
+        it is running. isCancelled() is polled; if it returns True, the method
+        returns. The daemon finishes the cancelled build in the background.
+
+        Returns (stdout, stderr) of the build, as ``sphinx-build`` would print,
+        or None, if Sphinx can't be run in the daemon.
+        """
+        key = (projectPath, outputPath, _confMTime(projectPath))
+        if key == self._failedKey:
+            return None
+        if key != self._key:
+            self.stop()
+            self._start(projectPath, outputPath)
+            self._key = key
+
+        stdout = []
+        stderr = []
+        try:
+            message = None
+            if self._building:  # wait for the cancelled build, its output is not shown
+                message = self._wait([], [], None, isCancelled)
+            if not self._building and message is not self._CANCELLED:
+                self._connection.send(True)
+                self._building = True
+                message = self._wait(stdout, stderr, onOutput, isCancelled)
+        except (EOFError, IOError):  # the daemon has died
+            message = None
+            self._building = False
+
+        if message is self._CANCELLED:
+            stderr.append('\nBuild has been cancelled\n')
+            return ''.join(stdout), ''.join(stderr)
+        elif message is None:
+            self.stop()
+            self._failedKey = key
+            return None
+
+        kind, status, warning = message
+        return status, warning
+
+    def _wait(self, stdout, stderr, onOutput, isCancelled):
+        """Receive the output of the running build to the stdout and stderr lists.
+        Returns the last message of the build, ('done', status, warning) or None,
+        if Sphinx can't be run, or _CANCELLED, if isCancelled() has returned True.
+        Raises EOFError or IOError, if the daemon has died.
+        """
+        while True:
+            if isCancelled is not None and isCancelled():
+                return self._CANCELLED
+            if not self._connection.poll(self.POLL_INTERVAL):
+                if not self._process.is_alive():
+                    raise EOFError()
+                continue
+
+            message = self._connection.recv()
+            if message is None or message[0] == 'done':
+                self._building = False
+                return message
+            kind, text, isWarning = message
+            (stderr if isWarning else stdout).append(text)
+            if onOutput is not None:
+                onOutput(text, isWarning)
+
+    def _start(self, projectPath, outputPath):
+        """Start the daemon process.
+        """
+        doctreePath = _doctreePath(projectPath, outputPath)
+        self._connection, childConnection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_daemonMain,
+                                                args=(childConnection, projectPath,
+                                                      outputPath, doctreePath))
+        self._process.daemon = True
+        self._process.start()
+        childConnection.close()
+
+    def stop(self, kill=False):
+        """Stop the daemon process, if running. If kill is True, the process is
+        terminated immediately, otherwise it can finish a build.
+        """
+        if self._process is None:
+            return
+
+        if not kill:
+            try:
+                self._connection.send(None)
+            except (IOError, ValueError):  # the daemon has died
+                pass
+            self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._connection.close()
+        self._process = None
+        self._connection = None
+        self._key = None
+        self._building = False
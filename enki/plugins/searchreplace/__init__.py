@@ -5,8 +5,42 @@ searchreplace --- Search and replace functionality
 Contains search dialog and search/replace in file/directory functionality
 """
 
+import multiprocessing
+
+from PyQt4.QtGui import QCheckBox, QFormLayout, QIcon, QLabel, QSpinBox, QWidget
+
+from enki.core.core import core
+from enki.core.uisettings import CheckableOption, NumericOption
+
 import controller
 
+
+class SettingsPage(QWidget):
+    """Settings page for the search and replace plugin
+    """
+    def __init__(self, parent):
+        QWidget.__init__(self, parent)
+
+        try:
+            cpuCount = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpuCount = 1
+
+        text = "<html>Count of processes, which search in directory.<br/>" + \
+               "0 means count of CPUs (<i>{}</i>)</html>".format(cpuCount)
+        self._workerCountLabel = QLabel(text, self)
+        self.sbWorkerCount = QSpinBox(self)
+        self.sbWorkerCount.setRange(0, 256)
+
+        self.cbTrigramIndex = QCheckBox("Use trigram index for search in directory", self)
+        self.cbTrigramIndex.setToolTip("Index is built in the background after the first search. "
+                                       "Next searches read only files, which may contain the searched text")
+
+        self._layout = QFormLayout(self)
+        self._layout.addRow(self._workerCountLabel, self.sbWorkerCount)
+        self._layout.addRow(self.cbTrigramIndex)
+
+
 class Plugin():
     """Main class of the plugin. Installs and uninstalls plugin to the system
     """
@@ -15,8 +49,20 @@ class Plugin():
         """Plugin initialisation
         """
         self._controller = controller.Controller()
+        core.uiSettingsManager().aboutToExecute.connect(self._onSettingsDialogAboutToExecute)
 
     def del_(self):
         """Plugin termination
         """
+        core.uiSettingsManager().aboutToExecute.disconnect(self._onSettingsDialogAboutToExecute)
         self._controller.del_()
+
+    def _onSettingsDialogAboutToExecute(self, dialog):
+        """UI settings dialogue is about to execute.
+        Add own options
+        """
+        page = SettingsPage(dialog)
+        dialog.appendPage(u"Search", page, QIcon(':/enkiicons/search.png'))
+
+        dialog.appendOption(NumericOption(dialog, core.config(), "Search/WorkerCount", page.sbWorkerCount))
+        dialog.appendOption(CheckableOption(dialog, core.config(), "Search/TrigramIndex", page.cbTrigramIndex))
@@ -7,12 +7,14 @@ This module implements S&R plugin functionality. It joins together all other mod
 import re
 import sys
 
-from PyQt4.QtCore import QObject, Qt
+from PyQt4.QtCore import QObject, QPoint, Qt
 from PyQt4.QtGui import QApplication, QAction, QIcon, QMessageBox
 
 
 from enki.core.core import core
 import substitutions
+import replacefiles
+import matchindex
 
 MODE_FLAG_SEARCH = 0x1
 MODE_FLAG_REPLACE = 0x2
@@ -27,7 +29,8 @@ MODE_REPLACE_DIRECTORY = MODE_FLAG_REPLACE | MODE_FLAG_DIRECTORY
 MODE_SEARCH_OPENED_FILES = MODE_FLAG_SEARCH | MODE_FLAG_FILES
 MODE_REPLACE_OPENED_FILES = MODE_FLAG_REPLACE | MODE_FLAG_FILES
 
-# Too many extra se
+# Too many extra selections slow down the editor.
+# Only matches near the viewport are highlighted, and not more than this count
 MAX_EXTRA_SELECTIONS_COUNT = 256
 
 
@@ -39,19 +42,21 @@ class Controller(QObject):
         self._mode = None
         self._searchThread = None
         self._replaceThread = None
+        self._refineThread = None
+        self._indexThread = None
         self._widget = None
         self._dock = None
         self._searchInFileStartPoint = None
         self._searchInFileLastCursorPos = None
 
-        # all matches cache
-        self._cachedRegExp = None
-        self._cachedText = None
-        self._catchedMatches = None
+        # matches of highlighted and searched pattern
+        self._matchIndexes = {}  # document: matchindex.MatchIndex
+        self._highlightedRange = None  # (document, start, end)
 
         self._createActions()
 
         core.workspace().currentDocumentChanged.connect(self._resetSearchInFileStartPoint)
+        core.workspace().documentClosed.connect(self._dropMatchIndex)
         QApplication.instance().focusChanged.connect(self._resetSearchInFileStartPoint)
 
     def del_(self):
@@ -61,6 +66,13 @@ class Controller(QObject):
             self._searchThread.stop()
         if self._replaceThread is not None:
             self._replaceThread.stop()
+        if self._refineThread is not None:
+            self._refineThread.stop()
+        if self._indexThread is not None:
+            self._indexThread.stop()
+
+        for document in self._matchIndexes.keys():
+            self._dropMatchIndex(document)
 
         for action in self._createdActions:
             core.actionManager().removeAction(action)
@@ -143,6 +155,11 @@ class Controller(QObject):
                       "search-replace-opened-files.png", "Ctrl+Alt+R",
                       "Replace in opened files...",
                       self._onModeSwitchTriggered, MODE_REPLACE_OPENED_FILES)
+        createAction("aUndoReplace", "&Undo Replace in Files",
+                      "search-replace-directory.png", None,
+                      "Restore not opened files, changed by the last replace in directory",
+                      self._onUndoReplaceTriggered, None,
+                      replacefiles.Journal().canUndo())
 
         am = core.actionManager()
         core.workspace().currentDocumentChanged.connect( \
@@ -189,6 +206,7 @@ class Controller(QObject):
         """
         import searchresultsdock
         self._dock = searchresultsdock.SearchResultsDock(core.mainWindow())
+        self._dock.refineRequested.connect(self._onRefineRequested)
 
         core.mainWindow().addDockWidget(Qt.BottomDockWidgetArea, self._dock)
         self._dock.setVisible( False )
@@ -223,18 +241,6 @@ class Controller(QObject):
     #
     # Highlight found items with yellow
     #
-    def _findAllMatches(self, text, regExp):
-        """Find all matces of regExp in text
-        This method caches found items for last text and regExp
-        """
-        if self._cachedText != text or \
-           self._cachedRegExp != regExp:
-            self._catchedMatches = [match for match in regExp.finditer(text)]
-            self._cachedText = text
-            self._cachedRegExp = regExp
-
-        return self._catchedMatches
-
     def _updateSearchWidgetFoundItemsHighlighting(self):
         document = core.workspace().currentDocument()
         if document is None:
@@ -244,53 +250,121 @@ class Controller(QObject):
            not self._widget.isSearchRegExpValid()[0] or \
            not self._widget.getRegExp().pattern:
             document.qutepart.setExtraSelections([])
+            for indexedDocument in self._matchIndexes.keys():
+                self._dropMatchIndex(indexedDocument)
             return
 
         return self._updateFoundItemsHighlighting(self._widget.getRegExp())
 
+    def _matchIndex(self, document, regExp):
+        """Get matchindex.MatchIndex of regExp for the document.
+        The index is updated on edits by _onContentsChange()
+        """
+        qutepart = document.qutepart
+        index = self._matchIndexes.get(document)
+        if index is None:
+            qutepart.document().contentsChange.connect(self._onContentsChange)
+            qutepart.verticalScrollBar().valueChanged.connect(self._onViewportScrolled)
+
+        if index is None or \
+           index.regExp != regExp or \
+           index.revision != qutepart.document().revision():
+            index = matchindex.MatchIndex(regExp, qutepart.text)
+            index.revision = qutepart.document().revision()
+            self._matchIndexes[document] = index
+
+        return index
+
+    def _dropMatchIndex(self, document):
+        """Forget matches of the document. Called when the document is closed, or highlighting is disabled
+        """
+        if document in self._matchIndexes:
+            del self._matchIndexes[document]
+            document.qutepart.document().contentsChange.disconnect(self._onContentsChange)
+            document.qutepart.verticalScrollBar().valueChanged.disconnect(self._onViewportScrolled)
+        if self._highlightedRange is not None and \
+           self._highlightedRange[0] is document:
+            self._highlightedRange = None
+
+    def _onContentsChange(self, position, charsRemoved, charsAdded):
+        """Document text has been edited. Rescan only the changed lines
+        """
+        textDocument = self.sender()
+        for document, index in self._matchIndexes.items():
+            if document.qutepart.document() is textDocument:
+                break
+        else:
+            return
+
+        text = document.qutepart.text
+        position = min(position, len(text))
+        end = min(position + charsAdded, len(text))
+        regionStart = textDocument.findBlock(position).position()
+        lastBlock = textDocument.findBlock(end)
+        regionEnd = max(lastBlock.position() + lastBlock.length() - 1, end)
+
+        index.update(text, regionStart, regionEnd, charsAdded - charsRemoved)
+        index.revision = textDocument.revision()
+
+    def _visibleRange(self, qutepart):
+        """Range of the text, which is visible in the viewport
+        """
+        viewport = qutepart.viewport()
+        start = qutepart.firstVisibleBlock().position()
+        end = qutepart.cursorForPosition(QPoint(viewport.width(), viewport.height())).position()
+        return start, end
+
+    def _highlightVisibleMatches(self, document, index):
+        """Highlight matches in the viewport and in one screen above and below it
+        """
+        visibleStart, visibleEnd = self._visibleRange(document.qutepart)
+        margin = visibleEnd - visibleStart + 1
+        start, end = max(0, visibleStart - margin), visibleEnd + margin
+
+        spans = index.spans(start, end)
+        if len(spans) > MAX_EXTRA_SELECTIONS_COUNT:
+            start, end = visibleStart, visibleEnd
+            spans = index.spans(start, end)[:MAX_EXTRA_SELECTIONS_COUNT]
+
+        document.qutepart.setExtraSelections([(matchStart, matchEnd - matchStart) \
+                                                for matchStart, matchEnd in spans])
+        self._highlightedRange = (document, start, end)
+
+    def _onViewportScrolled(self):
+        """Highlight matches, which became visible
+        """
+        if self._highlightedRange is None:
+            return
+
+        document, start, end = self._highlightedRange
+        if document is not core.workspace().currentDocument() or \
+           document not in self._matchIndexes:
+            return
+
+        visibleStart, visibleEnd = self._visibleRange(document.qutepart)
+        if visibleStart < start or visibleEnd > end:
+            self._highlightVisibleMatches(document, self._matchIndexes[document])
+
     def _updateFoundItemsHighlighting(self, regExp):
         """(Re)highlight found items with yellow color
         Called by _updateSearchWidgetFoundItemsHighlighting and by word search highlighting
         """
         document = core.workspace().currentDocument()
-
-        matches = self._findAllMatches(document.qutepart.text, regExp)
-
-        if len(matches) <= MAX_EXTRA_SELECTIONS_COUNT:
-            selections = [ (match.start(), len(match.group(0))) \
-                                for match in matches]
-        else:
-            selections = []
-
-        document.qutepart.setExtraSelections(selections)
+        self._highlightVisibleMatches(document, self._matchIndex(document, regExp))
 
     def _onCurrentDocumentChanged(self, old, new):
         """Current document changed. Clear highlighted items
         """
         if old is not None:
             old.qutepart.setExtraSelections([])
+        self._highlightedRange = None
 
-    def _searchInText(self, regExp, text, startPoint, forward):
-        """Search in text and return tuple (nearest match, all matches)
-        (None, None) if not found
+    def _searchInDocument(self, document, regExp, startPoint, forward):
+        """Search in the document and return tuple (ordinal of the nearest match, matchindex.MatchIndex)
+        Ordinal is None if not found
         """
-        matches = self._findAllMatches(text, regExp)
-        if matches:
-            if forward:
-                for match in matches:
-                    if match.start() >= startPoint:
-                        break
-                else:  # wrap, search from start
-                    match = matches[0]
-            else:  # reverse search
-                for match in matches[::-1]:
-                    if match.start() < startPoint:
-                        break
-                else:  # wrap, search from end
-                    match = matches[-1]
-            return match, matches
-        else:
-            return None, None
+        index = self._matchIndex(document, regExp)
+        return index.nearest(startPoint, forward), index
 
     #
     # Search word under cursor
@@ -324,7 +398,6 @@ class Controller(QObject):
             return
 
         regExp = re.compile('\\b%s\\b' % re.escape(word))
-        text = document.qutepart.text
 
         # avoid matching word under cursor
         if forward:
@@ -334,11 +407,11 @@ class Controller(QObject):
 
         self._updateFoundItemsHighlighting(regExp)
 
-        match, matches = self._searchInText(regExp, document.qutepart.text, startPoint, forward)
-        if match is not None:
-            document.qutepart.absSelectedPosition = (match.start(), match.start() + len(match.group(0)))
+        ordinal, index = self._searchInDocument(document, regExp, startPoint, forward)
+        if ordinal is not None:
+            document.qutepart.absSelectedPosition = index.span(ordinal)
             core.mainWindow().statusBar().showMessage('Match %d of %d' % \
-                                                      (matches.index(match) + 1, len(matches)), 3000)
+                                                      (ordinal + 1, index.count()), 3000)
         else:
             core.workspace().currentDocument().qutepart.resetSelection()
 
@@ -395,7 +468,8 @@ class Controller(QObject):
     def _searchFile(self, forward=True, incremental=False):
         """Do search in file operation. Will select next found item
         """
-        qutepart = core.workspace().currentDocument().qutepart
+        document = core.workspace().currentDocument()
+        qutepart = document.qutepart
 
         regExp = self._widget.getRegExp()
 
@@ -414,14 +488,14 @@ class Controller(QObject):
             else:
                 self._searchInFileStartPoint = cursor.selectionStart()
 
-        match, matches = self._searchInText(regExp, qutepart.text, self._searchInFileStartPoint, forward)
-        if match:
-            selectionStart, selectionEnd = match.start(), match.start() + len(match.group(0))
+        ordinal, index = self._searchInDocument(document, regExp, self._searchInFileStartPoint, forward)
+        if ordinal is not None:
+            selectionStart, selectionEnd = index.span(ordinal)
             qutepart.absSelectedPosition = (selectionStart, selectionEnd)
             self._searchInFileLastCursorPos = selectionEnd
             self._widget.setState(self._widget.Good)  # change background acording to result
             core.mainWindow().statusBar().showMessage('Match %d of %d' % \
-                                                      (matches.index(match) + 1, len(matches)), 3000)
+                                                      (ordinal + 1, index.count()), 3000)
         else:
             self._widget.setState(self._widget.Bad)
             qutepart.resetSelection()
@@ -456,14 +530,13 @@ class Controller(QObject):
         """
         self._widget.updateComboBoxes()
 
-        qpart = core.workspace().currentDocument().qutepart
+        document = core.workspace().currentDocument()
         regExp = self._widget.getRegExp()
 
-        matches = self._findAllMatches(qpart.text, regExp)
-        with qpart:
-            for match in matches[::-1]:  # reverse order, because replacement may move indexes
-                replaceTextSubed = substitutions.makeSubstitutions(replaceText, match)
-                qpart.replaceText(match.start(), len(match.group(0)), replaceTextSubed)
+        matches = list(regExp.finditer(document.qutepart.text))
+        template = substitutions.Template(replaceText)
+        document.applyReplacements([(match.start(), match.end(), template.substitute(match)) \
+                                        for match in matches])
 
         core.mainWindow().statusBar().showMessage( self.tr( "%d match(es) replaced." % len(matches) ), 3000 )
 
@@ -471,14 +544,18 @@ class Controller(QObject):
     # Search in directory (with thread)
     #
 
-    def _onSearchInDirectoryStartPressed(self, regExp, mask, path):
-        """Handler for 'search in directory' action
+    def _onSearchInDirectoryStartPressed(self, regExp, mask, path, patterns):
+        """Handler for 'search in directory' action.
+        patterns is not empty, if multiple words are searched
         """
         self._widget.updateComboBoxes()
 
         if self._dock is None:
             self._createDockWidget()
 
+        if self._refineThread is not None:
+            self._refineThread.stop()
+
         from threads import SearchThread
         self._searchThread = SearchThread()
         self._searchThread.progressChanged.connect(self._widget.onSearchProgressChanged)
@@ -493,7 +570,8 @@ class Controller(QObject):
         self._searchThread.search( regExp,
                                    mask,
                                    inOpenedFiles,
-                                   path)
+                                   path,
+                                   patterns)
 
     def _onSearchInDirectoryStopPressed(self):
         """Handler for 'search in directory' action
@@ -511,6 +589,46 @@ class Controller(QObject):
         else:
             core.mainWindow().statusBar().showMessage('Nothing found', 3000)
 
+        listedFiles = self._searchThread.listedFiles()
+        if listedFiles is not None:  # trigram index is enabled
+            if self._indexThread is None:
+                from threads import IndexThread
+                self._indexThread = IndexThread()
+                self._indexThread.error.connect(self._onThreadError)
+            self._indexThread.updateIndex(self._searchThread.searchPath(), listedFiles)
+
+    def _onRefineRequested(self, lineRegExpText, mask):
+        """Filter results of the last search in the background. Files are not searched again
+        """
+        if self._replaceThread is not None and self._replaceThread.isRunning():
+            return
+
+        if lineRegExpText:
+            try:
+                lineRegExp = re.compile(lineRegExpText, re.UNICODE)
+            except re.error as ex:
+                core.mainWindow().statusBar().showMessage('Invalid regular expression: %s' % ex, 3000)
+                return
+        else:
+            lineRegExp = None
+
+        if self._searchThread is not None:
+            self._searchThread.stop()
+
+        if self._refineThread is None:
+            from threads import RefineThread
+            self._refineThread = RefineThread()
+            self._refineThread.resultsAvailable.connect(self._onRefinedResultsAvailable)
+
+        self._refineThread.refine(self._dock.resultsSnapshot(), lineRegExp, mask)
+
+    def _onRefinedResultsAvailable(self, fileResults):
+        """Refine thread finished. Show the refined results instead of the previous ones
+        """
+        self._dock.clear()
+        self._dock.appendResults(fileResults)
+        core.mainWindow().statusBar().showMessage('%d matches ' % self._dock.matchesCount(), 3000)
+
     #
     # Replace in directory (with thread)
     #
@@ -528,7 +646,9 @@ class Controller(QObject):
         self._replaceThread.resultsHandled.connect(self._dock.onResultsHandledByReplaceThread)
         self._replaceThread.error.connect(self._onThreadError)
         self._replaceThread.finalStatus.connect(self._onReplaceThreadFinalStatus)
+        self._replaceThread.finished.connect(self._onReplaceThreadFinished)
 
+        self._widget.setReplaceInProgress(True)
         self._replaceThread.replace( self._dock.getCheckedItems(),
                                      replaceText)
 
@@ -547,6 +667,33 @@ class Controller(QObject):
         """Handler for replace in directory finished event
         """
         self._widget.setReplaceInProgress(False)
+        self._updateUndoReplaceAction()
+
+    def _updateUndoReplaceAction(self):
+        """Enable undo replace action, if the last replace may be undone
+        """
+        core.actionManager().action("mNavigation/mSearchReplace/aUndoReplace").setEnabled(
+                                                                        replacefiles.Journal().canUndo())
+
+    def _onUndoReplaceTriggered(self):
+        """Restore files, changed by the last replace in not opened files
+        """
+        if self._replaceThread is not None:
+            self._replaceThread.stop()
+
+        def isModifiedDocument(fileName):
+            document = core.workspace().findDocumentForPath(fileName)
+            return document is not None and document.qutepart.document().isModified()
+
+        restored, errors = replacefiles.Journal().undo(isModifiedDocument)
+        for fileName in restored:  # file may have been opened after the replace
+            document = core.workspace().findDocumentForPath(fileName)
+            if document is not None:
+                document.reload()
+        for error in errors:
+            core.mainWindow().appendMessage(error)
+        core.mainWindow().statusBar().showMessage('%d file(s) restored' % len(restored), 3000)
+        self._updateUndoReplaceAction()
 
     def _onReplaceThreadFinalStatus(self, message):
         """Show replace thread status on status bar
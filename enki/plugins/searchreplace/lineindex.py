@@ -0,0 +1,78 @@
+"""
+lineindex --- Line numbers of text positions
+============================================
+
+Search results show line and column of every match. Counting EOLs between matches and searching for
+line boundaries around every match takes most of the search time, if a big file contains many matches.
+
+:class:`LineIndex` remembers offsets of all line starts and finds the line of a position with ``bisect``.
+
+The module doesn't depend on Qt. It is used by the scanner and the in-file search
+"""
+
+import array
+import bisect
+
+
+class LineIndex:
+    """Index of line starts of a text.
+
+    text is unicode, str or mmap, anything, what has ``find()`` and ``len()``.
+    Positions and lines are 0-based. Lines don't include EOL
+    """
+    def __init__(self, text, eol='\n'):
+        self._text = text
+        self._eol = eol
+
+        lineStarts = array.array('l', [0])
+        find = text.find
+        eolLen = len(eol)
+        eolPos = find(eol)
+        while eolPos != -1:
+            lineStarts.append(eolPos + eolLen)
+            eolPos = find(eol, eolPos + eolLen)
+        self._lineStarts = lineStarts
+
+    def lineCount(self):
+        """Count of lines
+        """
+        return len(self._lineStarts)
+
+    def line(self, pos, hint=0):
+        """Line, which contains the position.
+        hint is a line before the position or the line of the position, if known.
+        Searching for lines of sorted positions with hints is faster
+        """
+        lineStarts = self._lineStarts
+        count = len(lineStarts)
+        if lineStarts[hint] > pos:
+            hint = 0
+        elif hint + 1 == count or pos < lineStarts[hint + 1]:
+            return hint
+        elif hint + 2 == count or pos < lineStarts[hint + 2]:  # the next line
+            return hint + 1
+        return bisect.bisect_right(lineStarts, pos, hint) - 1
+
+    def lineStart(self, line):
+        """Position of the first character of the line. The line must be returned by line()
+        """
+        return self._lineStarts[line]
+
+    def lineEnd(self, line):
+        """Position of the EOL of the line or end of the text. The line must be returned by line()
+        """
+        if line + 1 < len(self._lineStarts):
+            return self._lineStarts[line + 1] - len(self._eol)
+        else:
+            return len(self._text)
+
+    def lineAndColumn(self, pos):
+        """Tuple (line, column) of the position
+        """
+        line = self.line(pos)
+        return line, pos - self._lineStarts[line]
+
+    def lines(self, start, end):
+        """Text of the lines, which contain range [start, end]
+        """
+        return self._text[self.lineStart(self.line(start)):self.lineEnd(self.line(end))]
@@ -0,0 +1,80 @@
+"""
+literals --- Literal strings, which are required by a regular expression
+========================================================================
+
+Every match of ``foo_\\w+_bar`` contains ``foo_`` and ``_bar``. Files which don't contain
+these strings can't contain a match and may be skipped without running the regular expression.
+
+The module analyses the pattern with ``sre_parse``. Analysis is conservative, if a part of the
+pattern is not understood, it just doesn't produce literals.
+"""
+
+import sre_constants
+import sre_parse
+
+
+def _walk(items, literals, current):
+    """Walk parsed pattern items. Append found literals to the list.
+
+    current is list of characters of the literal, which is being collected.
+    Returns current after processing the items
+    """
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            current.append(unichr(av))
+        elif op == sre_constants.AT:  # zero-width, doesn't break the literal
+            pass
+        elif op == sre_constants.SUBPATTERN:  # group is a part of the sequence
+            current = _walk(av[-1], literals, current)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # content is required, but repeated content breaks the literal
+            _flush(literals, current)
+            _flush(literals, _walk(av[2], literals, []))
+            current = []
+        else:  # branch, character class, any character, etc.
+            _flush(literals, current)
+            current = []
+
+    return current
+
+
+def _flush(literals, current):
+    """Append collected literal to the list
+    """
+    if current:
+        literals.append(u''.join(current))
+
+
+def requiredLiterals(regExp):
+    """Get list of strings, all of which are contained by every match of the regular expression.
+
+    Returns empty list, if no literals found or the pattern can't be analysed.
+    If regExp has IGNORECASE flag, letter case of the literals shall be ignored by the caller.
+    """
+    literals = []
+    try:
+        parsed = sre_parse.parse(regExp.pattern, regExp.flags)
+        _flush(literals, _walk(parsed, literals, []))
+    except (sre_constants.error, RuntimeError):  # RuntimeError - too deep recursion
+        return []
+
+    return literals
+
+
+def pureLiteral(regExp):
+    """Get the string, if the regular expression matches only this string (i.e. escaped text).
+    Otherwise returns None.
+    If regExp has IGNORECASE flag, letter case shall be ignored by the caller.
+    """
+    try:
+        parsed = sre_parse.parse(regExp.pattern, regExp.flags)
+    except (sre_constants.error, RuntimeError):  # RuntimeError - too deep recursion
+        return None
+
+    chars = []
+    for op, av in parsed:
+        if op != sre_constants.LITERAL:
+            return None
+        chars.append(unichr(av))
+
+    return u''.join(chars)
@@ -0,0 +1,187 @@
+"""
+matchindex --- Positions of the matches in an opened document
+=============================================================
+
+:class:`MatchIndex` keeps sorted offsets of all matches of a pattern in the text of a document.
+It is used by the controller to highlight found items and to navigate between them.
+After an edit only the changed lines are rescanned, see :meth:`MatchIndex.update`.
+It is correct only for patterns, which match within one line, see :func:`isLineLocal`.
+The index is rebuilt for other patterns.
+
+The module doesn't depend on Qt
+"""
+
+import bisect
+import re
+import sre_constants
+import sre_parse
+
+# Categories, which contain the line break
+_LINE_BREAK_CATEGORIES = (sre_constants.CATEGORY_NOT_DIGIT,
+                          sre_constants.CATEGORY_SPACE,
+                          sre_constants.CATEGORY_NOT_WORD)
+
+_NEWLINE = ord('\n')
+
+
+def _inMatchesNewline(items):
+    """Check if a parsed character class matches the line break
+    """
+    negate = False
+    matches = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            matches = matches or av == _NEWLINE
+        elif op == sre_constants.RANGE:
+            matches = matches or av[0] <= _NEWLINE <= av[1]
+        elif op == sre_constants.CATEGORY:
+            matches = matches or av in _LINE_BREAK_CATEGORIES
+        else:
+            return True  # unknown item, be conservative
+    return matches != negate
+
+
+def _isLineLocalItems(items, flags):
+    """Check if parsed pattern items never match or look at the line break.
+
+    Word boundaries are allowed: they look at one character next to the match, which is
+    in the same line or is the line break itself
+    """
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            if av == _NEWLINE:
+                return False
+        elif op == sre_constants.NOT_LITERAL:
+            if av != _NEWLINE:
+                return False
+        elif op == sre_constants.ANY:
+            if flags & re.DOTALL:
+                return False
+        elif op == sre_constants.IN:
+            if _inMatchesNewline(av):
+                return False
+        elif op == sre_constants.AT:
+            if av not in (sre_constants.AT_BOUNDARY, sre_constants.AT_NON_BOUNDARY):
+                return False
+        elif op == sre_constants.GROUPREF:  # the group is in the same line
+            pass
+        elif op == sre_constants.SUBPATTERN:
+            if not _isLineLocalItems(av[-1], flags):
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if not _isLineLocalItems(av[2], flags):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all([_isLineLocalItems(branch, flags) for branch in av[1]]):
+                return False
+        else:  # lookaround, conditional group etc.
+            return False
+
+    return True
+
+
+def isLineLocal(regExp):
+    """Check if every match of the pattern is a not empty part of one line, and doesn't depend on
+    other lines. Only such matches can be updated by rescanning the edited lines
+    """
+    try:
+        parsed = sre_parse.parse(regExp.pattern, regExp.flags)
+        return parsed.getwidth()[0] > 0 and _isLineLocalItems(parsed, regExp.flags)
+    except (sre_constants.error, RuntimeError):  # RuntimeError - too deep recursion
+        return False
+
+
+class MatchIndex:
+    """Sorted starts and ends of not overlapping matches of regExp in the text.
+    Matches are the same, as regExp.finditer(text) returns
+    """
+    def __init__(self, regExp, text):
+        self.regExp = regExp
+        self.revision = None  # version of the indexed text. Set and checked by the owner of the index
+        self._lineLocal = isLineLocal(regExp)
+        self._starts = []
+        self._ends = []
+        self.reset(text)
+
+    def reset(self, text):
+        """Find all matches in the text
+        """
+        spans = [match.span() for match in self.regExp.finditer(text)]
+        self._starts = [start for start, end in spans]
+        self._ends = [end for start, end in spans]
+
+    def count(self):
+        """Count of matches
+        """
+        return len(self._starts)
+
+    def span(self, ordinal):
+        """(start, end) of the match
+        """
+        return self._starts[ordinal], self._ends[ordinal]
+
+    def nearest(self, position, forward):
+        """Ordinal of the first match, which starts at or after the position, if forward,
+        or of the last match, which starts before the position, otherwise.
+        Search wraps around the text. None, if there are no matches
+        """
+        if not self._starts:
+            return None
+
+        ordinal = bisect.bisect_left(self._starts, position)
+        if not forward:
+            ordinal -= 1
+        return ordinal % len(self._starts)
+
+    def spans(self, start, end):
+        """List of (start, end) of the matches, which intersect [start, end) range of the text
+        """
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_left(self._starts, end, first)
+        return zip(self._starts[first:last], self._ends[first:last])
+
+    def update(self, text, regionStart, regionEnd, delta):
+        """The text has been edited. Update the matches.
+
+        [regionStart, regionEnd] is the changed part of the new text, extended to whole lines.
+        delta is the change of the text length.
+
+        Matches before the region are kept. The text is rescanned from the region start, until found matches
+        coincide with the old matches after the region. The rest of the old matches are shifted by delta.
+        If the pattern is not line local, the whole text is rescanned
+        """
+        if not self._lineLocal:
+            self.reset(text)
+            return
+
+        starts, ends = self._starts, self._ends
+        regionEndOld = regionEnd - delta
+
+        first = bisect.bisect_left(ends, regionStart)  # matches before it end before the region
+        tail = bisect.bisect_right(starts, regionEndOld)  # matches from it start after the region
+
+        scanStart = regionStart
+        if first < len(starts):
+            scanStart = min(scanStart, starts[first])
+
+        newStarts = []
+        newEnds = []
+        index = tail
+        for match in self.regExp.finditer(text, scanStart):
+            start, end = match.span()
+            if start > regionEnd:
+                while index < len(starts) and starts[index] + delta < start:
+                    index += 1  # the old match is not found anymore
+                if index < len(starts) and \
+                   starts[index] + delta == start and \
+                   ends[index] + delta == end:
+                    break  # the same matches as before the edit follow
+            newStarts.append(start)
+            newEnds.append(end)
+        else:
+            index = len(starts)
+
+        self._starts = starts[:first] + newStarts + [start + delta for start in starts[index:]]
+        self._ends = ends[:first] + newEnds + [end + delta for end in ends[index:]]
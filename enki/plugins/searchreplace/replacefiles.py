@@ -0,0 +1,250 @@
+"""
+replacefiles --- Transactional replace in files
+===============================================
+
+Replace in not opened files is done in two phases.
+
+First, the new content of every file is written to a staged file next to it.
+Symbolic links are resolved, the staged file is placed next to the link target, therefore the link is kept. See :func:`stageReplacements`.
+Files, which have been changed after the search, are skipped, because positions of the found matches
+are not valid anymore. Staging is done by the worker processes and may be cancelled without any changes.
+
+Then all the staged files are committed by :class:`Journal`. Originals are kept in the journal
+directory, and the staged files are renamed to the originals. If renaming fails, already committed
+files are restored. The last replace may be undone with the journal.
+
+The module doesn't depend on Qt
+"""
+
+import marshal
+import os
+import os.path
+import shutil
+import sys
+
+import enki.core.defines
+
+import scanner
+
+_JOURNAL_FORMAT_VERSION = 1
+
+
+def journalDirectory():
+    """Directory, where the journal of the last replace is stored
+    """
+    return os.path.join(enki.core.defines.CONFIG_DIR, 'replacejournal')
+
+
+def stagedPath(fileName):
+    """Path of the staged file with the new content of the file
+    """
+    directory, baseName = os.path.split(fileName)
+    return os.path.join(directory, '.%s.enki-replace' % baseName)
+
+
+def _replaceFile(source, destination):
+    """Rename source file to destination. Replaces the destination
+    """
+    if sys.platform == 'win32' and os.path.exists(destination):  # os.rename() doesn't replace files on Windows
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def _removeIfExists(filePath):
+    """Remove the file, ignore errors
+    """
+    try:
+        if os.path.exists(filePath):
+            os.remove(filePath)
+    except OSError:
+        pass
+
+
+def _copyOwner(source, destination):
+    """Copy owner and group of the source file to the destination, if possible
+    """
+    if hasattr(os, 'chown'):
+        status = os.stat(source)
+        try:
+            os.chown(destination, status.st_uid, status.st_gid)
+        except OSError:  # not permitted for other users files
+            pass
+
+
+def stageReplacements(task):
+    """Worker process entry point. Write new content of the file to the staged file.
+
+    task is tuple (fileName, contentHash, spansList, template).
+    contentHash is scanner.contentHash() of the file, when it was searched, or None, if unknown.
+    spansList is list of spans arrays
+    of the matches to replace, template is substitutions.Template
+
+    Returns tuple (fileName, contentHash of the new content, error). error is None on success.
+    If the file has been changed after the search, it is not staged and error is set
+    """
+    fileName, contentHash, spansList, template = task
+    realPath = os.path.realpath(fileName)
+    try:
+        with open(realPath, 'rb') as openFile:
+            data = openFile.read()
+    except IOError as ex:
+        return fileName, None, "Error opening file: %s" % ex
+
+    if contentHash is not None and scanner.contentHash(data) != contentHash:
+        return fileName, None, "File %s has been changed after the search. Not replaced" % fileName
+
+    try:
+        content = data.decode('utf8')
+    except UnicodeDecodeError as ex:
+        return fileName, None, "File %s not read: unicode error '%s'. File may be corrupted" % (fileName, ex)
+
+    try:
+        data = template.replaceInText(content, spansList).encode('utf8')
+    except UnicodeEncodeError as ex:
+        return fileName, None, "Failed to encode file to utf8: %s" % ex
+
+    tmpPath = stagedPath(realPath)
+    try:
+        with open(tmpPath, 'wb') as openFile:
+            openFile.write(data)
+        shutil.copymode(realPath, tmpPath)
+        _copyOwner(realPath, tmpPath)
+    except (IOError, OSError) as ex:
+        _removeIfExists(tmpPath)
+        return fileName, None, "Error while saving replaced content: %s" % ex
+
+    return fileName, scanner.contentHash(data), None
+
+
+def discardStaged(fileNames):
+    """Remove staged files. Used, if the replace has been cancelled
+    """
+    for fileName in fileNames:
+        _removeIfExists(stagedPath(os.path.realpath(fileName)))
+
+
+class Journal:
+    """Journal of the last replace in files. Commits staged files and undoes the replace.
+
+    The journal directory contains the originals of the replaced files and the ``journal`` file
+    with list of tuples (resolved file name, backup name, contentHash of the new content)
+    """
+    def __init__(self, directory=None):
+        self._directory = directory or journalDirectory()
+        self._journalPath = os.path.join(self._directory, 'journal')
+
+    def _entries(self):
+        """Read list of entries of the journal. Empty list, if no journal
+        """
+        try:
+            with open(self._journalPath, 'rb') as journalFile:
+                data = marshal.load(journalFile)
+        except (IOError, EOFError, ValueError, TypeError):
+            return []
+
+        if not isinstance(data, dict) or data.get('version') != _JOURNAL_FORMAT_VERSION:
+            return []
+        return data['entries']
+
+    def clear(self):
+        """Forget the last replace
+        """
+        if os.path.isdir(self._directory):
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def canUndo(self):
+        """Check if the journal contains a replace, which may be undone
+        """
+        return bool(self._entries())
+
+    def commit(self, stagedFiles):
+        """Replace files with the staged ones.
+
+        stagedFiles is list of tuples (fileName, contentHash of the new content).
+        All the files are replaced, or, if it is not possible, none of them.
+        Raises IOError or OSError in the last case
+        """
+        self.clear()
+        entries = []
+        try:
+            os.makedirs(self._directory)
+            for index, (fileName, contentHash) in enumerate(stagedFiles):
+                realPath = os.path.realpath(fileName)
+                backupName = str(index)
+                backupPath = os.path.join(self._directory, backupName)
+                if hasattr(os, 'link'):
+                    try:
+                        os.link(realPath, backupPath)  # the original is not changed, but replaced
+                    except OSError:  # different file systems
+                        shutil.copy2(realPath, backupPath)
+                else:
+                    shutil.copy2(realPath, backupPath)
+                entries.append((realPath, backupName, contentHash))
+
+            with open(self._journalPath, 'wb') as journalFile:
+                marshal.dump({'version': _JOURNAL_FORMAT_VERSION, 'entries': entries}, journalFile)
+        except (IOError, OSError):
+            discardStaged([fileName for fileName, contentHash in stagedFiles])
+            self.clear()
+            raise
+
+        committed = []
+        try:
+            for fileName, backupName, contentHash in entries:
+                _replaceFile(stagedPath(fileName), fileName)
+                committed.append((fileName, backupName))
+        except (IOError, OSError):
+            discardStaged([fileName for fileName, contentHash in stagedFiles])
+            restored = True
+            for fileName, backupName in committed:
+                try:
+                    self._restore(fileName, backupName)
+                except (IOError, OSError):
+                    restored = False  # keep the journal, the original may be restored with undo()
+            if restored:
+                self.clear()
+            raise
+
+    def _restore(self, fileName, backupName):
+        """Restore the original of the file from the journal. The original is copied to the staged file first,
+        therefore the file is never truncated
+        """
+        tmpPath = stagedPath(fileName)
+        shutil.copy2(os.path.join(self._directory, backupName), tmpPath)
+        _replaceFile(tmpPath, fileName)
+
+    def undo(self, isSkipped=None):
+        """Restore the files, replaced by the last replace. Files, which have been changed after the replace,
+        are not restored.
+
+        isSkipped is optional callable, which gets the file name and returns True, if the file must not be restored.
+        Used for files, which are opened and modified in the editor
+
+        Returns tuple (list of restored files, list of error messages)
+        """
+        restored = []
+        errors = []
+        for fileName, backupName, contentHash in self._entries():
+            fileName = os.path.realpath(fileName)
+            if isSkipped is not None and isSkipped(fileName):
+                errors.append("File %s is modified in the editor. Not restored" % fileName)
+                continue
+
+            try:
+                with open(fileName, 'rb') as openFile:
+                    changed = scanner.contentHash(openFile.read()) != contentHash
+            except IOError:
+                changed = True
+            if changed:
+                errors.append("File %s has been changed after the replace. Not restored" % fileName)
+                continue
+
+            try:
+                self._restore(fileName, backupName)
+            except (IOError, OSError) as ex:
+                errors.append("Failed to restore %s: %s" % (fileName, ex))
+            else:
+                restored.append(fileName)
+
+        self.clear()
+        return restored, errors
@@ -0,0 +1,83 @@
+"""
+resultcache --- Cache of search results of files
+================================================
+
+Repeated searches with the same pattern replay results of files, which haven't been changed since
+the previous search, and search only changed files.
+
+Results are cached by (pattern key, file path), see :func:`patternKey`, and validated with the version
+of the file content. Version is size and modification time for not opened files and the document revision
+for opened ones. Results of a changed file replace its outdated entry.
+Least recently used entries are evicted, when the estimated size of the cache exceeds the limit.
+
+The module doesn't depend on Qt
+"""
+
+import threading
+
+from enki.lib.lrucache import LruCache
+
+import scanner
+
+# Estimated memory, used by a cached result besides the text of its line
+_RESULT_OVERHEAD = 128
+_ENTRY_OVERHEAD = 256
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def resultCache(maxSize):
+    """Get the ResultCache. maxSize is the size limit in bytes. The limit is updated, if changed
+    """
+    global _cache  # pylint: disable=W0603
+    with _cacheLock:
+        if _cache is None:
+            _cache = ResultCache(maxSize)
+        else:
+            _cache.setMaxSize(maxSize)
+        return _cache
+
+
+def patternKey(pattern):
+    """Key of scanner.Pattern or scanner.MultiPattern. Patterns with the same key find the same results
+    """
+    if isinstance(pattern, scanner.MultiPattern):
+        return tuple([(name, patternKey(subPattern)) \
+                        for name, subPattern in zip(pattern.names, pattern.patterns)])
+    else:
+        return (pattern.regExp.pattern, pattern.regExp.flags)
+
+
+def estimateSize(results):
+    """Estimate memory, used by scanner results of a file
+    """
+    size = _ENTRY_OVERHEAD
+    lastLine = None
+    for wholeLine, line, column, spans in results:
+        if wholeLine is not lastLine:  # lines are shared by results
+            size += len(wholeLine) * 4
+            lastLine = wholeLine
+        size += _RESULT_OVERHEAD
+    return size
+
+
+class ResultCache(LruCache):
+    """LRU cache of search results of files. Thread safe.
+
+    Key is (pattern key, file path). Value is tuple (scanner results, content hash),
+    as returned by scanner.searchInFile()
+    """
+    def __init__(self, maxSize):
+        LruCache.__init__(self, maxSize, lambda entry: estimateSize(entry[1][0]))
+
+    def get(self, key, version):
+        """Get cached value or None, if not cached or cached for other version of the file
+        """
+        entry = LruCache.get(self, key, lambda entry: entry[0] == version)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, version, value):
+        """Cache value. Values, which are bigger than the limit, are not cached
+        """
+        LruCache.put(self, key, (version, value))
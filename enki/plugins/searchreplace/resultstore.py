@@ -0,0 +1,130 @@
+"""
+resultstore --- Search results, spilled to the disk
+===================================================
+
+A search may find millions of items. When the results model holds more than Search/MaxResultsInMemory results,
+results of next files are moved to a temporary SQLite database. The model keeps only
+searchresultsmodel.FileResults of such files and loads their results, when a file is expanded in the dock.
+The replace thread loads them file by file.
+
+A result is stored as tuple (wholeLine, line, column, spans, checked) and identified by the file id
+and the start of the match.
+
+The module doesn't depend on Qt
+"""
+
+import array
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+class ResultStore:
+    """Temporary database of search results. Thread safe.
+    The database file is removed, when the store is closed. Methods of the closed store do nothing
+    """
+    def __init__(self):
+        fileHandle, self._path = tempfile.mkstemp(prefix='enki-search-', suffix='.sqlite')
+        os.close(fileHandle)
+
+        self._lock = threading.Lock()
+        self._lastFileId = 0
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = OFF')
+        self._connection.execute('PRAGMA synchronous = OFF')
+        self._connection.execute('CREATE TABLE results (fileId INTEGER, start INTEGER, wholeLine TEXT, '
+                                 'line INTEGER, column INTEGER, spans BLOB, checked INTEGER, '
+                                 'PRIMARY KEY (fileId, start))')
+
+    def close(self):
+        """Close and remove the database
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+            self._connection.close()
+            self._connection = None
+
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def _execute(self, query, parameters=()):
+        """Execute the query and return all rows. Empty list, if the store is closed
+        """
+        with self._lock:
+            if self._connection is None:
+                return []
+            return self._connection.execute(query, parameters).fetchall()
+
+    def addFile(self, results):
+        """Store results of a file. results is iterable of tuples (wholeLine, line, column, spans, checked).
+        Returns id of the file
+        """
+        with self._lock:
+            if self._connection is None:
+                return None
+            self._lastFileId += 1
+            fileId = self._lastFileId
+            self._connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                         ((fileId, spans[0], wholeLine, line, column,
+                                           buffer(spans.tostring()), checked) \
+                                            for wholeLine, line, column, spans, checked in results))
+            return fileId
+
+    def results(self, fileId, checkedOnly=False):
+        """Get list of tuples (wholeLine, line, column, spans, checked) of the file, ordered by position.
+        Lines of results are shared
+        """
+        query = 'SELECT wholeLine, line, column, spans, checked FROM results WHERE fileId = ?'
+        if checkedOnly:
+            query += ' AND checked'
+        query += ' ORDER BY start'
+
+        results = []
+        lastLine = None
+        for wholeLine, line, column, spans, checked in self._execute(query, (fileId,)):
+            if wholeLine == lastLine:
+                wholeLine = lastLine
+            lastLine = wholeLine
+            results.append((wholeLine, line, column, array.array('l', str(spans)), bool(checked)))
+        return results
+
+    def count(self, fileId, checkedOnly=False):
+        """Count of results of the file
+        """
+        query = 'SELECT COUNT(*) FROM results WHERE fileId = ?'
+        if checkedOnly:
+            query += ' AND checked'
+        rows = self._execute(query, (fileId,))
+        return rows[0][0] if rows else 0
+
+    def setChecked(self, fileId, checked, starts=None):
+        """Set checked state of results of the file, or of all files, if fileId is None.
+        starts is list of match starts of the results to change, None for all results of the file
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+            if fileId is None:
+                self._connection.execute('UPDATE results SET checked = ?', (checked,))
+            elif starts is None:
+                self._connection.execute('UPDATE results SET checked = ? WHERE fileId = ?', (checked, fileId))
+            else:
+                self._connection.executemany('UPDATE results SET checked = ? WHERE fileId = ? AND start = ?',
+                                             [(checked, fileId, start) for start in starts])
+
+    def remove(self, fileId, starts=None):
+        """Remove results of the file.
+        starts is list of match starts of the results to remove, None for all results of the file
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+            if starts is None:
+                self._connection.execute('DELETE FROM results WHERE fileId = ?', (fileId,))
+            else:
+                self._connection.executemany('DELETE FROM results WHERE fileId = ? AND start = ?',
+                                             [(fileId, start) for start in starts])
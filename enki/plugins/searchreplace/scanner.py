@@ -0,0 +1,512 @@
+"""
+scanner --- Search in file contents
+===================================
+
+Functions, which do the actual search job.
+The module doesn't depend on Qt, therefore it is used both by the search thread
+and by the worker processes of the search pool
+
+Files, which are not opened in the editor, are not decoded, if possible.
+They are mmap'ed and searched with the pattern, compiled for UTF-8 bytes. See :func:`bytesRegExp`.
+Only lines, which contain matches, are decoded.
+Files, which don't contain literals, required by the pattern, are skipped. See :class:`Pattern`
+
+Several words may be searched in one pass over the files with :class:`MultiPattern`
+"""
+
+import array
+import hashlib
+import heapq
+import itertools
+import mmap
+import operator
+import re
+import sre_constants
+import sre_parse
+
+import lineindex
+import literals
+
+# Pattern of the current search. Set in the worker processes by initWorker()
+_workerPattern = None
+
+_NON_ASCII_BYTE = re.compile('[\x80-\xff]')
+
+_UTF8_CONTINUATION_BYTES = ''.join([chr(code) for code in range(0x80, 0xc0)])
+
+# Escapes, which produce a character by its code. Meaning differs in unicode and bytes patterns
+_NUMERIC_ESCAPE = re.compile(r'\\(x|0|[0-7]{3})')
+
+# Categories, which match only ASCII characters, if re.UNICODE flag is not set
+_ASCII_CATEGORIES = (sre_constants.CATEGORY_DIGIT,
+                     sre_constants.CATEGORY_SPACE,
+                     sre_constants.CATEGORY_WORD)
+
+
+def isBinary(fileObject):
+    """Expects, that file position is 0, when exits, file position is 0
+    """
+    binary = '\0' in fileObject.read( 4096 )
+    fileObject.seek(0)
+    return binary
+
+
+def readFile(fileName):
+    """Read text from file. Returns empty string for binary files and None for not readable files.
+    The error is not reported here. The search reads not indexed files again and reports it
+    """
+    try:
+        with open(fileName, 'rb') as openedFile:
+            if isBinary(openedFile):
+                return ''
+            return unicode(openedFile.read(), 'utf8', errors = 'ignore')
+    except IOError:
+        return None
+
+
+class SpanMatch:
+    """Match-like object, made of group spans, captured by the search, and the text, which was searched.
+
+    spans is array (start0, end0, start1, end1, ...) of the whole match and all groups.
+    Not participating groups have span (-1, -1).
+    The class implements the part of the match object API, used by the plugin
+    """
+    def __init__(self, text, spans):
+        self._text = text
+        self._spans = spans
+
+    def start(self, index=0):
+        """Start of the group
+        """
+        return self._spans[index * 2]
+
+    def end(self, index=0):
+        """End of the group
+        """
+        return self._spans[index * 2 + 1]
+
+    def group(self, index=0):
+        """Captured group. Raises IndexError, if no such group
+        """
+        if index < 0 or index * 2 >= len(self._spans):
+            raise IndexError('no such group')
+        start, end = self._spans[index * 2], self._spans[index * 2 + 1]
+        if start == -1:
+            return None
+        return self._text[start:end]
+
+    def groups(self):
+        """All captured groups, except the whole match
+        """
+        return tuple([self.group(index) for index in range(1, len(self._spans) // 2)])
+
+
+def _isBytesSafe(items):
+    """Check if parsed pattern items match the same text in unicode string and in UTF-8 bytes.
+
+    Bytes of multibyte UTF-8 characters are never equal to ASCII characters. Therefore ASCII
+    literals, character classes and categories don't match a part of a character.
+    Any character, negated literals and classes match a single byte and are not safe
+    """
+    for op, av in items:
+        if op in (sre_constants.LITERAL, sre_constants.AT, sre_constants.GROUPREF):
+            pass
+        elif op == sre_constants.IN:
+            for itemOp, itemAv in av:
+                if itemOp == sre_constants.LITERAL and itemAv < 128:
+                    pass
+                elif itemOp == sre_constants.RANGE and itemAv[1] < 128:
+                    pass
+                elif itemOp == sre_constants.CATEGORY and itemAv in _ASCII_CATEGORIES:
+                    pass
+                else:
+                    return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _isBytesSafe(av[-1]):
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            body = av[2]
+            # Repeat applies to the last byte of a not grouped multibyte character
+            if len(body) == 1 and body[0][0] == sre_constants.LITERAL and body[0][1] >= 128:
+                return False
+            if not _isBytesSafe(body):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all([_isBytesSafe(branch) for branch in av[1]]):
+                return False
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if not _isBytesSafe(av[1]):
+                return False
+        else:
+            return False
+
+    return True
+
+
+def bytesRegExp(regExp):
+    """Compile the regular expression for search in UTF-8 encoded bytes.
+
+    Returns None, if bytes version could match other text, than the original regular expression.
+    In this case text must be decoded and searched with the original one
+    """
+    if regExp.flags & (re.UNICODE | re.LOCALE):
+        return None
+
+    pattern = regExp.pattern
+    if isinstance(pattern, unicode):
+        if _NUMERIC_ESCAPE.search(pattern):
+            return None
+        pattern = pattern.encode('utf8')
+
+    try:
+        if not _isBytesSafe(sre_parse.parse(regExp.pattern, regExp.flags)):
+            return None
+        return re.compile(pattern, regExp.flags)
+    except (sre_constants.error, RuntimeError):  # RuntimeError - too deep recursion
+        return None
+
+
+def _charCount(data):
+    """Count of characters in UTF-8 bytes
+    """
+    return len(data.translate(None, _UTF8_CONTINUATION_BYTES))
+
+
+def _charPos(data, knownPos, knownCharPos, pos):
+    """Convert position in UTF-8 bytes to position in characters,
+    if character position of knownPos is knownCharPos
+    """
+    if pos >= knownPos:
+        return knownCharPos + _charCount(data[knownPos:pos])
+    else:
+        return knownCharPos - _charCount(data[pos:knownPos])
+
+
+class Pattern:
+    """Search pattern, prepared for the search. Picklable, sent to the worker processes.
+
+    Files, which don't contain the literals, required by the regular expression (see :mod:`literals`),
+    are rejected with fast ``find()`` before decoding and running the regular expression.
+    If the pattern is a plain string, the regular expression engine is not used at all.
+    Literals are not used, if the case is ignored
+    """
+    def __init__(self, regExp):
+        self.regExp = regExp
+        self.bytesRegExp = bytesRegExp(regExp)
+
+        if regExp.flags & re.IGNORECASE:
+            self._literals = []
+            self._literal = None
+        else:
+            self._literals = literals.requiredLiterals(regExp)
+            self._literal = literals.pureLiteral(regExp) or None
+        self._bytesLiterals = [literal.encode('utf8') for literal in self._literals]
+        self._bytesLiteral = self._literal.encode('utf8') if self._literal is not None else None
+
+    def canSearchBytes(self):
+        """Check if UTF-8 bytes may be searched without decoding
+        """
+        return self._literal is not None or self.bytesRegExp is not None
+
+    def mayMatch(self, text):
+        """Check if the unicode text contains the required literals
+        """
+        return all(text.find(literal) != -1 for literal in self._literals)
+
+    def mayMatchBytes(self, data):
+        """Check if UTF-8 bytes contain the required literals
+        """
+        return all(data.find(literal) != -1 for literal in self._bytesLiterals)
+
+    def regs(self, text, pos=0):
+        """Iterator of spans of the match and the groups ((start, end), (start1, end1), ...)
+        of all matches in the unicode text, starting from pos
+        """
+        if self._literal is not None:
+            return _literalRegs(self._literal, text, pos)
+        else:
+            return _regExpRegs(self.regExp, text, pos)
+
+    def bytesRegs(self, data, pos=0):
+        """Like regs(), but for UTF-8 bytes. Positions are in bytes. canSearchBytes() must be True
+        """
+        if self._bytesLiteral is not None:
+            return _literalRegs(self._bytesLiteral, data, pos)
+        else:
+            return _regExpRegs(self.bytesRegExp, data, pos)
+
+
+_getRegs = operator.attrgetter('regs')
+
+
+def _regExpRegs(regExp, text, pos):
+    """Spans of all matches of the regular expression
+    """
+    return itertools.imap(_getRegs, regExp.finditer(text, pos))
+
+
+def _literalRegs(literal, text, pos):
+    """Spans of all not overlapping occurrences of the literal. Works like finditer() for escaped literal
+    """
+    find = text.find
+    length = len(literal)
+    pos = find(literal, pos)
+    while pos != -1:
+        yield ((pos, pos + length),)
+        pos = find(literal, pos + length)
+
+
+class MultiPattern:
+    """Several patterns, searched in one pass over the files. Used to search for a list of words.
+
+    patterns is a list of tuples (name, regExp). The interface is the same as of :class:`Pattern`.
+    Every file is read and decoded once. Matches of all the patterns are merged by position.
+    Overlapping matches are dropped, the leftmost and then the longest one wins, as for alternation
+    in a regular expression. Therefore the results may be replaced
+    """
+    def __init__(self, patterns):
+        self.names = [name for name, regExp in patterns]
+        self.patterns = [Pattern(regExp) for name, regExp in patterns]
+        self._indexes = {}  # matched text: index of the pattern
+
+    def canSearchBytes(self):
+        """Check if UTF-8 bytes may be searched without decoding
+        """
+        return all(pattern.canSearchBytes() for pattern in self.patterns)
+
+    def mayMatch(self, text):
+        """Check if the unicode text contains the literals, required by any of the patterns
+        """
+        return any(pattern.mayMatch(text) for pattern in self.patterns)
+
+    def mayMatchBytes(self, data):
+        """Check if UTF-8 bytes contain the literals, required by any of the patterns
+        """
+        return any(pattern.mayMatchBytes(data) for pattern in self.patterns)
+
+    def regs(self, text, pos=0):
+        """Iterator of spans of matches of all the patterns in the unicode text, see Pattern.regs()
+        """
+        return _mergedRegs([pattern.regs(text, pos) for pattern in self.patterns])
+
+    def bytesRegs(self, data, pos=0):
+        """Like regs(), but for UTF-8 bytes. Positions are in bytes. canSearchBytes() must be True
+        """
+        return _mergedRegs([pattern.bytesRegs(data, pos) for pattern in self.patterns])
+
+    def patternIndex(self, matchedText):
+        """Get index of the pattern, which has found the match.
+        The patterns are words, therefore the matched text identifies the pattern
+        """
+        index = self._indexes.get(matchedText)
+        if index is None:
+            index = 0
+            for patternIndex, pattern in enumerate(self.patterns):
+                match = pattern.regExp.match(matchedText)
+                if match is not None and match.end() == len(matchedText):
+                    index = patternIndex
+                    break
+            self._indexes[matchedText] = index
+        return index
+
+
+def _mergedRegs(allRegs):
+    """Merge iterators of spans of matches of several patterns by position.
+    Drop matches, which overlap previous ones. Of matches with the same start the longest is kept
+    """
+    keyed = [itertools.imap(lambda regs: (regs[0][0], -regs[0][1], regs), patternRegs) \
+                for patternRegs in allRegs]
+    lastStart = lastEnd = -1
+    for start, negativeEnd, regs in heapq.merge(*keyed):
+        if start >= lastEnd and start != lastStart:
+            lastStart, lastEnd = start, -negativeEnd
+            yield regs
+
+
+def _searchInBytes(pattern, data, mustStop=None):
+    """Search in UTF-8 bytes. pattern.canSearchBytes() must be True.
+    Returns the same results, as searchInText() for the decoded text
+    """
+    firstRegs = next(pattern.bytesRegs(data), None)
+    if firstRegs is None:
+        return []
+
+    # Something found. Slicing and searching str is faster, than mmap, and it takes less memory, than unicode
+    data = data[:]
+    allRegs = pattern.bytesRegs(data, firstRegs[0][0])
+
+    # Check it only if something found. The check is slower, than the search
+    if _NON_ASCII_BYTE.search(data) is None:  # positions in bytes and in characters are equal
+        return _searchInText(data, allRegs, mustStop, 'ascii')
+
+    lineIndex = lineindex.LineIndex(data)
+    results = []
+
+    # Last found line. Matches on the same line share it
+    lineStart = lineEnd = rangeEnd = -1
+    lineCharStart = 0  # position of lineStart in characters
+    line = 0
+    wholeLine = lineIsAscii = None
+
+    for regs in allRegs:
+        start, end = regs[0]
+
+        # Empty match may be found inside a multibyte character. Text search wouldn't find it
+        if start == end and start < len(data) and '\x80' <= data[start] <= '\xbf':
+            continue
+
+        if start < lineStart or end > lineEnd:
+            line = lineIndex.line(start, line)
+            endLine = lineIndex.line(end, line)
+            newLineStart = lineIndex.lineStart(line)
+            if newLineStart >= lineStart:
+                lineCharStart += _charCount(data[max(lineStart, 0):newLineStart])
+            else:
+                lineCharStart = _charCount(data[:newLineStart])
+            lineStart = newLineStart
+            lineEnd = rangeEnd = lineIndex.lineEnd(endLine)
+            wholeLine = data[lineStart:lineEnd].decode('utf8', 'ignore')
+            lineIsAscii = len(wholeLine) == lineEnd - lineStart
+            if endLine != line:  # multiline match. Next match can't share the line
+                lineEnd = -1
+
+        if lineIsAscii:
+            column = start - lineStart
+        else:
+            column = _charCount(data[lineStart:start])
+        charPos = lineCharStart + column
+
+        spans = array.array('l')
+        for groupStart, groupEnd in regs:
+            if groupStart == -1:
+                spans.extend((-1, -1))
+            elif lineIsAscii and groupStart >= lineStart and groupEnd <= rangeEnd:
+                spans.extend((charPos + groupStart - start, charPos + groupEnd - start))
+            else:
+                spans.append(_charPos(data, start, charPos, groupStart))
+                spans.append(_charPos(data, start, charPos, groupEnd))
+
+        results.append((wholeLine, line, column, spans))
+
+        if mustStop is not None and mustStop():
+            break
+    return results
+
+
+def searchInFile(pattern, fileName, mustStop=None):
+    """Search in the file. pattern is Pattern.
+    The file is mmap'ed. Files, which don't contain required literals, are not decoded.
+    Others are not decoded too, if the pattern allows it.
+
+    Returns tuple (results, contentHash). results is list of tuples (wholeLine, line, column, spans).
+    Binary files have no results. contentHash is contentHash() of the file,
+    which has been searched, or None, if nothing found.
+    Raises EnvironmentError, if the file is not readable
+    """
+    with open(fileName, 'rb') as openedFile:
+        try:
+            data = mmap.mmap(openedFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file can't be mapped
+            return [], None
+
+        try:
+            if '\0' in data[:4096]:  # binary
+                results = []
+            elif not pattern.mayMatchBytes(data):
+                results = []
+            elif pattern.canSearchBytes():
+                results = _searchInBytes(pattern, data, mustStop)
+            else:
+                content = data[:].decode('utf8', 'ignore')
+                results = _searchInText(content, pattern.regs(content), mustStop)
+
+            if results:
+                return results, contentHash(data)
+            else:
+                return results, None
+        finally:
+            data.close()
+
+
+def contentHash(data):
+    """Hash of the file contents. Used to check, if the file has been changed after the search.
+    data is bytes or mmap
+    """
+    return hashlib.md5(data).hexdigest()
+
+
+def searchInText(pattern, content, mustStop=None):
+    """Search in the text. pattern is Pattern.
+    Returns list of tuples (wholeLine, line, column, spans). See SpanMatch for the spans format.
+    The results don't reference the text, matches on the same line share wholeLine.
+
+    mustStop is callable, which is checked after every match. Search is interrupted, if it returns True
+    """
+    if not pattern.mayMatch(content):
+        return []
+    return _searchInText(content, pattern.regs(content), mustStop)
+
+
+def _searchInText(content, allRegs, mustStop, encoding=None):
+    """searchInText() implementation. allRegs is iterable of spans of matches, see Pattern.regs().
+    If encoding is set, content is bytes and lines are decoded
+    """
+    lineIndex = lineindex.LineIndex(content)
+    results = []
+
+    # Last found line. Matches on the same line share it
+    lineStart = lineEnd = -1
+    line = 0
+    wholeLine = None
+
+    # Process result for all occurrences
+    for regs in allRegs:
+        start, end = regs[0]
+
+        if start < lineStart or end > lineEnd:
+            line = lineIndex.line(start, line)
+            endLine = lineIndex.line(end, line)
+            lineStart = lineIndex.lineStart(line)
+            lineEnd = lineIndex.lineEnd(endLine)
+            wholeLine = content[lineStart:lineEnd]
+            if encoding is not None:
+                wholeLine = wholeLine.decode(encoding)
+            if endLine != line:  # multiline match. Next match can't share the line
+                lineEnd = -1
+
+        results.append((wholeLine, line, start - lineStart,
+                        array.array('l', [pos for span in regs for pos in span])))
+
+        if mustStop is not None and mustStop():
+            break
+    return results
+
+
+def initWorker(pattern):
+    """Worker process initializer. Remembers the (pickled) Pattern of the search
+    """
+    global _workerPattern  # pylint: disable=W0603
+    _workerPattern = pattern
+
+
+def searchInFiles(files):
+    """Worker process entry point. Search in a batch of files.
+
+    files is list of tuples (fileName, content). content is None, if the file shall be read from the disk
+
+    Returns list of tuples (fileName, results, contentHash, error) for files, which contain matches
+    or are not readable. contentHash is None for opened files. error is None, if the file has been read
+    """
+    found = []
+    for fileName, content in files:
+        if content is None:
+            try:
+                results, fileHash = searchInFile(_workerPattern, fileName)
+            except EnvironmentError as ex:
+                found.append((fileName, [], None, "Error opening file: %s" % ex))
+                continue
+        else:
+            results, fileHash = searchInText(_workerPattern, content), None
+        if results:
+            found.append((fileName, results, fileHash, None))
+    return found
@@ -2,12 +2,13 @@
 searchresultsdock --- Search results dock widget
 ================================================
 
-Shows results with SearchResultsModel
+Shows results with SearchResultsModel.
+Results may be refined with a regular expression for lines and a mask for paths
 """
 
 from PyQt4.QtCore import Qt, pyqtSignal, QModelIndex
-from PyQt4.QtGui import QFontMetrics, QHBoxLayout, QIcon, \
-                        QTreeView, QWidget, QPushButton
+from PyQt4.QtGui import QFontMetrics, QHBoxLayout, QIcon, QLineEdit, \
+                        QTreeView, QVBoxLayout, QWidget, QPushButton
 from enki.widgets.dockwidget import DockWidget
 from enki.core.core import core
 from enki.lib.htmldelegate import HTMLDelegate
@@ -125,6 +126,13 @@ class SearchResultsDock(DockWidget):
 
     onResultsHandledByReplaceThread = pyqtSignal(str, list)
 
+    refineRequested = pyqtSignal(unicode, list)
+    """
+    refineRequested(lineRegExpText, mask)
+
+    **Signal** emitted, when user requested to filter the shown results
+    """  # pylint: disable=W0105
+
     def __init__(self, parent):
         DockWidget.__init__( self, parent, "&Search Results", QIcon(":/enkiicons/search.png"), "Alt+S")
 
@@ -141,9 +149,22 @@ class SearchResultsDock(DockWidget):
         self._delegate = HTMLDelegate()
         self._view.setItemDelegate(self._delegate)
 
-        self._layout = QHBoxLayout( widget )
+        self._leRefineLine = QLineEdit( self )
+        self._leRefineLine.setPlaceholderText("Refine: line contains regular expression")
+        self._leRefineMask = QLineEdit( self )
+        self._leRefineMask.setPlaceholderText("Refine: path mask, i.e. src/* *.py")
+        self._leRefineLine.returnPressed.connect(self._onRefineReturnPressed)
+        self._leRefineMask.returnPressed.connect(self._onRefineReturnPressed)
+
+        refineLayout = QHBoxLayout()
+        refineLayout.setSpacing( 5 )
+        refineLayout.addWidget( self._leRefineLine )
+        refineLayout.addWidget( self._leRefineMask )
+
+        self._layout = QVBoxLayout( widget )
         self._layout.setMargin( 5 )
         self._layout.setSpacing( 5 )
+        self._layout.addLayout( refineLayout )
         self._layout.addWidget( self._view )
 
         self.setWidget( widget )
@@ -152,6 +173,7 @@ class SearchResultsDock(DockWidget):
         # connections
         self._model.firstResultsAvailable.connect(self.show)
         self._view.activated.connect(self._onResultActivated)
+        self._view.collapsed.connect(self._model.unloadResults)
 
         core.actionManager().addAction("mView/aSearchResults", self.showAction())
 
@@ -166,37 +188,52 @@ class SearchResultsDock(DockWidget):
         """
         result = index.internalPointer()
         if isinstance(result, searchresultsmodel.Result):
-            fileResults = index.parent().internalPointer()
+            fileResults = result.fileResults
             core.workspace().goTo( result.fileName,
                                    line=result.line,
                                    column=result.column,
-                                   selectionLength=len(result.match.group(0)))
+                                   selectionLength=result.length())
             core.mainWindow().statusBar().showMessage('Match %d of %d' % \
-                                                      (fileResults.results.index(result) + 1,
-                                                       len(fileResults.results)), 3000)
+                                                      (index.row() + 1,
+                                                       fileResults.count()), 3000)
             self.setFocus()
 
+    def _onRefineReturnPressed(self):
+        """Enter pressed in a refine line edit. Request filtering of the results
+        """
+        mask = filter(None, [wildcard.strip() for wildcard in self._leRefineMask.text().split(' ')])
+        lineRegExpText = self._leRefineLine.text()
+        if lineRegExpText or mask:
+            self.refineRequested.emit(lineRegExpText, mask)
+
     def clear(self):
         """Clear themselves
         """
         self._model.clear()
 
+    def resultsSnapshot(self):
+        """Get shown results as list of tuples (FileResults, list of its results or None) for the refine thread.
+        Lists are copied, because the model changes them, while the thread works.
+        None means, that the results are spilled and not loaded, the thread loads them from the store
+        """
+        return [(fileRes, list(fileRes.results) if fileRes.isLoaded() else None) \
+                    for fileRes in self._model.fileResults]
+
     def appendResults(self, fileResultList):
         """Append results. Handler for signal from the search thread
         """
         self._model.appendResults(fileResultList)
 
     def getCheckedItems(self):
-        """Get items, which must be replaced, as dictionary {file name : list of items}
+        """Get items, which must be replaced, as dictionary {file name : list of FileResults}.
+        Checked results of the FileResults must be replaced. They are taken with FileResults.checkedResults(),
+        therefore spilled results are loaded file by file
         """
         items = {}
 
         for fileRes in self._model.fileResults:
-            for row, result in enumerate(fileRes.results):
-                if result.checkState == Qt.Checked :
-                    if not result.fileName in items:
-                        items[result.fileName] = []
-                    items[ result.fileName ].append(result)
+            if fileRes.checkState != Qt.Unchecked:
+                items.setdefault(fileRes.fileName, []).append(fileRes)
         return items
 
     def setReplaceMode(self, enabled):
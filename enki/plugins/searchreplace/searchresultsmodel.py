@@ -1,33 +1,77 @@
 """
 searchresultsmodel --- Model for search results
 ===============================================
+
+If there are too many results, results of the last files are spilled to resultstore.ResultStore
+and loaded on request, see SearchResultsModel.fetchMore()
 """
 
+import bisect
+
 from PyQt4.QtCore import pyqtSignal, QAbstractItemModel, \
                          QDir, \
                          QModelIndex, Qt
 
 from PyQt4.QtGui import QApplication
 
+from enki.core.core import core
 from enki.lib.htmldelegate import htmlEscape
 
+import scanner
+import resultstore
+
 
-class Result:  # pylint: disable=R0902
+class Result(object):  # pylint: disable=R0902
     """One found by search thread item. Consists coordinates and capture. Used by SearchResultsModel
+
+    Search may find millions of items, therefore the item is compact. It doesn't keep the match object
+    and the file contents. Spans of the match and the groups are captured in the array
+    (start0, end0, start1, end1, ...), see scanner.SpanMatch. fileName and wholeLine
+    objects are shared by all items of the file and of the line.
+
+    fileResults is the parent FileResults. Set, when the item is added to it
     """
-    def __init__ (self, fileName, wholeLine, line, column, match):  # pylint: disable=R0913
+    __slots__ = ('fileName', 'wholeLine', 'line', 'column', 'spans', 'checkState', 'fileResults')
+
+    def __init__ (self, fileName, wholeLine, line, column, spans):  # pylint: disable=R0913
         self.fileName = fileName
         self.wholeLine = wholeLine
         self.line = line
         self.column = column
-        self.match = match
+        self.spans = spans
         self.checkState = Qt.Checked
+        self.fileResults = None
+
+    def start(self):
+        """Position of the match in the file
+        """
+        return self.spans[0]
+
+    def end(self):
+        """Position of the end of the match in the file
+        """
+        return self.spans[1]
+
+    def length(self):
+        """Length of the match
+        """
+        return self.spans[1] - self.spans[0]
+
+    def matchedText(self):
+        """Text of the match
+        """
+        return self.wholeLine[self.column:self.column + self.length()]
+
+    def matchIn(self, content):
+        """Match-like object for the file content, which was searched. Used for substitutions
+        """
+        return scanner.SpanMatch(content, self.spans)
 
     def text(self):  # pylint: disable=W0613
         """Displayable text of search result. Shown as line in the search results dock
         """
         beforeMatch = self.wholeLine[:self.column].lstrip()
-        afterMatch = self.wholeLine[self.column + len(self.match.group(0)):].rstrip()
+        afterMatch = self.wholeLine[self.column + self.length():].rstrip()
 
         if QApplication.instance().palette().base().color().lightnessF() > 0.5:
             backgroundColor = 'yellow'
@@ -46,7 +90,7 @@ class Result:  # pylint: disable=R0902
                   htmlEscape(beforeMatch),
                   backgroundColor,
                   foregroundColor,
-                  htmlEscape(self.match.group(0)),
+                  htmlEscape(self.matchedText()),
                   htmlEscape(afterMatch))
 
     def tooltip(self):
@@ -60,25 +104,99 @@ class Result:  # pylint: disable=R0902
 
 class FileResults:
     """Object stores all items, found in the file
+
+    row is the row in the SearchResultsModel, when the rows have been numbered. The model doesn't
+    renumber the rows after a removal, but corrects them, see SearchResultsModel._row()
+
+    If several patterns are searched at once, the object stores items of one pattern.
+    pattern is the displayed pattern and patternIndex is its index in the list of the patterns.
+    The model keeps items of every pattern together, ordered by patternIndex
+
+    contentHash is scanner.contentHash() of the searched content. Files, which have been changed
+    after the search, are not replaced
+
+    Results may be spilled to resultstore.ResultStore. In this case results list is empty, until
+    the model loads the results, see isLoaded()
     """
-    def __init__(self, baseDir, fileName, results):
+    def __init__(self, baseDir, fileName, results, pattern=None, patternIndex=0,  # pylint: disable=R0913
+                 contentHash=None):
         self.baseDir = baseDir
         self.fileName = fileName
         self.results = results
+        self.pattern = pattern
+        self.patternIndex = patternIndex
+        self.contentHash = contentHash
         self.checkState = Qt.Checked
+        self.row = -1
+        self.store = None  # resultstore.ResultStore, if the results are spilled
+        self.storeId = None
+        self.storedCount = 0  # count of results in the store
+        for result in results:
+            result.fileResults = self
 
     def __str__(self):
         """Convertor to string. Used for debugging
         """
-        return '%s (%d)' % (self.fileName, len(self.results))
+        return '%s (%d)' % (self.fileName, self.count())
+
+    def count(self):
+        """Count of results, including not loaded ones
+        """
+        if self.store is not None:
+            return self.storedCount
+        else:
+            return len(self.results)
+
+    def isLoaded(self):
+        """Check if the results are in the results list
+        """
+        return self.store is None or len(self.results) != 0
+
+    def spill(self, store):
+        """Move the results to the store
+        """
+        self.store = store
+        self.storeId = store.addFile((result.wholeLine, result.line, result.column, result.spans,
+                                      result.checkState == Qt.Checked) \
+                                        for result in self.results)
+        self.storedCount = len(self.results)
+        self.results = []
+
+    def loadResults(self, checkedOnly=False):
+        """Load results from the store. Returns list of new Result objects, the results list is not changed.
+        May be called from any thread
+        """
+        results = []
+        for wholeLine, line, column, spans, checked in self.store.results(self.storeId, checkedOnly):
+            result = Result(self.fileName, wholeLine, line, column, spans)
+            result.checkState = Qt.Checked if checked else Qt.Unchecked
+            result.fileResults = self
+            results.append(result)
+        return results
+
+    def checkedResults(self):
+        """Get list of checked results. Not loaded results are read from the store.
+        May be called from any thread
+        """
+        if self.isLoaded():
+            return [result for result in self.results if result.checkState == Qt.Checked]
+        else:
+            return self.loadResults(checkedOnly=True)
 
     def updateCheckState(self):
         """Update own checked state after checked state of child result changed or
         child result removed
         """
-        if all([res.checkState == Qt.Checked for res in self.results]):  # if all checked
+        if self.isLoaded():
+            checkedCount = len([res for res in self.results if res.checkState == Qt.Checked])
+            count = len(self.results)
+        else:
+            checkedCount = self.store.count(self.storeId, checkedOnly=True)
+            count = self.storedCount
+
+        if checkedCount == count:  # if all checked
             self.checkState = Qt.Checked
-        elif any([res.checkState == Qt.Checked for res in self.results]):  # if any checked
+        elif checkedCount:  # if any checked
             self.checkState = Qt.PartiallyChecked
         else:
             self.checkState = Qt.Unchecked
@@ -87,7 +205,10 @@ class FileResults:
         """Displayable text of the file results. Shown as line in the search results dock
         baseDir is base directory of current search operation
         """
-        return '%s (%d)' % (QDir(self.baseDir).relativeFilePath(self.fileName), len(self.results))
+        text = '%s (%d)' % (QDir(self.baseDir).relativeFilePath(self.fileName), self.count())
+        if self.pattern is not None:
+            text = '<b>%s</b>: %s' % (htmlEscape(self.pattern), text)
+        return text
 
     def tooltip(self):
         """Tooltip of the item in the results dock
@@ -97,11 +218,16 @@ class FileResults:
     def hasChildren(self):
         """Check if item has children
         """
-        return 0 != len(self.results)
+        return 0 != self.count()
 
 
 class SearchResultsModel(QAbstractItemModel):
     """AbstractItemodel used for display search results in 'Search in directory' and 'Replace in directory' mode
+
+    When the model holds Search/MaxResultsInMemory results, results of next files are spilled to
+    resultstore.ResultStore. The view loads them with fetchMore(), when a file is expanded.
+    unloadResults() frees memory, when it is collapsed. Checked states of spilled results are written
+    to the store immediately
     """
     firstResultsAvailable = pyqtSignal()
 
@@ -112,6 +238,12 @@ class SearchResultsModel(QAbstractItemModel):
         self._replaceMode = False
 
         self.fileResults = []  # list of FileResults
+        # Sorted list of FileResults.row of the items, removed after the rows have been numbered.
+        # Renumbering after every removal is too expensive, see _row()
+        self._removedRows = []
+        self._patternRowsCount = {}  # patternIndex: count of FileResults of the pattern, if grouped by pattern
+        self._store = None  # resultstore.ResultStore. Created, when results are spilled first time
+        self._inMemoryCount = 0  # count of not spilled results
 
     def setReplaceMode(self, enabled):
         """When replace mode is enabled, all items are checkState
@@ -144,12 +276,22 @@ class SearchResultsModel(QAbstractItemModel):
         if not isinstance(index.internalPointer(), Result):  # it is an top level item
             return QModelIndex()
 
-        result = index.internalPointer()
+        fileRes = index.internalPointer().fileResults
+        return self.createIndex(self._row(fileRes), 0, fileRes)
+
+    def _row(self, fileRes):
+        """Get row of the FileResults.
+        The row is shifted by the count of the items, which have been removed before it.
+        The cost doesn't depend on the order of removals
+        """
+        return fileRes.row - bisect.bisect_left(self._removedRows, fileRes.row)
+
+    def _renumber(self):
+        """Number the rows of all items
+        """
         for row, fileRes in enumerate(self.fileResults):
-            if fileRes.fileName == result.fileName:
-                return self.createIndex(row, 0, fileRes)
-        else:
-            assert(0)
+            fileRes.row = row
+        self._removedRows = []
 
     def hasChildren(self, item):
         """See QAbstractItemModel docs
@@ -214,11 +356,14 @@ class SearchResultsModel(QAbstractItemModel):
         if isinstance(index.internalPointer(), Result):  # it is a Result
             if role == Qt.CheckStateRole:
                 # update own state
-                index.internalPointer().checkState = value
+                result = index.internalPointer()
+                result.checkState = value
                 self.dataChanged.emit( index, index )  # own checked state changed
                 # update parent state
                 fileRes = index.parent().internalPointer()
                 assert(isinstance(fileRes, FileResults))
+                if fileRes.store is not None:
+                    fileRes.store.setChecked(fileRes.storeId, value == Qt.Checked, [result.start()])
                 fileRes.updateCheckState()
                 self.dataChanged.emit(index.parent(), index.parent())  # parent checked state might be changed
         elif isinstance(index.internalPointer(), FileResults):  # it is a FileResults
@@ -227,6 +372,11 @@ class SearchResultsModel(QAbstractItemModel):
                 fileRes.checkState = value
                 for res in fileRes.results:
                     res.checkState = value
+                if fileRes.store is not None:
+                    fileRes.store.setChecked(fileRes.storeId, value == Qt.Checked)
+                self.dataChanged.emit(index, index)
+                if not fileRes.results:
+                    return True
                 firstChildIndex = self.index(0, 0, index)
                 lastChildIndex = self.index(len(fileRes.results) - 1, 0, index)
                 self.dataChanged.emit(firstChildIndex, lastChildIndex)
@@ -241,6 +391,8 @@ class SearchResultsModel(QAbstractItemModel):
             fileRes.checkState = state
             for match in fileRes.results:
                 match.checkState = state
+        if self._store is not None:
+            self._store.setChecked(None, state == Qt.Checked)
         self.dataChanged.emit(self.createIndex(0, 0, self.fileResults[0]),
                               self.createIndex(len(self.fileResults) - 1, 0, self.fileResults[-1]))
 
@@ -256,50 +408,166 @@ class SearchResultsModel(QAbstractItemModel):
         """
         self.beginRemoveRows(QModelIndex(), 0, len(self.fileResults) - 1)
         self.fileResults = []
+        self._removedRows = []
+        self._patternRowsCount = {}
+        self._inMemoryCount = 0
+        if self._store is not None:
+            self._store.close()
+            self._store = None
         self.endRemoveRows()
 
     def appendResults(self, fileResultList ):
         """Handler of signal from the search thread.
-        New result is available, add it to the model
+        New result is available, add it to the model.
+        Results of several patterns are inserted to the end of the group of the pattern
         """
+        if not fileResultList:
+            return
         if not self.fileResults:  # appending first
             self.firstResultsAvailable.emit()
-        self.beginInsertRows( QModelIndex(), \
-                              len(self.fileResults), \
-                              len(self.fileResults) + len(fileResultList) - 1)
-        self.fileResults.extend(fileResultList)
+
+        self._spillIfTooMany(fileResultList)
+
+        if fileResultList[0].pattern is None:
+            self._insertFileResults(len(self.fileResults), fileResultList)
+            return
+
+        fileResultsByPattern = {}
+        for fileRes in fileResultList:
+            fileResultsByPattern.setdefault(fileRes.patternIndex, []).append(fileRes)
+
+        for patternIndex, patternFileResults in sorted(fileResultsByPattern.items()):
+            row = sum([count for index, count in self._patternRowsCount.iteritems() \
+                            if index <= patternIndex])
+            self._insertFileResults(row, patternFileResults)
+            self._patternRowsCount[patternIndex] = self._patternRowsCount.get(patternIndex, 0) + \
+                                                   len(patternFileResults)
+
+    def _spillIfTooMany(self, fileResultList):
+        """Spill results of the files to the store, if the model holds too many results
+        """
+        maxCount = core.config()['Search']['MaxResultsInMemory']
+        for fileRes in fileResultList:
+            if fileRes.store is not None:
+                continue
+            elif self._inMemoryCount + len(fileRes.results) <= maxCount:
+                self._inMemoryCount += len(fileRes.results)
+            else:
+                if self._store is None:
+                    self._store = resultstore.ResultStore()
+                fileRes.spill(self._store)
+
+    def canFetchMore(self, parent):
+        """See QAbstractItemModel docs. Results of spilled files are loaded on request
+        """
+        return parent.isValid() and \
+               isinstance(parent.internalPointer(), FileResults) and \
+               not parent.internalPointer().isLoaded()
+
+    def fetchMore(self, parent):
+        """See QAbstractItemModel docs. Load results of a spilled file from the store
+        """
+        fileRes = parent.internalPointer()
+        results = fileRes.loadResults()
+        if results:
+            self.beginInsertRows(parent, 0, len(results) - 1)
+            fileRes.results = results
+            self.endInsertRows()
+
+    def unloadResults(self, index):
+        """Free memory, used by loaded results of a spilled file. Called, when the file is collapsed
+        """
+        fileRes = index.internalPointer()
+        if not isinstance(fileRes, FileResults) or \
+           fileRes.store is None or \
+           not fileRes.results:
+            return
+
+        self.beginRemoveRows(index, 0, len(fileRes.results) - 1)
+        fileRes.results = []
+        self.endRemoveRows()
+
+    def _insertFileResults(self, row, fileResultList):
+        """Insert list of FileResults to the model
+        """
+        self.beginInsertRows(QModelIndex(), row, row + len(fileResultList) - 1)
+        if row == len(self.fileResults):  # appending. Rows of the removed items precede the new ones
+            for fileResRow, fileRes in enumerate(fileResultList, row + len(self._removedRows)):
+                fileRes.row = fileResRow
+            self.fileResults.extend(fileResultList)
+        else:
+            self.fileResults[row:row] = fileResultList
+            self._renumber()
         self.endInsertRows()
 
-    def onResultsHandledByReplaceThread(self, fileName, results):
-        """Replace thread has processed result, need to it from the model
+    def _removeFileResults(self, fileRes):
+        """Remove FileResults from the model
+        """
+        row = self._row(fileRes)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.fileResults[row]
+        bisect.insort(self._removedRows, fileRes.row)
+        if fileRes.pattern is not None:
+            self._patternRowsCount[fileRes.patternIndex] -= 1
+        if fileRes.store is not None:
+            fileRes.store.remove(fileRes.storeId)
+        else:
+            self._inMemoryCount -= len(fileRes.results)
+        self.endRemoveRows()
+
+    def onResultsHandledByReplaceThread(self, fileName, results):  # pylint: disable=W0613
+        """Replace thread has processed result, need to it from the model.
+        Results of the file may belong to several FileResults, if several patterns have been searched
+        """
+        resultsByFileRes = {}
+        for result in results:
+            resultsByFileRes.setdefault(id(result.fileResults), []).append(result)
+
+        for fileResResults in resultsByFileRes.itervalues():
+            self._removeResults(fileResResults[0].fileResults, fileResResults)
+
+    def _removeResults(self, fileRes, results):
+        """Remove results of the FileResults from the model.
+        Results are removed by contiguous ranges of rows.
+        Results of a spilled file are removed from the store, and from the rows, if loaded
         """
-        for index, fileRes in enumerate(self.fileResults):  # try to find FileResults
-            if fileRes.fileName == fileName:  # found
-                fileResIndex = self.createIndex(index, 0, fileRes)
-                if len(results) == len(fileRes.results):  # removing all
-                    self.beginRemoveRows(QModelIndex(), index, index)
-                    self.fileResults.pop(index)
-                    self.endRemoveRows()
+        if len(results) == fileRes.count():  # removing all
+            self._removeFileResults(fileRes)
+            return
+
+        if fileRes.store is not None:
+            fileRes.store.remove(fileRes.storeId, [result.start() for result in results])
+            fileRes.storedCount -= len(results)
+        else:
+            self._inMemoryCount -= len(results)
+
+        # Results, loaded from the store, are not the loaded rows. Identify them by position
+        key = Result.start if fileRes.store is not None else id
+        handled = set([key(res) for res in results])
+        ranges = []  # [first, last] ranges of rows to remove
+        for resRow, res in enumerate(fileRes.results):
+            if key(res) in handled:
+                if ranges and ranges[-1][1] == resRow - 1:
+                    ranges[-1][1] = resRow
                 else:
-                    for res in results:
-                        resIndex = fileRes.results.index(res)
-                        self.beginRemoveRows(fileResIndex, resIndex, resIndex)
-                        fileRes.results.pop(resIndex)
-                        self.endRemoveRows()
-                    if not fileRes.results:  # no results left
-                        self.beginRemoveRows(QModelIndex(), index, index)
-                        self.fileResults.pop(index)
-                        self.endRemoveRows()
-                    else:
-                        fileRes.updateCheckState()
-                return
-        else:  # not found
-            assert(0)
+                    ranges.append([resRow, resRow])
+
+        fileResIndex = self.createIndex(self._row(fileRes), 0, fileRes)
+        for first, last in reversed(ranges):  # from the end, because removal shifts next rows
+            self.beginRemoveRows(fileResIndex, first, last)
+            del fileRes.results[first:last + 1]
+            self.endRemoveRows()
+
+        if not fileRes.count():  # no results left
+            self._removeFileResults(fileRes)
+        else:
+            fileRes.updateCheckState()
+            self.dataChanged.emit(fileResIndex, fileResIndex)
 
     def matchesCount(self):
         """Get count of matches, stored by the model
         """
-        return sum([len (fileRes.results) for fileRes in self.fileResults])
+        return sum([fileRes.count() for fileRes in self.fileResults])
 
     def empty(self):
         """Check if have some items
@@ -47,11 +47,12 @@ class SearchWidget(QFrame):
     **Signal** emitted, when widget has been shown or hidden
     """  # pylint: disable=W0105
 
-    searchInDirectoryStartPressed = pyqtSignal(type(re.compile('')), list, unicode)
+    searchInDirectoryStartPressed = pyqtSignal(type(re.compile('')), list, unicode, list)
     """
-    searchInDirectoryStartPressed(regEx, mask, path)
+    searchInDirectoryStartPressed(regEx, mask, path, patterns)
 
-    **Signal** emitted, when 'search in directory' button had been pressed
+    **Signal** emitted, when 'search in directory' button had been pressed.
+    patterns is a list of tuples (word, regEx), if multiple words are searched. Otherwise empty
     """  # pylint: disable=W0105
 
     searchInDirectoryStopPressed = pyqtSignal()
@@ -168,6 +169,8 @@ class SearchWidget(QFrame):
         self.cbRegularExpression.stateChanged.connect(self._onSearchRegExpChanged)
         self.cbCaseSensitive.stateChanged.connect(self._onSearchRegExpChanged)
         self.cbWholeWord.stateChanged.connect(self._onSearchRegExpChanged)
+        self.cbMultiplePatterns.stateChanged.connect(self._onSearchRegExpChanged)
+        self.cbMultiplePatterns.stateChanged.connect(self._updateRegularExpressionEnabled)
 
         self.tbCdUp.clicked.connect(self._onCdUpPressed)
 
@@ -272,19 +275,22 @@ class SearchWidget(QFrame):
 
         # Set widgets visibility flag according to state
         widgets = (self.wSearch, self.pbPrevious, self.pbNext, self.pbSearch, self.wReplace, self.wPath, \
-                   self.pbReplace, self.pbReplaceAll, self.pbReplaceChecked, self.wOptions, self.wMask)
-        #                         wSear  pbPrev pbNext pbSear wRepl  wPath  pbRep  pbRAll pbRCHK wOpti wMask
+                   self.pbReplace, self.pbReplaceAll, self.pbReplaceChecked, self.wOptions, self.wMask, \
+                   self.cbMultiplePatterns)
+        #                         wSear  pbPrev pbNext pbSear wRepl  wPath  pbRep  pbRAll pbRCHK wOpti wMask cbMult
         visible = \
-        {MODE_SEARCH :               (1,     1,     1,     0,     0,     0,     0,     1,     1,    1,    0,),
-         MODE_REPLACE:               (1,     1,     1,     0,     1,     0,     1,     1,     0,    1,    0,),
-         MODE_SEARCH_DIRECTORY:      (1,     0,     0,     1,     0,     1,     0,     0,     0,    1,    1,),
-         MODE_REPLACE_DIRECTORY:     (1,     0,     0,     1,     1,     1,     0,     0,     1,    1,    1,),
-         MODE_SEARCH_OPENED_FILES:   (1,     0,     0,     1,     0,     0,     0,     0,     0,    1,    1,),
-         MODE_REPLACE_OPENED_FILES:  (1,     0,     0,     1,     1,     0,     0,     0,     1,    1,    1,)}
+        {MODE_SEARCH :               (1,     1,     1,     0,     0,     0,     0,     1,     1,    1,    0,    0,),
+         MODE_REPLACE:               (1,     1,     1,     0,     1,     0,     1,     1,     0,    1,    0,    0,),
+         MODE_SEARCH_DIRECTORY:      (1,     0,     0,     1,     0,     1,     0,     0,     0,    1,    1,    1,),
+         MODE_REPLACE_DIRECTORY:     (1,     0,     0,     1,     1,     1,     0,     0,     1,    1,    1,    1,),
+         MODE_SEARCH_OPENED_FILES:   (1,     0,     0,     1,     0,     0,     0,     0,     0,    1,    1,    1,),
+         MODE_REPLACE_OPENED_FILES:  (1,     0,     0,     1,     1,     0,     0,     0,     1,    1,    1,    1,)}
 
         for i, widget in enumerate(widgets):
             widget.setVisible(visible[mode][i])
 
+        self._updateRegularExpressionEnabled()
+
         # Search next button text
         if mode == MODE_REPLACE:
             self.pbNext.setText('Next')
@@ -441,15 +447,39 @@ class SearchWidget(QFrame):
             if  index == -1 :
                 self.cbMask.addItem( maskText )
 
+    def _isMultiplePatternsMode(self):
+        """Check if multiple words are searched
+        """
+        return self._mode is not None and \
+               self._mode & (MODE_FLAG_DIRECTORY | MODE_FLAG_FILES) and \
+               self.cbMultiplePatterns.checkState() == Qt.Checked
+
+    def _searchWords(self):
+        """Get list of space separated words for multiple words search
+        """
+        words = []
+        for word in self.cbSearch.currentText().split():
+            if not word in words:
+                words.append(word)
+        return words
+
     def _searchPatternTextAndFlags(self):
-        """Get search pattern and flags
+        """Get search pattern and flags.
+        If multiple words are searched, the pattern matches any of them
         """
-        pattern = self.cbSearch.currentText()
+        if self._isMultiplePatternsMode():
+            # the longest words first, as they are preferred by the search thread
+            words = sorted(self._searchWords(), key=len, reverse=True)
+            pattern = '|'.join([re.escape(word) for word in words])
+            if len(words) > 1:
+                pattern = '(?:' + pattern + ')'
+        else:
+            pattern = self.cbSearch.currentText()
 
-        pattern = pattern.replace(u'\u2029', '\n')  # replace unicode paragraph separator with habitual \n
+            pattern = pattern.replace(u'\u2029', '\n')  # replace unicode paragraph separator with habitual \n
 
-        if not self.cbRegularExpression.checkState() == Qt.Checked:
-            pattern = re.escape(pattern)
+            if not self.cbRegularExpression.checkState() == Qt.Checked:
+                pattern = re.escape(pattern)
 
         if self.cbWholeWord.checkState() == Qt.Checked:
             pattern = r'\b' + pattern + r'\b'
@@ -465,6 +495,25 @@ class SearchWidget(QFrame):
         pattern, flags = self._searchPatternTextAndFlags()
         return re.compile(pattern, flags)
 
+    def getPatterns(self):
+        """Get list of tuples (word, regExp) for every searched word, if multiple words are searched.
+        Otherwise empty list
+        """
+        if not self._isMultiplePatternsMode():
+            return []
+
+        flags = 0
+        if not self.cbCaseSensitive.checkState() == Qt.Checked:
+            flags = re.IGNORECASE
+
+        patterns = []
+        for word in self._searchWords():
+            pattern = re.escape(word)
+            if self.cbWholeWord.checkState() == Qt.Checked:
+                pattern = r'\b' + pattern + r'\b'
+            patterns.append((word, re.compile(pattern, flags)))
+        return patterns
+
     def isSearchRegExpValid(self):
         """Try to compile search pattern to check if it is valid
         Returns bool result and text error
@@ -547,6 +596,11 @@ class SearchWidget(QFrame):
 
         self.searchRegExpChanged.emit(self.getRegExp())
 
+    def _updateRegularExpressionEnabled(self):
+        """Words are searched as is in the multiple words mode. Regular expressions are not supported
+        """
+        self.cbRegularExpression.setEnabled(not self._isMultiplePatternsMode())
+
     def _onCdUpPressed(self):
         """User pressed "Up" button, need to remove one level from search path
         """
@@ -564,7 +618,8 @@ class SearchWidget(QFrame):
 
         self.searchInDirectoryStartPressed.emit(self.getRegExp(),
                                                 self._getSearchMask(),
-                                                self.cbPath.currentText())
+                                                self.cbPath.currentText(),
+                                                self.getPatterns())
 
     def on_pbReplace_pressed(self):
         """Handler of click on "Replace" (in file) button
@@ -1,5 +1,6 @@
-"""Module contains makeSubstitutions() function, which is used by controller and the threads
+"""Module contains makeSubstitutions() function and Template class, which are used by controller and the threads
 """
+import operator
 import re
 
 _seqReplacer = re.compile('\\\\.')
@@ -14,20 +15,104 @@ _escapeSequences = \
   't': '\t',}
 
 
+class Template:
+    """Replace text, parsed once for all replacements.
+
+    Escape sequences like \\n are converted to symbols. \\1 and other group references are substituted
+    with the groups of the match. A reference to not existing group is left as is
+    """
+    def __init__(self, replaceText):
+        self._segments = []  # literal text or tuple (group index, reference text)
+
+        literal = []
+        pos = 0
+        for escapeMatchObject in _seqReplacer.finditer(replaceText):
+            literal.append(replaceText[pos:escapeMatchObject.start()])
+            pos = escapeMatchObject.end()
+
+            escape = escapeMatchObject.group(0)
+            char = escape[1]
+            if char in _escapeSequences:
+                literal.append(_escapeSequences[char])
+            elif char.isdigit():
+                self._appendLiteral(literal)
+                literal = []
+                self._segments.append((int(char), escape))
+            else:
+                literal.append(escape)  # no any replacements, keep original value
+        literal.append(replaceText[pos:])
+        self._appendLiteral(literal)
+
+        if not self._segments:
+            self._literal = replaceText[:0]
+        elif len(self._segments) == 1 and not isinstance(self._segments[0], tuple):
+            self._literal = self._segments[0]
+        else:
+            self._literal = None  # has group references
+
+    def _appendLiteral(self, literal):
+        """Append literal segment, if not empty
+        """
+        text = ''.join(literal)
+        if text:
+            self._segments.append(text)
+
+    def substitute(self, matchObject):
+        """Make replacement text for the match object
+        """
+        if self._literal is not None:
+            return self._literal
+
+        parts = []
+        for segment in self._segments:
+            if isinstance(segment, tuple):
+                index, reference = segment
+                try:
+                    parts.append(matchObject.group(index) or '')
+                except IndexError:
+                    parts.append(reference)
+            else:
+                parts.append(segment)
+        return ''.join(parts)
+
+    def substituteSpans(self, text, spans):
+        """Make replacement text for the match, captured as spans array (start0, end0, start1, end1, ...).
+        See scanner.SpanMatch. text is the searched text
+        """
+        if self._literal is not None:
+            return self._literal
+
+        groupsCount = len(spans) // 2
+        parts = []
+        for segment in self._segments:
+            if isinstance(segment, tuple):
+                index, reference = segment
+                if index < groupsCount:
+                    start = spans[index * 2]
+                    if start != -1:
+                        parts.append(text[start:spans[index * 2 + 1]])
+                else:
+                    parts.append(reference)
+            else:
+                parts.append(segment)
+        return ''.join(parts)
+
+    def replaceInText(self, text, spansList):
+        """Replace the matches, captured as spans arrays, in the text. Returns the new text.
+        The text is joined from parts in one pass. The matches may be not ordered by position
+        """
+        parts = []
+        pos = 0
+        for spans in sorted(spansList, key=operator.itemgetter(0)):
+            parts.append(text[pos:spans[0]])
+            parts.append(self.substituteSpans(text, spans))
+            pos = spans[1]
+        parts.append(text[pos:])
+
+        return text[:0].join(parts)
+
+
 def makeSubstitutions(replaceText, matchObject):
     """Replace patterns like \n and \1 with symbols and matches
     """
-    def _replaceFunc(escapeMatchObject):
-        char = escapeMatchObject.group(0)[1]
-        if char in _escapeSequences:
-            return _escapeSequences[char]
-        elif char.isdigit():
-            index = int(char)
-            try:
-                return matchObject.group(index)
-            except IndexError:
-                return escapeMatchObject.group(0)
-
-        return escapeMatchObject.group(0)  # no any replacements, return original value
-
-    return _seqReplacer.sub(_replaceFunc, replaceText)
+    return Template(replaceText).substitute(matchObject)
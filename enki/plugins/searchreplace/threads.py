@@ -5,25 +5,28 @@ threads --- Search and Replace threads
 This threads are used for asynchronous search and replace
 """
 
+import collections
 import os.path
 import re
+import threading
 import time
 import fnmatch
+import itertools
+import multiprocessing
 
 from PyQt4.QtCore import pyqtSignal, \
                          QThread
 
 from enki.core.core import core
+import enki.core.projectfiles
+import enki.lib.treewalker
 import searchresultsmodel
 import substitutions
-
-
-def _isBinary(fileObject):
-    """Expects, that file position is 0, when exits, file position is 0
-    """
-    binary = '\0' in fileObject.read( 4096 )
-    fileObject.seek(0)
-    return binary
+import scanner
+import literals
+import trigramindex
+import replacefiles
+import resultcache
 
 
 class StopableThread(QThread):
@@ -53,74 +56,154 @@ class StopableThread(QThread):
 
 class SearchThread(StopableThread):
     """Thread builds list of files for search and than searches in this files.append
+
+    Results are emitted by batches. The first found results are emitted immediately, next ones when
+    Search/ResultsEmitInterval milliseconds passed or Search/MaxResultsBatchSize results found.
+    If the GUI thread hasn't processed Search/MaxPendingResultsBatches batches yet, the search pauses.
+
+    If more than one worker is configured, files are searched by a pool of worker processes.
+    Not opened files are mmap'ed and searched without decoding, if the pattern allows it.
+    If the trigram index is enabled, only files, which may contain the pattern according to the index, are searched.
+    Files, which don't contain literals, required by the pattern, are rejected without decoding.
+
+    If a list of patterns is given, all of them are searched in one pass over the files.
+    Results are grouped by pattern, see searchresultsmodel.FileResults
+
+    Results of every file are cached, see resultcache. Files, which haven't been changed since the previous search
+    with the same pattern, are not searched again
     """
-    RESULTS_EMIT_TIMEOUT = 1.0
+    POOL_BATCH_SIZE = 64  # count of files, sent to a worker process at once
+    POOL_POLL_TIMEOUT = 0.1  # how often the thread checks if it must stop, while waiting for the pool
+    POOL_PENDING_BATCHES_PER_WORKER = 2  # files are enumerated ahead of the workers by this count of batches
 
     resultsAvailable = pyqtSignal(list)  # list of searchresultsmodel.FileResults
     progressChanged = pyqtSignal(int, int)  # int value, int total
     error = pyqtSignal(unicode)
 
-    def search(self, regExp, mask, inOpenedFiles, searchPath):
+    # internal. Emitted after resultsAvailable, therefore delivered to the GUI thread after it has been processed
+    _resultsDelivered = pyqtSignal()
+
+    def __init__(self):
+        StopableThread.__init__(self)
+        self._pendingBatchesCondition = threading.Condition()
+        self._pendingBatchesCount = 0  # emitted, but not processed by the GUI thread batches
+        self._resultsDelivered.connect(self._onResultsDelivered)
+
+    def search(self, regExp, mask, inOpenedFiles, searchPath, patterns=None):
         """Start search process.
         context stores search text, directory and other parameters
+
+        patterns is a list of tuples (name, regExp) for search for several words at once.
+        regExp is not used in this case
         """
         self.stop()
 
-        self._regExp = regExp
+        if patterns:
+            self._regExps = [patternRegExp for name, patternRegExp in patterns]
+            self._pattern = scanner.MultiPattern(patterns)
+        else:
+            self._regExps = [regExp]
+            self._pattern = scanner.Pattern(regExp)
         self._mask = mask
         self._inOpenedFiles = inOpenedFiles
         self._searchPath = searchPath
+        self._workerCount = self._configuredWorkerCount()
+        self._useIndex = core.config()['Search']['TrigramIndex'] and not inOpenedFiles
+        self._listedFiles = None
+
+        self._emitInterval = core.config()['Search']['ResultsEmitInterval'] / 1000.
+        self._maxBatchSize = core.config()['Search']['MaxResultsBatchSize']
+        self._maxPendingBatchesCount = core.config()['Search']['MaxPendingResultsBatches']
+        with self._pendingBatchesCondition:
+            self._pendingBatchesCount = 0
+
+        cacheSize = core.config()['Search']['ResultCacheSize'] * 1024 * 1024
+        self._cache = resultcache.resultCache(cacheSize) if cacheSize > 0 else None
+        self._patternKey = resultcache.patternKey(self._pattern)
 
         self._openedFiles = {}
+        self._openedFileVersions = {}
         for document in core.workspace().documents():
             if document.filePath() is not None:
-                self._openedFiles[document.filePath()] = document.qutepart.text
+                text = document.qutepart.text
+                self._openedFiles[document.filePath()] = text
+                self._openedFileVersions[document.filePath()] = (id(document),
+                                                                 document.qutepart.document().revision(),
+                                                                 len(text))
 
         self.start()
 
-    def _getFiles(self, path, maskRegExp, filterRegExp):
-        """Get recursive list of files from directory.
-        maskRegExp is regExp object for check if file matches mask
+    def searchPath(self):
+        """Path of the last search
+        """
+        return self._searchPath
+
+    def listedFiles(self):
+        """List of files, found in the search directory by the last search.
+        None, if the trigram index is not used or the list had not been built
         """
-        retFiles = []
+        return self._listedFiles
 
+    @staticmethod
+    def _configuredWorkerCount():
+        """Get count of search worker processes from the settings. 0 means count of CPUs
+        """
+        count = core.config()['Search']['WorkerCount']
+        if count <= 0:
+            try:
+                count = multiprocessing.cpu_count()
+            except NotImplementedError:
+                count = 1
+        return count
+
+    def _iterDirectoryFiles(self, path, filterRegExp):
+        """Generator yields files of the directory tree in the order of enki.lib.treewalker.walk().
+
+        If the directory has been listed before, files are taken from core.projectFiles().
+        Inside a git work tree files are listed by git, files, ignored by git, are not searched.
+        Otherwise the tree is walked while the files are searched.
+        The new listing is passed to core.projectFiles()
+        """
         try:
             absPath = os.path.abspath(path)
         except OSError:  # current dir deleted
-            return []
-
-        try:
-            for root, dirs, files in os.walk(absPath, followlinks=True):  # pylint: disable=W0612
-                if root.startswith('.') or (os.path.sep + '.') in root:
-                    continue
-                for fileName in files:
-                    if fileName.startswith('.'):
-                        continue
-                    if maskRegExp and not maskRegExp.match(fileName):
-                        continue
+            return
 
-                    if filterRegExp.match(fileName):
-                        continue
+        files = core.projectFiles().files(absPath)
+        if files is not None:
+            for filePath in files:
+                yield filePath
+            return
 
-                    fullPath = os.path.join(root, fileName)
-                    if not os.path.isfile(fullPath):
-                        continue
-                    retFiles.append(root + os.path.sep + fileName)
+        listing = enki.core.projectfiles.gitListing(absPath, filterRegExp)
+        if listing is not None:
+            core.projectFiles().addListing(absPath, listing, fromGit=True)
+            files = [os.path.join(directory, fileName) \
+                        for directory, (dirs, fileNames) in listing.iteritems() \
+                            for fileName in fileNames]
+            files.sort(key=enki.lib.treewalker.walkOrderKey)
+            for filePath in files:
+                yield filePath
+            return
 
-                if self._exit :
-                    break
-        except UnicodeDecodeError:  # from os.walk()
+        listing = {}
+        try:
+            for directory, dirs, fileNames in enki.core.projectfiles.iterDirectory(absPath, filterRegExp):
+                listing[directory] = (set(dirs), set(fileNames))
+                for fileName in fileNames:
+                    yield os.path.join(directory, fileName)
+
+                if self._exit:
+                    return
+        except UnicodeDecodeError:  # from the walker
             self.error.emit('Failed to build list of files. Unicode decode error. Is correct locale set?')
-            return []
-
-        return retFiles
+            return
 
+        core.projectFiles().addListing(absPath, listing)
 
     def _getFilesToScan(self):
-        """Get list of files for search.
+        """Get files for search. Returns list for opened files and generator for directory
         """
-        files = set()
-
         if self._mask:
             regExPatterns = [fnmatch.translate(pat) for pat in self._mask]
             maskRegExpPattern = '(' + ')|('.join(regExPatterns) + ')'
@@ -129,213 +212,590 @@ class SearchThread(StopableThread):
             maskRegExp = None
 
         if self._inOpenedFiles:
-            files = self._openedFiles.keys()
-            if maskRegExp:
-                basenames = [os.path.basename(f) for f in files]
-                files = [f for f in basenames if maskRegExp.match(f)]
-            return files
+            files = sorted(self._openedFiles.keys(), key=enki.lib.treewalker.walkOrderKey)
         else:
-            path = self._searchPath
-            return self._getFiles(path, maskRegExp, core.fileFilter().regExp())
+            files = self._iterDirectoryFiles(self._searchPath, core.fileFilter().regExp())
 
-    def _fileContent(self, fileName):
-        """Read text from file
-        """
-        if fileName in self._openedFiles:
-            return self._openedFiles[ fileName ]
+        if maskRegExp:
+            files = (filePath for filePath in files \
+                        if maskRegExp.match(os.path.basename(filePath)))
 
-        try:
-            with open(fileName, 'rb') as openedFile:
-                if _isBinary(openedFile):
-                    return ''
-                return unicode(openedFile.read(), 'utf8', errors = 'ignore')
-        except IOError as ex:
-            print ex
-            return ''
+        return files
+
+    def _countFiles(self, files):
+        """Pass files through and count them.
+        self._filesCount is set, when all files have been enumerated
+        """
+        count = 0
+        for filePath in files:
+            count += 1
+            yield filePath
+        self._filesCount = count
 
     def run(self):
         """Start point of the code, running in thread.
-        Build list of files for search, than do search
+        Build list of files for search, than do search.
+        Files of not listed directory are searched while the directory is being walked.
+        Total for progressChanged is 0 until all files have been found
         """
-        startTime = time.clock()
         self.progressChanged.emit( -1, 0 )
 
-        files = sorted(self._getFilesToScan())
+        self._filesCount = 0
+        files = self._getFilesToScan()
 
-        if  self._exit :
-            return
+        if self._useIndex:
+            # The index needs the full list of files
+            files = list(files)
+            if  self._exit :
+                return
+            self._listedFiles = files
+            files = self._indexCandidates(trigramindex.indexForPath(self._searchPath), files)
+
+        if isinstance(files, list):
+            self._filesCount = len(files)
+        else:
+            files = self._countFiles(files)
 
-        self.progressChanged.emit( 0, len(files))
+        self.progressChanged.emit( 0, self._filesCount)
 
         # Prepare data for search process
-        lastResultsEmitTime = time.clock()
+        lastResultsEmitTime = None  # first results are emitted immediately
         notEmittedFileResults = []
+        notEmittedResultsCount = 0
+
+        # Pool startup is not free. Use it only if there are enough files
+        files = iter(files)
+        firstFiles = list(itertools.islice(files, self.POOL_BATCH_SIZE + 1))
+        files = itertools.chain(firstFiles, files)
+
+        if self._workerCount > 1 and len(firstFiles) > self.POOL_BATCH_SIZE:
+            fileResultsBatches = self._searchInPool(files)
+        else:
+            fileResultsBatches = self._searchInThread(files)
+
         # Search for all files
-        for fileIndex, fileName in enumerate(files):
-            results = self._searchInFile(fileName)
-            if  results:
-                newFileRes = searchresultsmodel.FileResults(self._searchPath,
-                                                            fileName,
-                                                            results)
-                notEmittedFileResults.append(newFileRes)
+        processedCount = 0
+        for processedCount, fileResultsBatch in fileResultsBatches:
+            notEmittedFileResults.extend(fileResultsBatch)
+            notEmittedResultsCount += sum([len(fileRes.results) for fileRes in fileResultsBatch])
 
             if notEmittedFileResults and \
-               (time.clock() - lastResultsEmitTime) > self.RESULTS_EMIT_TIMEOUT:
-                self.progressChanged.emit( fileIndex, len(files))
-                self.resultsAvailable.emit(notEmittedFileResults)
+               (lastResultsEmitTime is None or \
+                notEmittedResultsCount >= self._maxBatchSize or \
+                (time.time() - lastResultsEmitTime) > self._emitInterval):
+                self._emitResults(processedCount, notEmittedFileResults)
                 notEmittedFileResults = []
-                lastResultsEmitTime = time.clock()
+                notEmittedResultsCount = 0
+                lastResultsEmitTime = time.time()
 
             if  self._exit :
-                self.progressChanged.emit( fileIndex, len(files))
+                self.progressChanged.emit( processedCount, self._filesCount)
                 break
 
         if notEmittedFileResults:
-            self.resultsAvailable.emit(notEmittedFileResults)
+            self._emitResults(processedCount, notEmittedFileResults)
 
-    def _searchInFile(self, fileName):
-        """Search in the file and return searchresultsmodel.Result s
+    def _indexCandidates(self, index, files):
+        """Filter files with the trigram index. Leave files, which may contain any of the patterns
         """
-        lastPos = 0
-        eolCount = 0
-        results = []
-        eol = "\n"
+        if len(self._regExps) == 1:
+            return index.candidates(files, literals.requiredLiterals(self._regExps[0]), self._openedFiles)
 
-        content = self._fileContent( fileName )
+        candidates = set()
+        for regExp in self._regExps:
+            candidates.update(index.candidates(files, literals.requiredLiterals(regExp), self._openedFiles))
+        return [filePath for filePath in files if filePath in candidates]
 
-        # Process result for all occurrences
-        for match in self._regExp.finditer(content):
-            start = match.start()
+    def _emitResults(self, processedCount, fileResults):
+        """Emit progress and the results.
+        Wait, if the GUI thread hasn't processed too many previous batches
+        """
+        with self._pendingBatchesCondition:
+            while self._pendingBatchesCount >= self._maxPendingBatchesCount and not self._exit:
+                self._pendingBatchesCondition.wait(self.POOL_POLL_TIMEOUT)
+            self._pendingBatchesCount += 1
 
-            eolStart = content.rfind( eol, 0, start)
-            eolEnd = content.find( eol, start + len(match.group(0)))
-            eolCount += content[lastPos:start].count( eol )
-            lastPos = start
+        self.progressChanged.emit( processedCount, self._filesCount)
+        self.resultsAvailable.emit(fileResults)
+        self._resultsDelivered.emit()
 
-            wholeLine = content[eolStart+1 : eolEnd]
-            column = start - eolStart
-            if eolStart != 0:
-                column -= 1
+    def _onResultsDelivered(self):
+        """Batch of results has been processed by the GUI thread. Resume search, if paused
+        """
+        with self._pendingBatchesCondition:
+            self._pendingBatchesCount = max(0, self._pendingBatchesCount - 1)
+            self._pendingBatchesCondition.notify()
 
-            result = searchresultsmodel.Result( fileName = fileName, \
-                             wholeLine = wholeLine, \
-                             line = eolCount, \
-                             column = column, \
-                             match=match)
-            results.append(result)
+    def _searchInThread(self, files):
+        """Search in the files one by one in this thread.
+        Generator yields tuples (count of processed files, list of FileResults)
+        """
+        for fileIndex, fileName in enumerate(files):
+            results, contentHash = self._searchInFile(fileName)
+            yield fileIndex + 1, self._makeFileResults(fileName, results, contentHash)
 
             if self._exit:
                 break
-        return results
+
+    def _batches(self, files):
+        """Split iterable of files to lists of POOL_BATCH_SIZE files
+        """
+        files = iter(files)
+        while True:
+            batch = list(itertools.islice(files, self.POOL_BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+    def _searchInPool(self, files):
+        """Search in the files with a pool of worker processes.
+        Files are sent to workers by batches, while they are being enumerated.
+        Results are received in the same order as files.
+        Generator yields tuples (count of processed files, list of FileResults)
+        """
+        maxPendingBatchesCount = self._workerCount * self.POOL_PENDING_BATCHES_PER_WORKER
+        batches = self._batches(files)
+        pendingBatches = collections.deque()  # (batch, versions, cached results, AsyncResult or None)
+        allBatchesSent = False
+        processedCount = 0
+
+        pool = multiprocessing.Pool(self._workerCount, scanner.initWorker, (self._pattern,))
+        try:
+            while True:
+                while not allBatchesSent and len(pendingBatches) < maxPendingBatchesCount:
+                    batch = next(batches, None)
+                    if batch is None:
+                        allBatchesSent = True
+                    else:
+                        pendingBatches.append(self._sendBatch(pool, batch))
+                    if self._exit:
+                        return
+
+                if not pendingBatches:
+                    break
+
+                # Wait with timeout to react on stop() quickly, even if a batch takes long time
+                batch, versions, cachedResults, asyncResult = pendingBatches[0]
+                if asyncResult is not None:
+                    asyncResult.wait(self.POOL_POLL_TIMEOUT)
+                    if not asyncResult.ready():
+                        if self._exit:
+                            return
+                        continue
+
+                pendingBatches.popleft()
+                processedCount += len(batch)
+
+                found = {}
+                failed = set()
+                if asyncResult is not None:
+                    for fileName, rawResults, contentHash, error in asyncResult.get():
+                        if error is not None:
+                            self.error.emit(error)
+                            failed.add(fileName)
+                            continue
+                        if contentHash is None:  # opened file
+                            contentHash = self._openedFileHash(fileName)
+                        found[fileName] = (rawResults, contentHash)
+
+                fileResultsBatch = []
+                for fileName in batch:
+                    if fileName in cachedResults:
+                        rawResults, contentHash = cachedResults[fileName]
+                    else:
+                        rawResults, contentHash = found.get(fileName, ([], None))
+                        if fileName not in failed:
+                            self._cacheResults(fileName, versions[fileName], rawResults, contentHash)
+                    results = [self._makeResult(fileName, rawResult) for rawResult in rawResults]
+                    fileResultsBatch.extend(self._makeFileResults(fileName, results, contentHash))
+                yield processedCount, fileResultsBatch
+
+                if self._exit:
+                    return
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _sendBatch(self, pool, batch):
+        """Send not cached files of the batch to the pool.
+        Returns tuple (batch, {file name: version}, {file name: cached results}, AsyncResult or None)
+        """
+        versions = {}
+        cachedResults = {}
+        task = []
+        for fileName in batch:
+            version = self._fileVersion(fileName)
+            cached = self._cachedResults(fileName, version)
+            if cached is not None:
+                cachedResults[fileName] = cached
+            else:
+                versions[fileName] = version
+                task.append((fileName, self._openedFiles.get(fileName)))
+
+        if task:
+            asyncResult = pool.apply_async(scanner.searchInFiles, (task,))
+        else:
+            asyncResult = None
+        return batch, versions, cachedResults, asyncResult
+
+    def _fileVersion(self, fileName):
+        """Version of the file content for the result cache. Document revision for opened files,
+        size and modification time for other ones.
+        None, if the cache is disabled or the file is not accessible.
+        The version is taken before the file is read, therefore a file, changed while searching,
+        is searched again next time
+        """
+        if self._cache is None:
+            return None
+        elif fileName in self._openedFileVersions:
+            return self._openedFileVersions[fileName]
+
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def _cachedResults(self, fileName, version):
+        """Get tuple (scanner results, content hash) from the cache or None
+        """
+        if version is None:
+            return None
+        return self._cache.get((self._patternKey, fileName), version)
+
+    def _cacheResults(self, fileName, version, rawResults, contentHash):
+        """Put results of the file to the cache
+        """
+        if version is not None:
+            self._cache.put((self._patternKey, fileName), version, (rawResults, contentHash))
+
+    @staticmethod
+    def _makeResult(fileName, rawResult):
+        """Make searchresultsmodel.Result from scanner result tuple
+        """
+        wholeLine, line, column, spans = rawResult
+        return searchresultsmodel.Result( fileName = fileName, \
+                                          wholeLine = wholeLine, \
+                                          line = line, \
+                                          column = column, \
+                                          spans = spans)
+
+    def _makeFileResults(self, fileName, results, contentHash):
+        """Make list of searchresultsmodel.FileResults for results, found in the file.
+        If several patterns are searched, results of every pattern are separate FileResults
+        """
+        if not results:
+            return []
+        elif not isinstance(self._pattern, scanner.MultiPattern):
+            return [searchresultsmodel.FileResults(self._searchPath, fileName, results, contentHash=contentHash)]
+
+        resultsByPattern = {}
+        for result in results:
+            patternIndex = self._pattern.patternIndex(result.matchedText())
+            resultsByPattern.setdefault(patternIndex, []).append(result)
+
+        return [searchresultsmodel.FileResults(self._searchPath, fileName, resultsByPattern[patternIndex],
+                                               self._pattern.names[patternIndex], patternIndex, contentHash) \
+                    for patternIndex in sorted(resultsByPattern.keys())]
+
+    def _openedFileHash(self, fileName):
+        """Content hash of the opened file, as it has been searched. See scanner.contentHash()
+        """
+        return scanner.contentHash(self._openedFiles[fileName].encode('utf8'))
+
+    def _searchInFile(self, fileName):
+        """Search in the file. Returns tuple (list of searchresultsmodel.Result, content hash).
+        Not opened files are searched without decoding, if the pattern allows it
+        """
+        version = self._fileVersion(fileName)
+        cached = self._cachedResults(fileName, version)
+        if cached is not None:
+            rawResults, contentHash = cached
+        else:
+            if fileName in self._openedFiles:
+                rawResults = scanner.searchInText(self._pattern, self._openedFiles[fileName], lambda: self._exit)
+                contentHash = self._openedFileHash(fileName) if rawResults else None
+            else:
+                try:
+                    rawResults, contentHash = scanner.searchInFile(self._pattern, fileName, lambda: self._exit)
+                except EnvironmentError as ex:
+                    self.error.emit("Error opening file: %s" % ex)
+                    return [], None
+
+            if not self._exit:  # results of the interrupted search may be incomplete
+                self._cacheResults(fileName, version, rawResults, contentHash)
+
+        return [self._makeResult(fileName, rawResult) for rawResult in rawResults], contentHash
+
+
+class IndexThread(StopableThread):
+    """Thread updates the trigram index of a search directory in the background
+    """
+    error = pyqtSignal(unicode)
+
+    def updateIndex(self, searchPath, files):
+        """Start index update. Index new and changed files from the list
+        """
+        self.stop()
+
+        self._searchPath = searchPath
+        self._files = files
+
+        self.start()
+
+    def run(self):
+        """Start point of the code, running in thread
+        """
+        index = trigramindex.indexForPath(self._searchPath)
+        try:
+            index.update(self._files, lambda: self._exit)
+        except EnvironmentError as ex:
+            self.error.emit("Failed to save search index: %s" % ex)
+
+
+class RefineThread(StopableThread):
+    """Thread filters results of the last search. Files are not read.
+
+    Results, which line matches the regular expression, and which file path matches the mask, are kept.
+    The mask is list of wildcards. A wildcard with / is matched against the path relative to the search directory,
+    other ones against the file name.
+    New results are emitted at once, when all results have been filtered
+    """
+    resultsAvailable = pyqtSignal(list)  # list of searchresultsmodel.FileResults
+
+    def refine(self, fileResults, regExp, mask):
+        """Start refining.
+        fileResults is list of tuples (FileResults, list of its results or None, if the results are spilled
+        to the store and not loaded). regExp may be None, mask may be empty
+        """
+        self.stop()
+
+        self._fileResults = fileResults
+        self._regExp = regExp
+        self._mask = mask
+
+        self.start()
+
+    def _maskRegExps(self):
+        """Compile the mask. Returns tuple (reg exp for relative paths, reg exp for file names).
+        An item is None, if there are no such wildcards
+        """
+        def compileWildcards(wildcards):
+            if not wildcards:
+                return None
+            return re.compile('(' + ')|('.join([fnmatch.translate(wildcard) for wildcard in wildcards]) + ')')
+
+        return (compileWildcards([wildcard for wildcard in self._mask if '/' in wildcard]),
+                compileWildcards([wildcard for wildcard in self._mask if '/' not in wildcard]))
+
+    @staticmethod
+    def _pathMatches(fileRes, pathRegExp, nameRegExp):
+        """Check if path of the FileResults matches the mask
+        """
+        if nameRegExp is not None and nameRegExp.match(os.path.basename(fileRes.fileName)):
+            return True
+        if pathRegExp is not None:
+            relativePath = os.path.relpath(fileRes.fileName, fileRes.baseDir).replace(os.sep, '/')
+            return pathRegExp.match(relativePath) is not None
+        return False
+
+    def _filterResults(self, results):
+        """Get results, which line matches the reg exp. The reg exp is applied once per line
+        """
+        filtered = []
+        lastLine = None
+        lastLineMatches = False
+        for result in results:
+            if result.wholeLine is not lastLine:
+                lastLine = result.wholeLine
+                lastLineMatches = self._regExp.search(lastLine) is not None
+            if lastLineMatches:
+                filtered.append(result)
+        return filtered
+
+    @staticmethod
+    def _copyFileResults(fileRes, results):
+        """Make new FileResults with copies of the results. The original results are still shown by the model
+        """
+        copies = []
+        for result in results:
+            copy = searchresultsmodel.Result(result.fileName, result.wholeLine, result.line, result.column,
+                                             result.spans)
+            copy.checkState = result.checkState
+            copies.append(copy)
+
+        newFileRes = searchresultsmodel.FileResults(fileRes.baseDir, fileRes.fileName, copies,
+                                                    fileRes.pattern, fileRes.patternIndex, fileRes.contentHash)
+        newFileRes.updateCheckState()
+        return newFileRes
+
+    def run(self):
+        """Start point of the code, running in thread
+        """
+        pathRegExp, nameRegExp = self._maskRegExps()
+
+        refined = []
+        for fileRes, results in self._fileResults:
+            if self._exit:
+                return
+
+            if self._mask and not self._pathMatches(fileRes, pathRegExp, nameRegExp):
+                continue
+            if results is None:
+                results = fileRes.loadResults()
+            if self._regExp is not None:
+                results = self._filterResults(results)
+            if results:
+                refined.append(self._copyFileResults(fileRes, results))
+
+        self.resultsAvailable.emit(refined)
 
 
 class ReplaceThread(StopableThread):
     """Thread does replacements in the directory according to checked items
 
     Replacements in opened documents are done by GUI thread, in other - by new thread
+
+    The replace text is parsed once. Files are rebuilt in one pass.
+    Not opened files are replaced transactionally, see replacefiles. New contents are staged
+    by a pool of worker processes, if more than one worker is configured and there are enough files.
+    Files, which have been changed after the search, are skipped and reported.
+    If the replace is stopped before all files have been staged, no files are changed.
+    Otherwise all staged files are committed at once and the replace may be undone.
+    resultsHandled is emitted for every replaced file
+
+    Results of not opened files are taken file by file, while the files are staged.
+    Results, spilled to resultstore.ResultStore, are not loaded all at once
     """
+    POOL_MIN_FILES_COUNT = 16  # pool startup is not free. Use it only if there are enough files
+    POOL_POLL_TIMEOUT = 0.1  # how often the thread checks if it must stop, while waiting for the pool
+
     resultsHandled = pyqtSignal(unicode, list)
     finalStatus = pyqtSignal(unicode)
     error = pyqtSignal(unicode)
 
-    def replace(self, results, replaceText):
-        """Run replace process
+    def replace(self, items, replaceText):
+        """Run replace process.
+        items is dictionary {file name: list of searchresultsmodel.FileResults}.
+        Checked results of the FileResults are replaced
         """
         self.stop()
 
-        self._replaceText = replaceText
-        self._totalCount = sum([len(v) for v in results.itervalues()])
+        self._template = substitutions.Template(replaceText)
+        self._workerCount = SearchThread._configuredWorkerCount()  # pylint: disable=W0212
+        self._replacedCount = 0
 
         # do replacements in opened files, prepare for replacing in not opened
-        self._results = {}
-        for filePath, matches in results.iteritems():
+        self._items = {}
+        for filePath, fileResList in items.iteritems():
             foundDocument = core.workspace().findDocumentForPath(filePath)
             if foundDocument is not None:
+                contentHash = self._contentHash(fileResList)
+                if contentHash is not None and \
+                   scanner.contentHash(foundDocument.qutepart.text.encode('utf8')) != contentHash:
+                    self.error.emit(self.tr("File %s has been changed after the search. Not replaced") % filePath)
+                    continue
+                matches = self._checkedResults(fileResList)
                 self._replaceInOpenedDocument(foundDocument, matches)
+                self._replacedCount += len(matches)
                 self.resultsHandled.emit( filePath, matches)
             else:
-                self._results[filePath] = matches
+                self._items[filePath] = fileResList
 
         self.start()
 
-    def _replaceInOpenedDocument(self, document, matches):
-        """Do replacements in opened document
+    @staticmethod
+    def _contentHash(fileResList):
+        """Content hash of the file, when the matches have been found. None, if unknown
         """
-        pos = document.qutepart.cursorPosition
-        oldText = document.qutepart.text
-        document.qutepart.text = self._doReplacements(document.qutepart.text, matches)
-        if oldText != document.qutepart.text:
-            document.qutepart.document().setModified(True)
-        document.qutepart.cursorPosition = pos
+        return fileResList[0].contentHash
 
-    def _saveContent(self, fileName, content):
-        """Write text to the file
+    @staticmethod
+    def _checkedResults(fileResList):
+        """Get checked results of the file. Spilled results are loaded from the store
         """
-        try:
-            content = content.encode('utf8')
-        except UnicodeEncodeError as ex:
-            pattern = self.tr("Failed to encode file to utf8: %s")
-            text = unicode(str(ex), 'utf8')
-            self.error.emit(pattern % text)
-            return
+        return [result for fileRes in fileResList for result in fileRes.checkedResults()]
 
-        try:
-            with open(fileName, 'wb') as openFile:
-                openFile.write(content)
-        except IOError as ex:
-            pattern = self.tr("Error while saving replaced content: %s")
-            text = unicode(str(ex), 'utf8')
-            self.error.emit(pattern % text)
-
-    def _fileContent(self, fileName):
-        """Read file
+    def _replaceInOpenedDocument(self, document, matches):
+        """Do replacements in opened document as one undoable action
         """
-        try:
-            with open(fileName, 'rb') as openFile:
-                content = openFile.read()
-        except IOError as ex:
-            self.error.emit( self.tr( "Error opening file: %s" % str(ex) ) )
-            return ''
+        text = document.qutepart.text
+        substituteSpans = self._template.substituteSpans
+        document.applyReplacements([(result.start(), result.end(), substituteSpans(text, result.spans)) \
+                                        for result in matches])
 
-        try:
-            return unicode(content, 'utf8')
-        except UnicodeDecodeError as ex:
-            self.error.emit(self.tr( "File %s not read: unicode error '%s'. File may be corrupted" % \
-                            (fileName, str(ex) ) ))
-            return None
+    def _tasks(self):
+        """Generator of tasks for replacefiles.stageReplacements(). Results are taken file by file
+        """
+        for fileName, fileResList in self._items.iteritems():
+            spansList = [result.spans for result in self._checkedResults(fileResList)]
+            yield fileName, self._contentHash(fileResList), spansList, self._template
+
+    def _stage(self, tasks, filesCount):
+        """Stage new contents of the files with replacefiles.stageReplacements().
+        tasks is iterable of tasks for filesCount files.
+        Returns list of tuples (fileName, content hash of the new content) for staged files
+        """
+        if self._workerCount > 1 and filesCount >= self.POOL_MIN_FILES_COUNT:
+            pool = multiprocessing.Pool(self._workerCount)
+            try:
+                stagedIter = pool.imap_unordered(replacefiles.stageReplacements, tasks)
+                stagedFiles = []
+                while not self._exit:
+                    # Wait with timeout to react on stop() quickly
+                    try:
+                        fileName, contentHash, error = stagedIter.next(self.POOL_POLL_TIMEOUT)
+                    except multiprocessing.TimeoutError:
+                        continue
+                    except StopIteration:
+                        break
+                    if error is not None:
+                        self.error.emit(error)
+                    else:
+                        stagedFiles.append((fileName, contentHash))
+                return stagedFiles
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            stagedFiles = []
+            for task in tasks:
+                fileName, contentHash, error = replacefiles.stageReplacements(task)
+                if error is not None:
+                    self.error.emit(error)
+                else:
+                    stagedFiles.append((fileName, contentHash))
+                if self._exit:
+                    break
+            return stagedFiles
 
     def run(self):
         """Start point of the code, running i thread
         Does thread job
         """
-        startTime = time.clock()
-
-        for fileName in self._results.keys():
-            content = self._fileContent(fileName)
-            if content is None:  # if failed to read file
-                continue
+        startTime = time.time()
 
-            matches = self._results[ fileName ]
+        stagedFiles = self._stage(self._tasks(), len(self._items))
 
-            content = self._doReplacements(content, matches)
-
-            self._saveContent(fileName, content)
+        if self._exit:
+            replacefiles.discardStaged(self._items.keys())
+            self.finalStatus.emit("Replace cancelled. Not opened files are not changed")
+            return
 
-            self.resultsHandled.emit( fileName, matches)
+        if stagedFiles:
+            try:
+                replacefiles.Journal().commit(stagedFiles)
+            except (IOError, OSError) as ex:
+                pattern = self.tr("Failed to replace. Not opened files are not changed: %s")
+                text = unicode(str(ex), 'utf8')
+                self.error.emit(pattern % text)
+                return
 
-            if  self._exit :
-                break
+        for fileName, contentHash in stagedFiles:
+            matches = self._checkedResults(self._items[fileName])
+            self._replacedCount += len(matches)
+            self.resultsHandled.emit(fileName, matches)
 
         self.finalStatus.emit("%d replacements in %d second(s)" % \
-                              (self._totalCount,
-                               time.clock() - startTime))
-
-    def _doReplacements(self, content, matches):
-        """Do replacements for one file
-        """
-        for result in matches[::-1]:  # count from end to begin because we are replacing by offset in content
-            replaceTextWithMatches = substitutions.makeSubstitutions(self._replaceText,
-                                                                     result.match)
-            content = content[:result.match.start()] + replaceTextWithMatches + content[result.match.end():]
-
-        return content
+                              (self._replacedCount,
+                               time.time() - startTime))
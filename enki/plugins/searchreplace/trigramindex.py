@@ -0,0 +1,218 @@
+"""
+trigramindex --- Persistent trigram index of the files under a search root
+=========================================================================
+
+The index maps every 3-character substring (trigram) of the lowercased file contents to the
+list of files, which contain it. The search thread asks the index for files, which can contain
+all trigrams of the literals, required by the search pattern, and doesn't read other files.
+
+Files, which are not indexed yet or have been changed after indexing (mtime or size differ),
+are always considered as candidates, therefore not up to date index never hides matches.
+
+Index files are stored in the ``searchindex`` subdirectory of the config directory.
+The module doesn't depend on Qt
+"""
+
+import array
+import hashlib
+import marshal
+import os
+import os.path
+import threading
+
+import enki.core.defines
+
+import scanner
+
+_INDEX_FORMAT_VERSION = 1
+
+# Bigger files are not indexed and always searched
+MAX_INDEXED_FILE_SIZE = 4 * 1024 * 1024
+
+_indexes = {}  # root path -> TrigramIndex
+_indexesLock = threading.Lock()
+
+
+def indexDirectory():
+    """Directory, where index files are stored
+    """
+    return os.path.join(enki.core.defines.CONFIG_DIR, 'searchindex')
+
+
+def indexForPath(rootPath):
+    """Get TrigramIndex for the search root. Index is loaded from the disk on first request
+    """
+    rootPath = os.path.abspath(rootPath)
+    with _indexesLock:
+        if not rootPath in _indexes:
+            _indexes[rootPath] = TrigramIndex(rootPath)
+        return _indexes[rootPath]
+
+
+def _trigrams(text):
+    """Set of trigrams of the text
+    """
+    return set([text[index:index + 3] for index in xrange(len(text) - 2)])
+
+
+class TrigramIndex:
+    """Trigram index of the files under a search root.
+
+    Methods are thread safe. candidates() is called by the search thread, update() by the index thread
+    """
+    def __init__(self, rootPath):
+        self._rootPath = rootPath
+        fileName = hashlib.md5(rootPath.encode('utf8')).hexdigest()
+        self._filePath = os.path.join(indexDirectory(), fileName)
+        self._lock = threading.Lock()
+        self._clear()
+        self._load()
+
+    def _clear(self):
+        """Make the index empty
+        """
+        self._files = {}  # file path -> (mtime, size, file id)
+        self._paths = {}  # file id -> file path. Contains only ids of up to date entries
+        self._postings = {}  # trigram -> array of file ids. May contain ids of outdated entries
+        self._nextId = 0
+
+    def _load(self):
+        """Load the index from the disk. Leave it empty, if failed
+        """
+        try:
+            with open(self._filePath, 'rb') as indexFile:
+                data = marshal.load(indexFile)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+
+        if not isinstance(data, dict) or \
+           data.get('version') != _INDEX_FORMAT_VERSION or \
+           data.get('root') != self._rootPath:
+            return
+
+        self._files = data['files']
+        self._paths = dict([(fileId, path) for path, (mtime, size, fileId) in self._files.iteritems()])
+        self._postings = dict([(trigram, array.array('i', ids)) \
+                                    for trigram, ids in data['postings'].iteritems()])
+        self._nextId = data['nextId']
+
+    def _save(self):
+        """Save the index to the disk. Raises EnvironmentError, if failed.
+        The index will be rebuilt next time in this case
+        """
+        data = {'version': _INDEX_FORMAT_VERSION,
+                'root': self._rootPath,
+                'files': self._files,
+                'postings': dict([(trigram, ids.tostring()) for trigram, ids in self._postings.iteritems()]),
+                'nextId': self._nextId}
+
+        if not os.path.isdir(indexDirectory()):
+            os.makedirs(indexDirectory())
+        tmpPath = self._filePath + '.tmp'
+        with open(tmpPath, 'wb') as indexFile:
+            marshal.dump(data, indexFile)
+        if os.path.exists(self._filePath):  # os.rename() doesn't replace files on Windows
+            os.remove(self._filePath)
+        os.rename(tmpPath, self._filePath)
+
+    @staticmethod
+    def _stat(filePath):
+        """Get (mtime, size) of the file or None, if not accessible
+        """
+        try:
+            stat = os.stat(filePath)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def candidates(self, files, literals, alwaysInclude=()):
+        """Filter list of files. Leave only files, which may contain all the literals,
+        files, which are not indexed or not up to date and files from alwaysInclude.
+
+        The order of files is preserved.
+        If literals don't contain any trigram, files are returned as is
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(_trigrams(literal.lower()))
+        if not trigrams:
+            return files
+
+        with self._lock:
+            postings = [self._postings.get(trigram, ()) for trigram in trigrams]
+            postings.sort(key=len)
+            matchingIds = set(postings[0])
+            for ids in postings[1:]:
+                if not matchingIds:
+                    break
+                matchingIds.intersection_update(ids)
+
+            matchingPaths = set([self._paths[fileId] for fileId in matchingIds if fileId in self._paths])
+
+            indexedStats = {}  # file path -> (mtime, size) when indexed. Only for not matching indexed files
+            for filePath in files:
+                if filePath not in matchingPaths and filePath not in alwaysInclude:
+                    entry = self._files.get(filePath)
+                    if entry is not None:
+                        indexedStats[filePath] = entry[:2]
+
+        # Files are checked without the lock, the index thread isn't blocked while the search stats them
+        return [filePath for filePath in files \
+                    if filePath not in indexedStats or \
+                       indexedStats[filePath] != self._stat(filePath)]
+
+    def update(self, files, mustStop=None):
+        """Index new and changed files from the list and save the index.
+        Forget indexed files, which don't exist anymore.
+
+        mustStop is callable, which is checked after every file. Update is interrupted, if it returns True.
+        Raises EnvironmentError, if failed to save the index
+        """
+        changed = False
+
+        with self._lock:
+            for filePath in self._files.keys():
+                if not os.path.exists(filePath):
+                    del self._paths[self._files.pop(filePath)[2]]
+                    changed = True
+
+            # Outdated entries are never removed from postings, but only from self._paths.
+            # Rebuild the index from scratch, when it contains too many outdated ids
+            if self._nextId > 2 * len(self._paths) + 1024:
+                self._clear()
+                changed = True
+
+        for filePath in files:
+            if mustStop is not None and mustStop():
+                break
+
+            with self._lock:
+                entry = self._files.get(filePath)
+            stat = self._stat(filePath)
+            if stat is None or \
+               (entry is not None and entry[:2] == stat):  # up to date
+                continue
+            if stat[1] > MAX_INDEXED_FILE_SIZE:
+                trigrams = None
+            else:
+                text = scanner.readFile(filePath)
+                # not readable files are not indexed, the search reports the error
+                trigrams = _trigrams(text.lower()) if text is not None else None
+
+            with self._lock:
+                if filePath in self._files:
+                    del self._paths[self._files.pop(filePath)[2]]
+                if trigrams is not None:
+                    fileId = self._nextId
+                    self._nextId += 1
+                    self._files[filePath] = (stat[0], stat[1], fileId)
+                    self._paths[fileId] = filePath
+                    for trigram in trigrams:
+                        if not trigram in self._postings:
+                            self._postings[trigram] = array.array('i')
+                        self._postings[trigram].append(fileId)
+            changed = True
+
+        if changed:
+            with self._lock:
+                self._save()
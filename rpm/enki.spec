@@ -25,6 +25,7 @@ Requires:       python-markdown
 Requires:       python-qutepart >= 2.1
 Requires:       python-docutils
 Requires:       ctags
+Suggests:       python-scandir
 
 
 %if 0%{?fedora_version}
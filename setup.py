@@ -39,6 +39,11 @@ def _checkDependencies():
         print '\t' + str(ex)
         ok = False
 
+    try:
+        import scandir
+    except ImportError:
+        print "Optional scandir is not installed. Searching in directories is slower without it"
+
     if not ok:
         print 'See http://enki-editor.org/install-sources.html'
 
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import unittest
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+import base
+
+
+class Test(base.TestCase):
+    CREATE_NOT_SAVED_DOCUMENT = False
+
+    def test_one_undo_action(self):
+        text = 'foo bar foo\nbaz foo\nlast line'
+        doc = self.createFile('file.txt', text)
+        doc.qutepart.cursorPosition = (2, 2)
+
+        count = doc.applyReplacements([(0, 3, 'foo'), (16, 19, 'qux'), (8, 11, 'fox')])
+        self.assertEqual(count, 2)  # the first replacement doesn't change the text
+        self.assertEqual(doc.qutepart.text, 'foo bar fox\nbaz qux\nlast line')
+        self.assertEqual(doc.qutepart.cursorPosition, (2, 2))
+        self.assertTrue(doc.qutepart.document().isModified())
+
+        doc.qutepart.document().undo()
+        self.assertEqual(doc.qutepart.text, text)
+
+    def test_nothing_changed(self):
+        doc = self.createFile('file.txt', 'foo')
+        self.assertEqual(doc.applyReplacements([(0, 3, 'foo')]), 0)
+        self.assertFalse(doc.qutepart.document().isModified())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import unittest
+import os.path
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+import base
+
+from PyQt4.QtTest import QTest
+
+from enki.core.core import core
+from enki.core.projectfiles import gitListing, walkDirectory
+
+
+class Test(base.TestCase):
+    def _write(self, relPath, text=''):
+        path = os.path.join(self.TEST_FILE_DIR, relPath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as file_:
+            file_.write(text)
+        return path
+
+    def _addListing(self):
+        listing = walkDirectory(self.TEST_FILE_DIR, core.fileFilter().regExp())
+        core.projectFiles().addListing(self.TEST_FILE_DIR, listing)
+        QTest.qWait(0)  # listing is processed by the GUI thread
+
+    def test_files(self):
+        a = self._write('a.txt')
+        b = self._write('sub/b.py')
+        self._write('sub/b.pyc')  # filtered
+        self._write('.hidden/c.txt')
+
+        self.assertIsNone(core.projectFiles().files(self.TEST_FILE_DIR))
+
+        self._addListing()
+
+        files = core.projectFiles().files(self.TEST_FILE_DIR)
+        self.assertEqual(files, [a, self.EXISTING_FILE, b])
+        self.assertEqual(core.projectFiles().files(os.path.join(self.TEST_FILE_DIR, 'sub')), [b])
+        self.assertEqual(core.projectFiles().directoryContents(self.TEST_FILE_DIR),
+                         (['sub'], sorted(['a.txt', os.path.basename(self.EXISTING_FILE)])))
+        self.assertTrue(core.projectFiles().isFile(b))
+        self.assertFalse(core.projectFiles().isFile(os.path.join(self.TEST_FILE_DIR, 'sub', 'd.py')))
+        self.assertIsNone(core.projectFiles().isFile(os.path.join(self.TEST_FILE_DIR, 'sub', 'b.pyc')))
+        self.assertEqual(core.projectFiles().glob(os.path.join(self.TEST_FILE_DIR, 's*', '*.py')),
+                         ([], [b]))
+
+    def test_watch(self):
+        self._write('sub/b.txt')
+        self._addListing()
+
+        newFile = self._write('sub/new.txt')
+        newDirFile = self._write('sub/newdir/c.txt')
+
+        def check():
+            files = core.projectFiles().files(self.TEST_FILE_DIR)
+            self.assertIn(newFile, files)
+            self.assertIn(newDirFile, files)
+        self.waitUntilPassed(2000, check)
+
+        os.unlink(newFile)
+        self.waitUntilPassed(2000,
+                             lambda: self.assertNotIn(newFile, core.projectFiles().files(self.TEST_FILE_DIR)))
+
+    def test_git_listing(self):
+        try:
+            subprocess.check_call(['git', 'init', '-q', self.TEST_FILE_DIR])
+        except OSError:
+            self.skipTest('git is not available')
+
+        a = self._write('a.txt')
+        self._write('build/b.o')  # ignored
+        self._write('sub/b.pyc')  # filtered
+        self._write('.gitignore', 'build\n')  # hidden
+
+        subprocess.check_call(['git', 'init', '-q', os.path.join(self.TEST_FILE_DIR, 'nested')])
+        self._write('nested/n.txt')  # listed by git as 'nested/'
+        if hasattr(os, 'symlink'):
+            os.symlink(os.path.join(self.TEST_FILE_DIR, 'sub'), os.path.join(self.TEST_FILE_DIR, 'linkdir'))
+
+        listing = gitListing(self.TEST_FILE_DIR, core.fileFilter().regExp())
+        self.assertEqual(listing[self.TEST_FILE_DIR],
+                         (set(), set(['a.txt', os.path.basename(self.EXISTING_FILE)])))
+        self.assertEqual(len(listing), 1)
+
+        # ignored directory is walked
+        self.assertIsNone(gitListing(os.path.join(self.TEST_FILE_DIR, 'build'), core.fileFilter().regExp()))
+
+        # ignored files are not known
+        core.projectFiles().addListing(self.TEST_FILE_DIR, listing, fromGit=True)
+        QTest.qWait(0)  # listing is processed by the GUI thread
+        self.assertIsNone(core.projectFiles().isFile(os.path.join(self.TEST_FILE_DIR, 'build.h')))
+
+    def test_git_submodule(self):
+        try:
+            subprocess.check_call(['git', 'init', '-q', self.TEST_FILE_DIR])
+        except OSError:
+            self.skipTest('git is not available')
+
+        libPath = os.path.join(self.TEST_FILE_DIR, '.lib')
+        subprocess.check_call(['git', 'init', '-q', libPath])
+        self._write('.lib/c.txt')
+        subprocess.check_call(['git', 'add', 'c.txt'], cwd=libPath)
+        subprocess.check_call(['git', '-c', 'user.name=enki', '-c', 'user.email=enki@example.com',
+                               'commit', '-q', '-m', 'c'], cwd=libPath)
+        subprocess.check_call(['git', '-c', 'protocol.file.allow=always',
+                               'submodule', 'add', '-q', './.lib', 'sub/lib'], cwd=self.TEST_FILE_DIR)
+
+        listing = gitListing(self.TEST_FILE_DIR, core.fileFilter().regExp())
+        if listing is None:
+            self.skipTest('git is too old to list the submodules')
+        self.assertEqual(listing[os.path.join(self.TEST_FILE_DIR, 'sub', 'lib')], (set(), set(['c.txt'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
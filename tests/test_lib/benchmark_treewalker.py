@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Compare time of listing files for search with os.walk() and enki.lib.treewalker.
+
+Creates a synthetic tree of 100k files with a big ignored .git directory and walks it.
+Not a test, run manually::
+
+    python benchmark_treewalker.py [files count]
+"""
+
+import os
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", ".."))
+
+from enki.lib import treewalker
+
+FILES_PER_DIRECTORY = 50
+DIRECTORIES_PER_LEVEL = 10
+
+_FILTER = re.compile(r'.*\.(pyc|o|so)$')
+
+
+def _createTree(root, filesCount):
+    """Create directory tree with filesCount files. Third part of files are in .git
+    """
+    created = 0
+    dirIndex = 0
+    while created < filesCount:
+        if dirIndex % 3 == 0:
+            parent = os.path.join(root, '.git', 'objects', '%02x' % (dirIndex % 256))
+        else:
+            parent = root
+            index = dirIndex
+            while index:
+                parent = os.path.join(parent, 'dir%d' % (index % DIRECTORIES_PER_LEVEL))
+                index //= DIRECTORIES_PER_LEVEL
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        for fileIndex in range(min(FILES_PER_DIRECTORY, filesCount - created)):
+            extension = '.pyc' if fileIndex % 5 == 0 else '.py'
+            open(os.path.join(parent, 'f%d_%d%s' % (dirIndex, fileIndex, extension)), 'w').close()
+        created += FILES_PER_DIRECTORY
+        dirIndex += 1
+
+
+def _osWalk(root):
+    """The algorithm, used before treewalker
+    """
+    files = []
+    for dirPath, dirNames, fileNames in os.walk(root, followlinks=True):
+        for name in list(dirNames):
+            if name.startswith('.'):
+                dirNames.remove(name)
+        for name in fileNames:
+            fullPath = os.path.join(dirPath, name)
+            if not name.startswith('.') and not _FILTER.match(name) and os.path.isfile(fullPath):
+                files.append(fullPath)
+    return files
+
+
+def _treeWalker(root):
+    return list(treewalker.iterFiles(root,
+                                     skipDirectory=lambda name: name.startswith('.'),
+                                     skipFile=lambda name: name.startswith('.') or _FILTER.match(name)))
+
+
+def _measure(name, func, root):
+    startTime = time.time()
+    files = func(root)
+    print '%-12s %6.3f s, %d files' % (name, time.time() - startTime, len(files))
+    return files
+
+
+def main():
+    filesCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    root = tempfile.mkdtemp()
+    try:
+        _createTree(root, filesCount)
+        print 'scandir() is %s' % ('available' if treewalker.scandir is not None else 'not available')
+        for _ in range(2):  # first run may be affected by the cold cache
+            osWalkFiles = _measure('os.walk', _osWalk, root)
+            treeWalkerFiles = _measure('treewalker', _treeWalker, root)
+        assert sorted(osWalkFiles) == sorted(treeWalkerFiles)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
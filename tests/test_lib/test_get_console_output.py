@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", ".."))
+
+from enki.lib.get_console_output import get_console_output, open_console_output, kill_process_group
+
+
+class Test(unittest.TestCase):
+    def test_output(self):
+        stdout, stderr = get_console_output([sys.executable, '-c', 'import sys; sys.stderr.write("err")'])
+        self.assertEqual(stderr, 'err')
+
+    @unittest.skipIf(sys.platform.startswith('win'), "uses a shell")
+    def test_kill_process_group(self):
+        popen = open_console_output(['sh', '-c', 'sleep 30 & echo $!; wait'], cwd=None, new_process_group=True)
+        childPid = int(popen.stdout.readline())
+
+        start = time.time()
+        kill_process_group(popen)
+        self.assertLess(time.time() - start, 10)
+        self.assertIsNotNone(popen.returncode)
+
+        # The child of the command has been killed too
+        for i in range(50):
+            try:
+                with open('/proc/{}/stat'.format(childPid)) as statFile:
+                    alive = statFile.read().split()[2] != 'Z'
+            except IOError:
+                alive = False
+            if not alive:
+                break
+            time.sleep(0.1)
+        self.assertFalse(alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
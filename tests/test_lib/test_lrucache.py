@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import unittest
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", ".."))
+
+from enki.lib.lrucache import LruCache
+
+
+class Test(unittest.TestCase):
+    def test_lru(self):
+        cache = LruCache(20, len)
+        cache.put('a', 'x' * 10)
+        cache.put('b', 'y' * 10)
+        self.assertEqual(cache.get('a'), 'x' * 10)  # 'b' is the least recently used now
+        cache.put('c', 'z' * 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        self.assertEqual(cache.size(), 20)
+
+        cache.put('d', 'w' * 30)  # too big
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.size(), 20)
+
+        cache.setMaxSize(10)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.size(), 10)
+
+    def test_invalid(self):
+        cache = LruCache(100, len)
+        cache.put('a', 'x' * 10)
+        self.assertEqual(cache.get('a', lambda value: value.startswith('x')), 'x' * 10)
+        self.assertIsNone(cache.get('a', lambda value: False))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size(), 0)
+
+        cache.put('a', 'x' * 10)
+        cache.put('a', 'x' * 20)  # replaces the old value
+        self.assertEqual(cache.size(), 20)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
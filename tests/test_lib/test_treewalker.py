@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import unittest
+import fnmatch
+import os
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", ".."))
+
+from enki.lib import treewalker
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        for relPath in ('b.txt', 'a/z.txt', 'a/sub/y.txt', 'c/x.txt', '.git/objects/o.txt'):
+            path = os.path.join(self._dir, relPath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _path(self, relPath):
+        return os.path.join(self._dir, relPath)
+
+    def test_order(self):
+        files = list(treewalker.iterFiles(self._dir, skipDirectory=lambda name: name.startswith('.')))
+        self.assertEqual(files, [self._path('b.txt'),
+                                 self._path('a/z.txt'),
+                                 self._path('a/sub/y.txt'),
+                                 self._path('c/x.txt')])
+        self.assertEqual(sorted(reversed(files), key=treewalker.walkOrderKey), files)
+
+    def test_prune(self):
+        walked = []
+
+        def skipDirectory(name):
+            walked.append(name)
+            return name in ('.git', 'a')
+
+        dirs = [directory for directory, subdirs, files in treewalker.walk(self._dir, skipDirectory)]
+        self.assertEqual(dirs, [self._dir, self._path('c')])
+        self.assertNotIn('objects', walked)
+
+    def test_filtered_directories(self):
+        from enki.core.projectfiles import iterDirectory
+        os.makedirs(self._path('a/__pycache__'))
+        open(self._path('a/__pycache__/z.pyc'), 'w').close()
+        filterRegExp = re.compile('(' + ')|('.join([fnmatch.translate(f) for f in ('*.pyc', '__pycache__')]) + ')')
+
+        dirs = [directory for directory, subdirs, files in iterDirectory(self._dir, filterRegExp)]
+        self.assertEqual(dirs, [self._dir, self._path('a'), self._path('a/sub'), self._path('c')])
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'Symlinks not supported')
+    def test_symlink_loop(self):
+        os.symlink(self._dir, self._path('a/loop'))
+        files = list(treewalker.iterFiles(self._dir))
+        self.assertEqual(len(files), len(set(files)))
+        self.assertIn(self._path('a/z.txt'), files)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Compare time of computing line, column and whole line of search results
+with EOL counting and with enki.plugins.searchreplace.lineindex.
+
+Searches a text with 1M matches. Not a test, run manually::
+
+    python benchmark_lineindex.py [matches count]
+"""
+
+import os.path
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), "..", "..",
+                                'enki', 'plugins', 'searchreplace'))
+
+import scanner
+
+MATCHES_PER_LINE = 4
+
+
+def _searchWithEolCounting(regExp, content):
+    """The algorithm, used before lineindex
+    """
+    lastPos = 0
+    eolCount = 0
+    results = []
+    eol = "\n"
+
+    for match in regExp.finditer(content):
+        start = match.start()
+
+        eolStart = content.rfind( eol, 0, start)
+        eolEnd = content.find( eol, start + len(match.group(0)))
+        if eolEnd == -1:
+            eolEnd = len(content)
+        eolCount += content[lastPos:start].count( eol )
+        lastPos = start
+
+        wholeLine = content[eolStart+1 : eolEnd]
+        column = start - eolStart - 1
+
+        results.append((wholeLine, eolCount, column, match))
+    return results
+
+
+def _measure(name, func, regExp, content):
+    startTime = time.time()
+    results = func(regExp, content)
+    print '%-14s %6.3f s, %d matches' % (name, time.time() - startTime, len(results))
+    return results
+
+
+def main():
+    matchesCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    line = u' '.join([u'value_%d = foo(bar)' % index for index in range(MATCHES_PER_LINE)])
+    content = u'\n'.join([line] * (matchesCount // MATCHES_PER_LINE))
+    regExp = re.compile(u'foo')
+
+    old = _measure('EOL counting', _searchWithEolCounting, regExp, content)
+    new = _measure('lineindex',
+                   lambda regExp, content: scanner.searchInText(scanner.Pattern(regExp), content),
+                   regExp, content)
+    assert [result[:3] for result in old] == [result[:3] for result in new]
+
+
+if __name__ == '__main__':
+    main()
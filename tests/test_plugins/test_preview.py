@@ -15,6 +15,8 @@ import sys
 import stat
 import imp
 import codecs
+import time
+import Queue
 import mock
 
 # Local application imports
@@ -156,6 +158,28 @@ class Test(PreviewTestCase):
         with self.assertRaisesRegexp(AssertionError, 'Dock Previe&w not found'):
             self._dock()
 
+    def test_sphinxBuildCancel(self):
+        """Only a newer build of the project or quit cancels a Sphinx build.
+        """
+        from enki.plugins.preview.preview import ConverterThread
+        self._doBasicSphinxConfig()
+        # Not started, the queue is checked without a running thread
+        converterThread = ConverterThread.__new__(ConverterThread)
+        converterThread._queue = Queue.Queue()
+        rstPath = os.path.join(self.TEST_FILE_DIR, 'a.rst')
+        mdPath = os.path.join(self.TEST_FILE_DIR, 'a.md')
+
+        converterThread._queue.put(ConverterThread._Task(mdPath, 'Markdown', u'', None))
+        converterThread._queue.put(ConverterThread._CANCEL)
+        self.assertFalse(converterThread._isCancelled())
+
+        converterThread._queue.put(ConverterThread._Task(rstPath, 'Restructured Text', u'', None))
+        self.assertTrue(converterThread._isCancelled())
+
+        converterThread._queue = Queue.Queue()
+        converterThread._queue.put(None)
+        self.assertTrue(converterThread._isCancelled())
+
     def test_emptyDocument(self):
         core.workspace().createEmptyNotSavedDocument()
         with self.assertRaisesRegexp(AssertionError, 'Dock Previe&w not found'):
@@ -206,6 +230,54 @@ class Test(PreviewTestCase):
 
         self.openDialog(lambda: combo.setCurrentIndex(combo.count() - 1), inDialog)
 
+    @requiresModule('markdown')
+    def test_render_cache(self):
+        """Switching back to a rendered document shows the cached page
+        without a conversion."""
+        html = self.createFile('dummy.html', '')
+        markdown = []
+        self._assertHtmlReady(lambda: markdown.append(self.createFile('cached.md', 'cached text')))
+
+        self._dock()._thread.process = mock.Mock()
+        core.workspace().setCurrentDocument(html)
+        self._assertHtmlReady(lambda: core.workspace().setCurrentDocument(markdown[0]))
+        self.assertFalse(self._dock()._thread.process.called)
+        self.assertIn('cached text', self._plainText())
+
+    @requiresModule('markdown')
+    def test_render_cache_failed(self):
+        """A failed or timed out conversion is not served from the cache."""
+        from enki.plugins.preview import converter
+        html = self.createFile('dummy.html', '')
+        markdown = []
+        failed = converter.ConversionFailed("<font color='red'>Conversion has been aborted</font>")
+        with mock.patch.object(self._dock()._thread, '_convert', side_effect=failed):
+            self._assertHtmlReady(lambda: markdown.append(self.createFile('failed.md', 'failed text')))
+        self.assertNotIn('failed text', self._plainText())
+
+        core.workspace().setCurrentDocument(html)
+        self._assertHtmlReady(lambda: core.workspace().setCurrentDocument(markdown[0]))
+        self.assertIn('failed text', self._plainText())
+
+    @requiresModule('markdown')
+    def test_incremental_update(self):
+        """Changed blocks are replaced without reloading the page."""
+        document = []
+        self._assertHtmlReady(lambda: document.append(self.createFile('blocks.md', 'one\n\ntwo\n\nthree')))
+        qp = document[0].qutepart
+        frame = self._widget().webView.page().mainFrame()
+
+        qp.lines[2] = 'changed'
+        self.assertEmits(lambda: self._dock()._scheduleDocumentProcessing(),
+                         self._dock().setHtmlDone, 2000)
+        self.assertFalse(base.waitForSignal(lambda: None, frame.loadFinished, 200))
+        self.assertIn('changed', self._plainText())
+        self.assertNotIn('two', self._plainText())
+
+        core.config()['Preview']['IncrementalUpdate'] = False
+        self._assertHtmlReady(lambda: qp.lines.append('four'))
+        self.assertIn('four', self._plainText())
+
     # Cases for literate programming setting ui
     ##-----------------------------------------
     @requiresModule('CodeChat')
@@ -280,6 +352,9 @@ class Test(PreviewTestCase):
         self.assertTrue(sw.rbBuildOnlyOnSave.isChecked())
         self.assertTrue(sw.rbBuildOnFileChange.isEnabled())
         self.assertFalse(sw.rbBuildOnFileChange.isChecked())
+        # The build daemon is off by default.
+        self.assertTrue(sw.cbSphinxBuildDaemon.isEnabled())
+        self.assertFalse(sw.cbSphinxBuildDaemon.isChecked())
         # All setting directories are enabled and empty.
         self.assertTrue(sw.leSphinxProjectPath.isEnabled())
         self.assertEqual(sw.leSphinxProjectPath.text(), '')
@@ -759,6 +834,25 @@ head
             self.assertTrue(u"document isn't included in any toctree" in self._logText())
             self.assertTrue('#FF9955' in self._widget().prgStatus.styleSheet())
 
+    @requiresModule('sphinx')
+    @requiresSphinx
+    def test_sphinxBuildDaemon(self):
+        """The resident Sphinx application builds the project."""
+        self._doBasicSphinxConfig()
+        core.config()['Sphinx']['BuildDaemon'] = True
+        self.testText = u'Daemon text'
+        webViewContent, logContent = self._doBasicSphinxTest('rst')
+        self.assertIn(u'Daemon text', webViewContent)
+        self.assertIn(u'Sphinx build daemon', logContent)
+
+    @requiresSphinx
+    def test_sphinxOutputStreamed(self):
+        """The builder output is shown while Sphinx is running."""
+        self._doBasicSphinxConfig()
+        self.assertEmits(lambda: self.createFile('code.rst', self.testText),
+                         self._dock()._thread.htmlBuilderOutput, 10000)
+        self._assertHtmlReady(lambda: None, timeout=10000)
+
     @requiresSphinx
     def test_previewCheck23(self):
         """If the document is modified externally, then build on save will be
@@ -1122,6 +1216,72 @@ Usage: C:\Python27\Scripts\sphinx-build [options] sourcedir outdir [filenames...
         self.assertEqual(_getSphinxVersion('anything_since_replaced_by_mock'),
                          [1, 2, 3])
 
+class RenderCache(unittest.TestCase):
+    def test_lru(self):
+        from enki.plugins.preview.rendercache import RenderCache, renderKey, estimateSize
+        page = (u'x' * 100, None)
+        cache = RenderCache(estimateSize(page) * 2)
+        keys = [renderKey('Markdown', 'Default', (), text) for text in 'abc']
+        self.assertEqual(keys[0], renderKey('Markdown', 'Default', (), u'a'))
+        self.assertNotEqual(keys[0], renderKey('Markdown', 'WhiteOnBlack', (), u'a'))
+
+        cache.put(keys[0], page)
+        cache.put(keys[1], page)
+        self.assertEqual(cache.get(keys[0]), page)
+        cache.put(keys[2], page)  # evicts the least recently used
+        self.assertEqual(cache.get(keys[0]), page)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.size(), estimateSize(page) * 2)
+
+        cache.put(keys[1], (u'x' * 1000, None))  # too big
+        self.assertIsNone(cache.get(keys[1]))
+
+class HtmlBlocks(unittest.TestCase):
+    def test_split(self):
+        from enki.plugins.preview import htmlblocks
+        fragment = '<style>p {}</style>\n<p>One &amp; <b>two</b></p>\n<hr />\n<ul>\n<li>a</li>\n</ul>'
+        page = htmlblocks.splitHtml(fragment)
+        self.assertEqual(page.head, ('<style>p {}</style>\n', ''))
+        self.assertEqual([tag for tag, markup in page.blocks], ['p', 'hr', 'ul'])
+        self.assertIn('<hr data-enki-block />', htmlblocks.markedHtml(page))
+
+        document = '<html><head><title>x</title></head><body>\n<div class="document">\n' \
+                   '<h1>x</h1>\n<p>a</p>\n</div>\n</body></html>'
+        page = htmlblocks.splitHtml(document)
+        self.assertEqual([tag for tag, markup in page.blocks], ['h1', 'p'])
+        self.assertTrue(page.head[0].endswith('<div class="document">\n'))
+
+        self.assertIsNone(htmlblocks.splitHtml('text <p>a</p>'))
+        self.assertIsNone(htmlblocks.splitHtml('<p>a<li>b</p>'))
+
+    def test_changed_range(self):
+        from enki.plugins.preview.htmlblocks import changedRange
+        self.assertEqual(changedRange('abcd', 'axcd'), (1, 2, 2))
+        self.assertEqual(changedRange('ab', 'abc'), (2, 2, 3))
+        self.assertEqual(changedRange('aa', 'a'), (1, 2, 1))
+        self.assertEqual(changedRange('a', 'a'), (1, 1, 1))
+
+def _slowConvert(converterName, text, settings):
+    if text == 'hang':
+        time.sleep(60)
+    return text.upper(), None
+
+class ConverterPool(unittest.TestCase):
+    @unittest.skipUnless(sys.platform.startswith('linux'), "the patched converter is inherited by fork")
+    def test_timeout(self):
+        from enki.plugins.preview import converter
+        with mock.patch.object(converter, 'convert', _slowConvert):
+            pool = converter.ConverterPool(1)
+        try:
+            self.assertEqual(pool.convert('Markdown', u'text', {}, 5), (u'TEXT', None))
+            with self.assertRaises(converter.ConversionFailed) as context:
+                pool.convert('Markdown', u'hang', {}, 0.5)
+            self.assertIn('aborted', unicode(context.exception))
+            # The hung worker has been replaced
+            self.assertFalse(pool.convert('Restructured Text', u'', {}, 5)[1])
+        finally:
+            pool.close()
+
 # Main
 # ====
 # Run the unit tests in this file.
@@ -4,6 +4,11 @@ import unittest
 import os.path
 import sys
 import platform
+import random
+import re
+import array
+import shutil
+import tempfile
 
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
 
@@ -142,6 +147,34 @@ class InFile(base.TestCase):
         self.assertEqual(qpart.selectedPosition, ((3, 0), (4, 1)))
         self.assertEqual(qpart.selectedText, "a\nb")
 
+    @base.inMainLoop
+    def test_search_next_after_edit(self):
+        qpart = core.workspace().currentDocument().qutepart
+
+        qpart.text = 'a\nb\nx\nb\na\nb'
+
+        QTest.keyClick(core.mainWindow(), Qt.Key_F, Qt.ControlModifier)
+        QTest.mouseClick(_findSearchController()._widget.cbRegularExpression, Qt.LeftButton)
+        self.keyClicks("a\\nb")
+        self.assertEqual(qpart.selectedPosition, ((0, 0), (1, 1)))
+
+        self.keyClick(Qt.Key_F3)
+        self.assertEqual(qpart.selectedPosition, ((4, 0), (5, 1)))
+        self.assertEqual(core.mainWindow().statusBar().currentMessage(), 'Match 2 of 2')
+
+        # the new match starts on the edited line and ends on the next one
+        qpart.lines[2] = 'a'
+
+        # wrap
+        self.keyClick(Qt.Key_F3)
+        self.assertEqual(qpart.selectedPosition, ((0, 0), (1, 1)))
+        self.assertEqual(core.mainWindow().statusBar().currentMessage(), 'Match 1 of 3')
+
+        self.keyClick(Qt.Key_F3)
+        self.assertEqual(qpart.selectedPosition, ((2, 0), (3, 1)))
+        self.assertEqual(qpart.selectedText, "a\nb")
+        self.assertEqual(core.mainWindow().statusBar().currentMessage(), 'Match 2 of 3')
+
     @base.inMainLoop
     def test_whole_word(self):
         qpart = core.workspace().currentDocument().qutepart
@@ -211,6 +244,441 @@ class InFile(base.TestCase):
         qpart.text = qpart.text + ' '
         self.assertEqual(highlightedWordsCount(), 0)
 
+    def test_highlight_many_found_items(self):
+        qpart = core.workspace().currentDocument().qutepart
+        qpart.text = 'foo\n' * 5000
+
+        QTest.keyClick(core.mainWindow(), Qt.Key_F, Qt.ControlModifier)
+        self.keyClicks("foo")
+
+        # only items near the viewport are highlighted
+        count = len(qpart.extraSelections()) - 1
+        from enki.plugins.searchreplace import controller
+        self.assertTrue(0 < count <= controller.MAX_EXTRA_SELECTIONS_COUNT)
+
+        # edited line is rescanned
+        qpart.lines[1] = 'foo foo'
+        self.assertEqual(len(qpart.extraSelections()) - 1, count + 1)
+
+
+class SearchInDirectory(base.TestCase):
+    def _search(self, regExp, workerCount, patterns=None):
+        from enki.plugins.searchreplace.threads import SearchThread
+        core.config()['Search']['WorkerCount'] = workerCount
+
+        found = []
+        thread = SearchThread()
+        thread.resultsAvailable.connect(found.extend)
+        thread.search(regExp, [], False, self.TEST_FILE_DIR, patterns)
+        while not thread.wait(10):  # the thread waits until the GUI thread processes the results
+            base._processPendingEvents()
+        base._processPendingEvents()
+        return found
+
+    def test_pool(self):
+        # enough files to be sent to the worker processes by few batches
+        for index in range(200):
+            with open(os.path.join(self.TEST_FILE_DIR, 'file%03d.txt' % index), 'w') as file_:
+                file_.write('line\nfoo %d bar\n' % index)
+
+        serial = self._search(re.compile('foo (\\d+)'), 1)
+        parallel = self._search(re.compile('foo (\\d+)'), 4)
+
+        self.assertEqual(len(parallel), 200)
+        self.assertEqual([fileRes.fileName for fileRes in parallel],
+                         [fileRes.fileName for fileRes in serial])
+        result = parallel[7].results[0]
+        self.assertEqual(result.line, 1)
+        self.assertEqual(result.column, 0)
+        self.assertEqual(result.matchedText(), 'foo 7')
+        self.assertEqual(result.matchIn('line\nfoo 7 bar\n').group(1), '7')
+
+    def test_backpressure(self):
+        for index in range(20):
+            with open(os.path.join(self.TEST_FILE_DIR, 'file%03d.txt' % index), 'w') as file_:
+                file_.write('foo\n' * 3)
+
+        core.config()['Search']['MaxResultsBatchSize'] = 1
+        core.config()['Search']['MaxPendingResultsBatches'] = 1
+        found = self._search(re.compile('foo'), 1)
+        self.assertEqual(len(found), 20)
+
+    def test_not_decoded(self):
+        text = u'h\xe9llo\nfoo b\xe4r\n'
+        with open(os.path.join(self.TEST_FILE_DIR, 'utf8.txt'), 'wb') as file_:
+            file_.write(text.encode('utf8'))
+        with open(os.path.join(self.TEST_FILE_DIR, 'binary.txt'), 'wb') as file_:
+            file_.write('b\xc3\xa4r\0')
+
+        regExp = re.compile(u'b(\xe4)r')
+        from enki.plugins.searchreplace import scanner
+        self.assertIsNotNone(scanner.bytesRegExp(regExp))
+        self.assertIsNone(scanner.bytesRegExp(re.compile(u'b.r')))
+
+        found = self._search(regExp, 1)
+        self.assertEqual([os.path.basename(fileRes.fileName) for fileRes in found], ['utf8.txt'])
+        result = found[0].results[0]
+        self.assertEqual((result.line, result.column), (1, 4))
+        self.assertEqual(result.wholeLine, u'foo b\xe4r')
+        self.assertEqual(text[result.start():result.end()], u'b\xe4r')
+        self.assertEqual(result.matchIn(text).group(1), u'\xe4')
+
+
+    def test_substitutions_from_spans(self):
+        text = u'x = foo(1)\ny = fooo(2)\n'
+        with open(os.path.join(self.TEST_FILE_DIR, 'code.txt'), 'w') as file_:
+            file_.write(text)
+
+        from enki.plugins.searchreplace import substitutions
+        found = self._search(re.compile('f(o+)\\((\\d)\\)|(never)'), 1)
+        result = found[0].results[1]
+        self.assertEqual((result.line, result.column, result.matchedText()), (1, 4, 'fooo(2)'))
+        match = result.matchIn(text)
+        self.assertEqual(match.groups(), ('ooo', '2', None))
+        self.assertEqual(substitutions.makeSubstitutions('b\\1r[\\2]', match), 'booor[2]')
+
+    def test_multiple_patterns(self):
+        with open(os.path.join(self.TEST_FILE_DIR, 'a.txt'), 'w') as file_:
+            file_.write('fooBar = foo\nbar(FOO)\n')
+        with open(os.path.join(self.TEST_FILE_DIR, 'b.txt'), 'w') as file_:
+            file_.write('bar\n')
+
+        patterns = [(word, re.compile(re.escape(word), re.IGNORECASE)) for word in ('foo', 'bar', 'fooBar')]
+        found = self._search(None, 1, patterns)
+        self.assertEqual([(os.path.basename(fileRes.fileName), fileRes.pattern) for fileRes in found],
+                         [('a.txt', 'foo'), ('a.txt', 'bar'), ('a.txt', 'fooBar'), ('b.txt', 'bar')])
+        # the longest of overlapping matches wins
+        self.assertEqual([(result.line, result.matchedText()) for result in found[0].results],
+                         [(0, 'foo'), (1, 'FOO')])
+        self.assertEqual([(result.line, result.column) for result in found[2].results], [(0, 0)])
+
+    def test_refine(self):
+        os.mkdir(os.path.join(self.TEST_FILE_DIR, 'src'))
+        for name in ('a.py', 'b.txt', 'src/c.py'):
+            with open(os.path.join(self.TEST_FILE_DIR, name), 'w') as file_:
+                file_.write('foo = 1\nprint(foo)\nfoo()\n')
+
+        found = self._search(re.compile('foo'), 1)
+        self.assertEqual(len(found), 3)
+
+        from enki.plugins.searchreplace.threads import RefineThread
+
+        def refine(regExp, mask):
+            refined = []
+            thread = RefineThread()
+            thread.resultsAvailable.connect(refined.extend)
+            thread.refine([(fileRes, fileRes.results) for fileRes in found], regExp, mask)
+            thread.wait()
+            base._processPendingEvents()
+            return sorted([(os.path.relpath(fileRes.fileName, self.TEST_FILE_DIR), len(fileRes.results)) \
+                                for fileRes in refined])
+
+        self.assertEqual(refine(re.compile('print'), []), [('a.py', 1), ('b.txt', 1), ('src/c.py', 1)])
+        self.assertEqual(refine(None, ['*.py']), [('a.py', 3), ('src/c.py', 3)])
+        self.assertEqual(refine(re.compile('='), ['src/*']), [('src/c.py', 1)])
+        self.assertEqual(found[0].results[0].fileResults, found[0])  # original results are not changed
+
+    def test_result_cache(self):
+        path = os.path.join(self.TEST_FILE_DIR, 'a.txt')
+        with open(path, 'w') as file_:
+            file_.write('foo\n')
+        self.assertEqual(len(self._search(re.compile('foo|bar'), 1)[0].results), 1)
+
+        # size and mtime are not changed, cached results are replayed
+        stat = os.stat(path)
+        with open(path, 'w') as file_:
+            file_.write('bar\n')
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self._search(re.compile('foo|bar'), 1)[0].results[0].matchedText(), 'foo')
+
+        # changed file is searched again
+        with open(path, 'w') as file_:
+            file_.write('bar bar\n')
+        self.assertEqual(len(self._search(re.compile('foo|bar'), 1)[0].results), 2)
+
+
+class TrigramIndex(base.TestCase):
+    def test_candidates(self):
+        from enki.plugins.searchreplace import trigramindex, literals
+
+        paths = []
+        for name, text in (('a.txt', 'call foo_x_bar()'), ('b.txt', 'nothing here'), ('c.txt', 'FOO_Y_BAR')):
+            paths.append(os.path.join(self.TEST_FILE_DIR, name))
+            with open(paths[-1], 'w') as file_:
+                file_.write(text)
+
+        index = trigramindex.TrigramIndex(self.TEST_FILE_DIR)
+        required = literals.requiredLiterals(re.compile('foo_\\w+_bar', re.IGNORECASE))
+        self.assertEqual(required, ['foo_', '_bar'])
+
+        # not indexed files are always searched
+        self.assertEqual(index.candidates(paths, required), paths)
+
+        index.update(paths)
+        self.assertEqual(index.candidates(paths, required), [paths[0], paths[2]])
+        # no trigrams, no filtering
+        self.assertEqual(index.candidates(paths, literals.requiredLiterals(re.compile('a|b'))), paths)
+
+        # the index is persistent
+        reloaded = trigramindex.TrigramIndex(self.TEST_FILE_DIR)
+        self.assertEqual(reloaded.candidates(paths, required), [paths[0], paths[2]])
+
+        # changed file is searched until reindexed
+        with open(paths[1], 'w') as file_:
+            file_.write('now contains foo_z_bar')
+        self.assertEqual(index.candidates(paths, required), paths)
+
+
+class LineIndex(unittest.TestCase):
+    def test_lines(self):
+        from enki.plugins.searchreplace import lineindex
+        text = u'ab\n\ncd\nef'
+        index = lineindex.LineIndex(text)
+        self.assertEqual(index.lineCount(), 4)
+        self.assertEqual([index.line(pos) for pos in range(len(text) + 1)],
+                         [0, 0, 0, 1, 2, 2, 2, 3, 3, 3])
+        self.assertEqual(index.lineAndColumn(6), (2, 2))
+        self.assertEqual((index.lineStart(2), index.lineEnd(2)), (4, 6))
+        self.assertEqual(index.lineEnd(3), len(text))
+        self.assertEqual(index.lines(1, 5), u'ab\n\ncd')
+
+
+class Prefilter(unittest.TestCase):
+    def test_pure_literal(self):
+        from enki.plugins.searchreplace import literals
+        self.assertEqual(literals.pureLiteral(re.compile(u'foo\\.bar')), u'foo.bar')
+        self.assertEqual(literals.pureLiteral(re.compile(u'fo+')), None)
+        self.assertEqual(literals.pureLiteral(re.compile(u'(foo)')), None)
+
+    def test_may_match(self):
+        from enki.plugins.searchreplace import scanner
+        pattern = scanner.Pattern(re.compile(u'foo_\\w+_bar'))
+        self.assertTrue(pattern.mayMatch(u'_bar foo_'))
+        self.assertFalse(pattern.mayMatch(u'foo_x_baz'))
+        self.assertFalse(pattern.mayMatchBytes('foo_x_baz'))
+
+        # case is ignored, literals are not used
+        pattern = scanner.Pattern(re.compile(u'foo_\\w+_bar', re.IGNORECASE))
+        self.assertTrue(pattern.mayMatch(u'FOO_x_BAR'))
+        self.assertEqual(len(scanner.searchInText(pattern, u'FOO_x_BAR')), 1)
+
+    def test_literal_search(self):
+        from enki.plugins.searchreplace import scanner
+        text = u'a.b a.b\nxa.ba.b'
+        literal = scanner.searchInText(scanner.Pattern(re.compile(u'a\\.b')), text)
+        regExp = scanner.searchInText(scanner.Pattern(re.compile(u'a\\.(b)')), text)
+        self.assertEqual([result[:3] for result in literal],
+                         [(u'a.b a.b', 0, 0), (u'a.b a.b', 0, 4), (u'xa.ba.b', 1, 1), (u'xa.ba.b', 1, 4)])
+        self.assertEqual([result[:3] for result in literal], [result[:3] for result in regExp])
+
+
+class MatchIndex(unittest.TestCase):
+    def test_update(self):
+        from enki.plugins.searchreplace import matchindex
+        regExp = re.compile(u'\\bfoo\\b')
+        text = u'foo bar\nbar foo\nfoo'
+        index = matchindex.MatchIndex(regExp, text)
+        self.assertEqual(index.count(), 3)
+        self.assertEqual(index.spans(4, 14), [(12, 15)])
+
+        # 'bar' on the 2nd line replaced with 'foo foo'
+        text = u'foo bar\nfoo foo foo\nfoo'
+        index.update(text, 8, 19, 4)
+        self.assertEqual(index.spans(0, len(text)), [match.span() for match in regExp.finditer(text)])
+
+    def test_update_multiline(self):
+        """Random edits. The index must be the same, as a full rescan finds.
+        Patterns, which match or look at line breaks, are rescanned fully
+        """
+        from enki.plugins.searchreplace import matchindex
+        self.assertTrue(matchindex.isLineLocal(re.compile(u'\\bfoo\\b')))
+        self.assertFalse(matchindex.isLineLocal(re.compile(u'a\\nb')))
+        self.assertFalse(matchindex.isLineLocal(re.compile(u'b\\s*a')))
+        self.assertFalse(matchindex.isLineLocal(re.compile(u'c$', re.MULTILINE)))
+
+        rand = random.Random(1)
+        alphabet = u'abcfo x\n'
+        for pattern in (u'\\bfoo\\b', u'a.b', u'a\\nb', u'b\\s*a', u'c$', u'(?<=\\n)a'):
+            regExp = re.compile(pattern, re.MULTILINE)
+            text = u''.join([rand.choice(alphabet) for i in range(1000)])
+            index = matchindex.MatchIndex(regExp, text)
+            for i in range(200):
+                position = rand.randint(0, len(text))
+                removed = rand.randint(0, min(5, len(text) - position))
+                added = u''.join([rand.choice(alphabet) for i in range(rand.randint(0, 5))])
+                text = text[:position] + added + text[position + removed:]
+
+                # the edit is extended to whole lines, as the controller does
+                regionStart = text.rfind(u'\n', 0, position) + 1
+                regionEnd = text.find(u'\n', position + len(added))
+                if regionEnd == -1:
+                    regionEnd = len(text)
+                index.update(text, regionStart, regionEnd, len(added) - removed)
+                self.assertEqual(index.spans(0, len(text) + 1),
+                                 [match.span() for match in regExp.finditer(text)],
+                                 pattern)
+
+    def test_nearest(self):
+        from enki.plugins.searchreplace import matchindex
+        index = matchindex.MatchIndex(re.compile(u'ab'), u'ab ab ab')
+        self.assertEqual(index.nearest(3, True), 1)
+        self.assertEqual(index.nearest(4, True), 2)
+        self.assertEqual(index.nearest(7, True), 0)  # wrap
+        self.assertEqual(index.nearest(3, False), 0)
+        self.assertEqual(index.nearest(0, False), 2)  # wrap
+        self.assertEqual(index.span(2), (6, 8))
+        self.assertEqual(matchindex.MatchIndex(re.compile(u'x'), u'ab').nearest(0, True), None)
+
+
+class ResultCache(unittest.TestCase):
+    def test_lru(self):
+        from enki.plugins.searchreplace import resultcache
+        results = [(u'x' * 100, 0, 0, None)]
+        size = resultcache.estimateSize(results)
+        cache = resultcache.ResultCache(size * 2)
+
+        cache.put('a', 1, (results, None))
+        cache.put('b', 1, (results, None))
+        self.assertIsNotNone(cache.get('a', 1))  # 'b' is the least recently used now
+        cache.put('c', 1, (results, None))
+        self.assertIsNone(cache.get('b', 1))
+        self.assertIsNotNone(cache.get('a', 1))
+        self.assertEqual(cache.size(), size * 2)
+
+        self.assertIsNone(cache.get('a', 2))  # other version
+        self.assertEqual(cache.size(), size)
+
+
+class ResultsModel(base.TestCase):
+    FILES_COUNT = 10000
+    RESULTS_PER_FILE = 50
+
+    def _fileResults(self, index):
+        from enki.plugins.searchreplace.searchresultsmodel import Result, FileResults
+        fileName = os.path.join(self.TEST_FILE_DIR, 'file%05d.txt' % index)
+        results = [Result(fileName, 'foo', line, 0, array.array('l', [line * 4, line * 4 + 3])) \
+                        for line in range(self.RESULTS_PER_FILE)]
+        return FileResults(self.TEST_FILE_DIR, fileName, results)
+
+    def test_big(self):
+        from PyQt4.QtCore import QModelIndex
+        from enki.plugins.searchreplace.searchresultsmodel import SearchResultsModel
+        core.config()['Search']['MaxResultsInMemory'] = self.FILES_COUNT * self.RESULTS_PER_FILE
+        model = SearchResultsModel(None)
+        allFileResults = [self._fileResults(index) for index in range(self.FILES_COUNT)]
+        for start in range(0, self.FILES_COUNT, 1000):
+            model.appendResults(allFileResults[start:start + 1000])
+
+        self.assertEqual(model.matchesCount(), self.FILES_COUNT * self.RESULTS_PER_FILE)
+
+        def checkParents(rows):
+            for row in rows:
+                fileIndex = model.index(row, 0, QModelIndex())
+                resultIndex = model.index(self.RESULTS_PER_FILE - 1, 0, fileIndex)
+                self.assertEqual(model.parent(resultIndex), fileIndex)
+
+        checkParents(range(self.FILES_COUNT))
+
+        # Remove odd files from the end and even results of the rest
+        for fileRes in allFileResults[::-2]:
+            model.onResultsHandledByReplaceThread(fileRes.fileName, list(fileRes.results))
+        for fileRes in allFileResults[::2]:
+            model.onResultsHandledByReplaceThread(fileRes.fileName, fileRes.results[::2])
+
+        self.assertEqual(model.rowCount(QModelIndex()), self.FILES_COUNT // 2)
+        self.assertEqual(model.matchesCount(), self.FILES_COUNT // 2 * self.RESULTS_PER_FILE // 2)
+        checkParents(range(self.FILES_COUNT // 2 - 1, -1, -1))
+        self.assertEqual([res.line for res in model.fileResults[0].results],
+                         range(1, self.RESULTS_PER_FILE, 2))
+
+    def test_remove_in_random_order(self):
+        from PyQt4.QtCore import QModelIndex
+        from enki.plugins.searchreplace.searchresultsmodel import SearchResultsModel
+        core.config()['Search']['MaxResultsInMemory'] = self.FILES_COUNT * self.RESULTS_PER_FILE
+        model = SearchResultsModel(None)
+        allFileResults = [self._fileResults(index) for index in range(self.FILES_COUNT)]
+        model.appendResults(allFileResults)
+
+        # the replace thread handles the files in any order
+        removed = list(allFileResults)
+        random.Random(1).shuffle(removed)
+        removed = removed[:self.FILES_COUNT - 100]
+        for fileRes in removed:
+            model.onResultsHandledByReplaceThread(fileRes.fileName, list(fileRes.results))
+
+        removedSet = set(removed)
+        left = [fileRes for fileRes in allFileResults if fileRes not in removedSet]
+        self.assertEqual(model.fileResults, left)
+
+        # appended after the removals
+        appended = self._fileResults(self.FILES_COUNT)
+        model.appendResults([appended])
+        left.append(appended)
+        for row, fileRes in enumerate(left):
+            fileIndex = model.index(row, 0, QModelIndex())
+            resultIndex = model.index(0, 0, fileIndex)
+            self.assertEqual(model.parent(resultIndex), fileIndex)
+
+    def test_spilled(self):
+        from PyQt4.QtCore import QModelIndex
+        from enki.plugins.searchreplace.searchresultsmodel import SearchResultsModel
+        core.config()['Search']['MaxResultsInMemory'] = self.RESULTS_PER_FILE
+        model = SearchResultsModel(None)
+        model.appendResults([self._fileResults(index) for index in range(3)])
+
+        self.assertEqual(model.matchesCount(), 3 * self.RESULTS_PER_FILE)
+        self.assertIsNone(model.fileResults[0].store)
+        spilled = model.fileResults[1]
+        self.assertEqual(spilled.results, [])
+        self.assertEqual(spilled.count(), self.RESULTS_PER_FILE)
+
+        # loaded on request
+        fileIndex = model.index(1, 0, QModelIndex())
+        self.assertTrue(model.hasChildren(fileIndex))
+        self.assertTrue(model.canFetchMore(fileIndex))
+        model.fetchMore(fileIndex)
+        self.assertEqual(model.rowCount(fileIndex), self.RESULTS_PER_FILE)
+        self.assertEqual(spilled.results[3].line, 3)
+
+        # check state is stored
+        model.setData(model.index(3, 0, fileIndex), Qt.Unchecked, Qt.CheckStateRole)
+        model.unloadResults(fileIndex)
+        self.assertEqual(model.rowCount(fileIndex), 0)
+        self.assertEqual(len(spilled.checkedResults()), self.RESULTS_PER_FILE - 1)
+        self.assertEqual(spilled.checkState, Qt.PartiallyChecked)
+
+        # replaced results are removed from the store
+        model.onResultsHandledByReplaceThread(spilled.fileName, spilled.checkedResults())
+        self.assertEqual([result.line for result in spilled.loadResults()], [3])
+        self.assertEqual(model.matchesCount(), 2 * self.RESULTS_PER_FILE + 1)
+
+        model.clear()
+
+
+    def test_grouped_by_pattern(self):
+        from PyQt4.QtCore import QModelIndex
+        from enki.plugins.searchreplace.searchresultsmodel import SearchResultsModel, Result, FileResults
+        model = SearchResultsModel(None)
+
+        def fileResults(name, pattern, patternIndex):
+            results = [Result(name, pattern, 0, 0, array.array('l', [0, len(pattern)]))]
+            return FileResults(self.TEST_FILE_DIR, name, results, pattern, patternIndex)
+
+        model.appendResults([fileResults('a', 'bar', 1)])
+        model.appendResults([fileResults('a', 'foo', 0), fileResults('b', 'bar', 1)])
+        model.appendResults([fileResults('c', 'foo', 0), fileResults('c', 'baz', 2)])
+        self.assertEqual([(fileRes.pattern, fileRes.fileName) for fileRes in model.fileResults],
+                         [('foo', 'a'), ('foo', 'c'), ('bar', 'a'), ('bar', 'b'), ('baz', 'c')])
+
+        for row, fileRes in enumerate(model.fileResults):
+            index = model.index(0, 0, model.index(row, 0, QModelIndex()))
+            self.assertEqual(model.parent(index).row(), row)
+
+        model.onResultsHandledByReplaceThread('a', model.fileResults[0].results + model.fileResults[2].results)
+        model.appendResults([fileResults('d', 'foo', 0)])
+        self.assertEqual([(fileRes.pattern, fileRes.fileName) for fileRes in model.fileResults],
+                         [('foo', 'c'), ('foo', 'd'), ('bar', 'b'), ('baz', 'c')])
+
 
 class ReplaceInDirectory(base.TestCase):
     @base.inMainLoop
@@ -247,6 +715,125 @@ class ReplaceInDirectory(base.TestCase):
             self.assertEqual(file_.read(), 'the text contains UUHHH bar\nand\nfew\nmore lines\n')
 
 
+    def _search(self, regExp):
+        from enki.plugins.searchreplace.threads import SearchThread
+        found = []
+        searchThread = SearchThread()
+        searchThread.resultsAvailable.connect(found.extend)
+        searchThread.search(regExp, [], False, self.TEST_FILE_DIR)
+        while not searchThread.wait(10):
+            base._processPendingEvents()
+        base._processPendingEvents()
+        return found
+
+    def _replace(self, fileResults, replaceText):
+        from enki.plugins.searchreplace.threads import ReplaceThread
+        handled = []
+        errors = []
+        replaceThread = ReplaceThread()
+        replaceThread.resultsHandled.connect(lambda fileName, results: handled.append(fileName))
+        replaceThread.error.connect(errors.append)
+        replaceThread.replace(dict([(fileRes.fileName, [fileRes]) for fileRes in fileResults]),
+                              replaceText)
+        replaceThread.wait()
+        base._processPendingEvents()
+        return handled, errors
+
+    def test_template_and_mode(self):
+        filePath = os.path.join(self.TEST_FILE_DIR, 'script.sh')
+        with open(filePath, 'w') as file_:
+            file_.write('foo1 foo22\nfoo333\n')
+        os.chmod(filePath, 0755)
+
+        found = self._search(re.compile('foo(\\d+)'))
+        self._replace(found, '\\1bar\\9')
+
+        with open(filePath) as file_:
+            self.assertEqual(file_.read(), '1bar\\9 22bar\\9\n333bar\\9\n')
+        self.assertEqual(os.stat(filePath).st_mode & 0777, 0755)
+        self.assertEqual(os.listdir(self.TEST_FILE_DIR), ['script.sh'])  # no staged files left
+
+    def test_stale_and_undo(self):
+        from enki.plugins.searchreplace import replacefiles
+        paths = [os.path.join(self.TEST_FILE_DIR, name) for name in ('a.txt', 'b.txt')]
+        for path in paths:
+            with open(path, 'w') as file_:
+                file_.write('foo\n')
+
+        found = self._search(re.compile('foo'))
+        with open(paths[1], 'w') as file_:  # changed after the search
+            file_.write('new foo\n')
+
+        handled, errors = self._replace(found, 'bar')
+        self.assertEqual(handled, [paths[0]])
+        self.assertEqual(len(errors), 1)
+        with open(paths[0]) as file_:
+            self.assertEqual(file_.read(), 'bar\n')
+        with open(paths[1]) as file_:
+            self.assertEqual(file_.read(), 'new foo\n')
+
+        journal = replacefiles.Journal()
+        self.assertTrue(journal.canUndo())
+        self.assertEqual(journal.undo(), ([paths[0]], []))
+        with open(paths[0]) as file_:
+            self.assertEqual(file_.read(), 'foo\n')
+        self.assertFalse(journal.canUndo())
+
+    def test_undo_skips_modified_documents(self):
+        from enki.plugins.searchreplace import replacefiles
+        path = os.path.join(self.TEST_FILE_DIR, 'a.txt')
+        with open(path, 'w') as file_:
+            file_.write('foo\n')
+
+        self._replace(self._search(re.compile('foo')), 'bar')
+        restored, errors = replacefiles.Journal().undo(lambda fileName: fileName == path)
+        self.assertEqual((restored, len(errors)), ([], 1))
+        with open(path) as file_:
+            self.assertEqual(file_.read(), 'bar\n')
+        self.assertFalse(replacefiles.Journal().canUndo())
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'symbolic links are not supported')
+    def test_symlink(self):
+        from enki.plugins.searchreplace import replacefiles
+        targetDir = tempfile.mkdtemp()
+        try:
+            targetPath = os.path.join(targetDir, 'target.txt')
+            with open(targetPath, 'w') as file_:
+                file_.write('foo\n')
+            linkPath = os.path.join(self.TEST_FILE_DIR, 'link.txt')
+            os.symlink(targetPath, linkPath)
+
+            found = self._search(re.compile('foo'))
+            handled, errors = self._replace(found, 'bar')
+            self.assertEqual((handled, errors), ([linkPath], []))
+            self.assertTrue(os.path.islink(linkPath))
+            with open(targetPath) as file_:
+                self.assertEqual(file_.read(), 'bar\n')
+            self.assertEqual(os.listdir(targetDir), ['target.txt'])  # no staged files left
+
+            restored, errors = replacefiles.Journal().undo()
+            self.assertEqual((restored, errors), ([os.path.realpath(targetPath)], []))
+            self.assertTrue(os.path.islink(linkPath))
+            with open(targetPath) as file_:
+                self.assertEqual(file_.read(), 'foo\n')
+        finally:
+            shutil.rmtree(targetDir)
+
+
+class Substitutions(unittest.TestCase):
+    def test_template(self):
+        from enki.plugins.searchreplace import substitutions
+        match = re.search('f(o+)|(x)', 'a foo')
+        spans = array.array('l', [pos for span in match.regs for pos in span])
+        for replaceText, expected in (('[\\1]\\2\\t\\\\\\q\\9', '[oo]\t\\\\q\\9'),
+                                      ('plain', 'plain'),
+                                      ('', '')):
+            template = substitutions.Template(replaceText)
+            self.assertEqual(template.substitute(match), expected)
+            self.assertEqual(template.substituteSpans('a foo', spans), expected)
+            self.assertEqual(substitutions.makeSubstitutions(replaceText, match), expected)
+
+
 class Gui(base.TestCase):
     @base.inMainLoop
     def test_esc_on_widget_closes(self):